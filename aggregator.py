@@ -1,10 +1,85 @@
 #!/usr/bin/python
 from xmpp import *
 from sqlalchemy import *
-import time, sys, random, traceback
-from utils import Connection, Configuration, MessageScheduler, Notifier, Logging
-from database import Database
-from jabber_rpc import Parser
+import time, sys, random, traceback, operator
+from utils import Connection, Configuration, MessageScheduler, Notifier, Logging, OrderedWorkerPool
+from threading import RLock, Lock
+from database import Database, ResultWriter
+from jabber_rpc import Parser, Peers, NS_COMPACT_RPC, CONTROL_LANE, RESULT_LANE
+
+comparisons = {'==':operator.eq, '!=':operator.ne, '<>':operator.ne, '<':operator.lt, '<=':operator.le,
+    '>':operator.gt, '>=':operator.ge}
+
+class Evaluation:
+    """ Evaluation compiled from the database, compares values against a typed threshold.
+    A value passes when the comparison holds """
+    def __init__(self, comparison, threshold):
+        self.comparison = comparison
+        self.threshold = threshold
+        self.compare = comparisons[comparison.strip()]
+        self.numeric = type(threshold).__name__ != 'str'
+        if self.numeric:
+            self.types = (int, float)
+        else:
+            self.types = (str,)
+
+    """ Returns whether a value passes, lists pass when every element passes.
+    Raises TypeError when a value can't be compared with the threshold """
+    def check(self, val):
+        val_type = type(val).__name__
+        if val_type == 'list':
+            for element in val:
+                if not self.check(element):
+                    return False
+            return True
+        if (val_type == 'str') == self.numeric:
+            raise TypeError('Cannot compare %s with %s' % (val_type, type(self.threshold).__name__))
+        return self.compare(val, self.threshold)
+
+    """ Check a batch of values, returns True or False for each, or None where it can't be compared """
+    def check_all(self, values):
+        compare = self.compare
+        threshold = self.threshold
+        types = self.types
+        passed = []
+        for val in values:
+            # Compare directly when the value matches the threshold type, the common case
+            if type(val) in types:
+                passed.append(compare(val, threshold))
+                continue
+            try:
+                passed.append(self.check(val))
+            except TypeError:
+                passed.append(None)
+        return passed
+
+class SequenceWindow:
+    """ Sequence numbers of the results stored for a job from one Poller. Keeps the highest, and a bitmap of
+    which of the size numbers before it have been seen, so results resent out of order are still recognised.
+    Numbers older than the window are treated as unseen, so they're stored again rather than lost """
+    def __init__(self, size=1024):
+        self.size = size
+        self.highest = None
+        # Bit i is set when highest - i has been seen
+        self.bitmap = 0
+
+    def seen(self, sequence):
+        if self.highest == None or sequence > self.highest:
+            return False
+        offset = self.highest - sequence
+        if offset >= self.size:
+            return False
+        return (self.bitmap >> offset) & 1 == 1
+
+    def add(self, sequence):
+        if self.highest == None or sequence - self.highest >= self.size:
+            self.highest = sequence
+            self.bitmap = 1
+        elif sequence > self.highest:
+            self.bitmap = ((self.bitmap << (sequence - self.highest)) | 1) & ((1 << self.size) - 1)
+            self.highest = sequence
+        elif self.highest - sequence < self.size:
+            self.bitmap |= 1 << (self.highest - sequence)
 
 class Aggregator:
     """ Aggregator object 
@@ -18,21 +93,43 @@ class Aggregator:
         
         self.job_map = {}
         self.job_pool = []
+        # Job id -> Poller, jobs sent to a Poller which hasn't confirmed them yet
+        self.placing = {}
         
         self.failed_jobs = []
         
         self.evals = {}
+
+        # Sequence numbers of the results stored for each job and Poller, so resent results are acked without
+        # being stored again, and the jobs each Poller has sequence numbers for
+        self.sequences = {}
+        self.sequence_jobs = {}
+        self.duplicates = 0
+        # Held by result workers while they update the failing jobs and counters
+        self.result_lock = Lock()
         
-        self.notifier = Notifier()
+        # Notifications are sent in the background, so failing jobs don't hold up storing results
+        self.notifier = Notifier(*config.get_notifications())
         
-        self.sched = MessageScheduler(self.message_handler)
+        # Stanzas are handled by a pool of workers, in order for each sender. The lock is held by anything which
+        # changes the pollers and jobs, results are stored without it
+        self.lock = RLock()
+        workers, max_pending = config.get_dispatch()
+        self.dispatcher = OrderedWorkerPool(workers, max_pending, config.get_lane_weights())
+
+        self.sched = MessageScheduler(self.message_handler, action_lock=self.lock)
 
         conn = Connection('aggregator', 'roflcake')
         entity_prefix, entity_suffix = conn.get_entity_name()
         self.entity_name = entity_prefix + entity_suffix
 
-        self.log = Logging(conn)
+        self.log = Logging(conn, *config.get_logging())
         conn.join_muc('aggregators')
+
+        # Results are written in the background, failed writes are logged
+        batch_size, flush_interval, max_queued = config.get_result_writer()
+        self.writer = ResultWriter(self.results, batch_size, flush_interval, max_queued, self.db.get_rollup_tables(),
+            self.log.error)
         
         self.conn = conn.get_conn()
         
@@ -43,9 +140,13 @@ class Aggregator:
         self.conn.RegisterHandler('iq',self.result_handler,'result')
         self.conn.RegisterHandler('presence',self.presence_handler)
         
-        self.temp_messages = []
-        
-        self.parser = Parser()
+        # Pollers advertising the compact encoding in their disco#info are sent it
+        self.compact_rpc = config.get_compact_rpc()
+        self.peers = Peers()
+        if self.compact_rpc:
+            self.parser = Parser(self.peers)
+        else:
+            self.parser = Parser()
 
         self.go_on()
 
@@ -53,43 +154,69 @@ class Aggregator:
     def message_handler(self, message, retry=False):
         #print 'Sending message.'
         if retry == True:
-            self.log.error('Timed out, attempting to resend.')
+            self.log.warning('Timed out, attempting to resend.')
         self.conn.send(message)
     
 # HANDLERS
-    """ IQ result handler """
+    """ IQ result handler, the response's action is run by the dispatcher """
     def result_handler(self, conn, iq_node):
         if self.sched.is_managed(int(iq_node.getID())):
-            self.sched.received_response(iq_node)
+            # Free the window slot here so held messages go out without waiting on the dispatcher,
+            # only the action is queued
+            pending = self.sched.release_response(iq_node)
+            if pending != None and pending.action != None:
+                self.dispatcher.add_task(str(iq_node.getFrom()), self.sched.run_action, (pending, iq_node))
         raise NodeProcessed
             
-    """ Presence handler """
+    """ Presence handler, handled by the dispatcher """
     def presence_handler(self, conn, presence_node):
-        if len(self.job_map) > 0:
-            sender = presence_node.getFrom()
-            if presence_node.getAttr('type') == 'unavailable':
-                failed_poller = None
-                for poller in self.job_map:
-                    if poller == sender:
-                        failed_poller = poller
-                        break
-                        
-                if failed_poller != None:
-                # Only used if Controller has gone offline
-                    self.log.info('Poller %s has gone offline.' % failed_poller)
+        self.dispatcher.add_task(str(presence_node.getFrom()), self.handle_presence, (presence_node,))
         raise NodeProcessed
+
+    """ Logs Pollers going offline """
+    def handle_presence(self, presence_node):
+        self.lock.acquire()
+        try:
+            if len(self.job_map) > 0:
+                sender = presence_node.getFrom()
+                if presence_node.getAttr('type') == 'unavailable':
+                    failed_poller = None
+                    for poller in self.job_map:
+                        if poller == sender:
+                            failed_poller = poller
+                            break
+                            
+                    if failed_poller != None:
+                    # Only used if Controller has gone offline
+                        self.log.info('Poller %s has gone offline.' % failed_poller)
+        finally:
+            self.lock.release()
                 
     """ IQ get handler """
     def get_handler(self, conn, iq_node):
         if iq_node.getQueryNS() == NS_DISCO_INFO:
             reply = iq_node.buildReply('result')
             identity = Node('identity', {'category':'skynet', 'type':'aggregator'})
-            reply.setQueryPayload([identity])
+            if self.compact_rpc:
+                reply.setQueryPayload([identity, Node('feature', {'var':NS_COMPACT_RPC})])
+            else:
+                reply.setQueryPayload([identity])
             conn.send(reply)
         raise NodeProcessed
 
-    """ IQ set handler. Permits RPC calls in the whitelist, else returns error message """
+    """ IQ set handler, RPC calls are run by the dispatcher. Calls from the Controller go in the control lane,
+    ahead of results from Pollers """
     def set_handler(self, conn, iq_node):
+        if iq_node.getFrom() == 'controller@quae.co.uk/skynet':
+            lane = CONTROL_LANE
+        else:
+            lane = RESULT_LANE
+        self.dispatcher.add_task(str(iq_node.getFrom()), self.run_calls, (conn, iq_node), lane)
+        raise NodeProcessed
+
+    """ Permits RPC calls in the whitelist, else returns error message. Calls from the Controller change the
+    pollers and jobs so hold the lock, results from Pollers are stored in parallel """
+    def run_calls(self, conn, iq_node):
         sender = iq_node.getFrom()
         iq_id = iq_node.getAttr('id')
         
@@ -97,18 +224,19 @@ class Aggregator:
             query_node = iq_node.getQueryChildren()
             for node in query_node:
                 try:
-                    method = node.getTagData('methodName')
-                    method_whitelist = ['run_job', 'add_poller', 'remove_poller', 'remove_job', 'move_job']
+                    method, args = self.parser.get_call(node)
+                    method_whitelist = ['run_job', 'add_poller', 'remove_poller', 'remove_job', 'move_job',
+                    'run_jobs', 'add_pollers', 'remove_pollers', 'remove_jobs', 'move_jobs', 'get_result_stats']
                     if method in method_whitelist:
                         method = getattr(self, method)
                         try:
+                            self.lock.acquire()
                             try:
-                                params = node.getTag('params').getChildren()
-                                args = self.parser.get_args(params)
-                            except AttributeError:
-                                args = []
-                            status, parameters = apply(method, args)
-                            message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters)
+                                status, parameters = apply(method, args)
+                            finally:
+                                self.lock.release()
+                            message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters,
+                                self.parser.is_compact(node))
                             conn.send(message)
                         except TypeError:
                             #print sys.exc_info()
@@ -125,19 +253,14 @@ class Aggregator:
                 query_node = iq_node.getQueryChildren()
                 for node in query_node:
                     try:
-                       method = node.getTagData('methodName')
-                       method_whitelist = ['add_result']
+                       method, args = self.parser.get_call(node, sender)
+                       method_whitelist = ['add_result', 'add_results']
                        if method in method_whitelist:
                            method = getattr(self, method)
                            try:
-                               try:
-                                   params = node.getTag('params').getChildren()
-                                   args = self.parser.get_args(params)
-                               except AttributeError:
-                                   args = []
-                                   
                                status, parameters = apply(method, args)
-                               message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters)
+                               message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters,
+                                   self.parser.is_compact(node))
                                conn.send(message)
                            except TypeError:
                                #print sys.exc_info()
@@ -148,27 +271,75 @@ class Aggregator:
                         #print sys.exc_info()
                         conn.send(iq_node.buildReply('error'))
         
-        raise NodeProcessed  # This stanza is fully processed
-        
-    """ Establish evaluations """
+    """ Establish evaluations, compiling each once for use on every result """
     def set_evals(self, job, evaluations):
         for evaluation in evaluations:
             if evaluation.string != None:
-                self.evals[job].append((evaluation.comparison, str(evaluation.string)))
+                threshold = str(evaluation.string)
             elif evaluation.float != None:
-                self.evals[job].append((evaluation.comparison, float(evaluation.float)))
+                threshold = float(evaluation.float)
             elif evaluation.int != None:
-                self.evals[job].append((evaluation.comparison, int(evaluation.int)))
+                threshold = int(evaluation.int)
             else:
                 self.log.info('Evaluation contains no comparison value.')
+                continue
+            try:
+                self.evals[job].append(Evaluation(evaluation.comparison, threshold))
+            except KeyError:
+                self.log.error('Evaluation comparison %s is not supported.' % evaluation.comparison)
+
+    """ Evaluate a batch of values for a job. Returns, for each value, the evaluations it failed,
+    or None if it couldn't be evaluated """
+    def evaluate(self, id, values):
+        failures = [[] for val in values]
+        for evaluation in self.evals.get(int(id), []):
+            passed = evaluation.check_all(values)
+            for i in range(len(values)):
+                if failures[i] == None:
+                    continue
+                if passed[i] == None:
+                    failures[i] = None
+                elif passed[i] == False:
+                    failures[i].append(evaluation)
+        return failures
+
+    """ Log and notify when a job starts failing evaluations, and when it recovers """
+    def notify(self, id, val, failed):
+        if len(failed) > 0:
+            thresholds = ', '.join(['%s %s' % (evaluation.comparison, evaluation.threshold) for evaluation in failed])
+            message = 'Job %s has caused an error! The value %s failed the evaluations %s.' % (id, val, thresholds)
+            self.log.error(message)
+            self.result_lock.acquire()
+            started = id not in self.failed_jobs
+            if started:
+                self.failed_jobs.append(id)
+            self.result_lock.release()
+            if started:
+                self.log.info('Sending notifications')
+                self.notifier.send_email(message)
+                self.notifier.send_sms(message)
+        else:
+            self.result_lock.acquire()
+            recovered = id in self.failed_jobs
+            if recovered:
+                self.failed_jobs.remove(id)
+            self.result_lock.release()
+            if recovered:
+                message = 'Job %s is back within normal parameters' % id
+                self.notifier.send_email(message)
+                self.log.info(message)
                 
     """ Callback handler used by scheduler.add_message when poller replies on successful job assignment """
     def assign_job(self, sender, query_node):
         if query_node.getNamespace() == NS_RPC:
-            params = query_node.getTag('methodResponse').getTag('params').getChildren()
-            job_id = self.parser.get_args_no_sender(params)[0]
+            job_id = self.parser.get_response(query_node)[0]
             job_id = int(job_id)
-            self.job_map[JID(sender)].append(job_id)
+            # Jobs removed before the Poller confirmed them have already been stopped
+            if self.placing.pop(job_id, None) == None:
+                return
+            # A job restarted with new details is already known
+            if job_id not in self.job_map[JID(sender)]:
+                self.job_map[JID(sender)].append(job_id)
             self.evals[job_id] = []
             
             evaluations = self.db.get_evaluations(job_id)
@@ -176,6 +347,23 @@ class Aggregator:
         else:
             pass
 #            print 'Receieved iq message with incorrect namespace'
+
+    """ Callback handler used by scheduler.add_message when poller replies to run_jobs with the jobs it started """
+    def assign_jobs(self, sender, query_node):
+        if query_node.getNamespace() == NS_RPC:
+            job_ids = self.parser.get_response(query_node)[0]
+            for job_id in job_ids:
+                job_id = int(job_id)
+                if self.placing.pop(job_id, None) == None:
+                    continue
+                self.job_map[JID(sender)].append(job_id)
+                self.evals[job_id] = []
+                self.set_evals(job_id, self.db.get_evaluations(job_id))
+
+    """ Callback handler for the disco#info of an added Poller, records the encodings it accepts """
+    def disco_handler(self, sender, query_node):
+        if query_node.getNamespace() == NS_DISCO_INFO:
+            self.peers.add(sender, query_node)
 # END HANDLERS
 
 # RPC METHODS
@@ -196,6 +384,7 @@ class Aggregator:
 #                job_comp = num_jobs
             
             message = self.parser.rpc_call(poller, 'run_job', [self.entity_name, job, addr, proto, freq, dom, resource])
+            self.placing[int(job)] = JID(poller)
             self.sched.add_message(message, self.assign_job)
             return 'success', [str(poller), int(job)]
         else:
@@ -218,7 +407,8 @@ class Aggregator:
     """ Removes job from the Aggregator, cleans up state """
     def remove_job(self, sender, job_id):
         job_id = int(job_id)
-        parent_poller = None
+        # A job the Poller hasn't confirmed is stopped there, the run_job was sent first so arrives first
+        parent_poller = self.placing.pop(job_id, None)
         for poller, jobs in self.job_map.items():
             for i in range(len(jobs)):
                 if jobs[i] == job_id:
@@ -229,6 +419,7 @@ class Aggregator:
             self.evals.pop(job_id)
         except KeyError:
             pass
+        self.forget_sequences(job=job_id)
             
         if parent_poller != None:
             message = self.parser.rpc_call(parent_poller, 'remove_job', [job_id])
@@ -237,16 +428,127 @@ class Aggregator:
         else:
             return 'failure', ['Failed to remove job']
     
-    """ Called by child Poller to deliver result """
-    def add_result(self, sender, id, recorded, val):
-        status = self.insert_result(id, recorded, val)
-        if status != 'failure':
+    """ Batched run_job, takes a list of poller, job, addr, proto, freq, dom and resource lists.
+    Forwards the jobs for each Poller in one call """
+    def run_jobs(self, sender, jobs):
+        if len(self.job_map) > 0:
+            poller_jobs = {}
+            for poller, job, addr, proto, freq, dom, resource in jobs:
+                poller_jobs.setdefault(poller, []).append([job, addr, proto, freq, dom, resource])
+                self.placing[int(job)] = JID(poller)
+            for poller, batch in poller_jobs.items():
+                message = self.parser.rpc_call(poller, 'run_jobs', [self.entity_name, batch])
+                self.sched.add_message(message, self.assign_jobs)
+            return 'success', ['Sent %s jobs' % len(jobs)]
+        else:
+            return 'failure', ['There are no pollers connected']
+
+    """ Batched move_job, takes a list of move_job arguments """
+    def move_jobs(self, sender, jobs):
+        for poller, job, addr, proto, freq, dom, resource, segment in jobs:
+            status, parameters = self.move_job(sender, poller, job, addr, proto, freq, dom, resource, segment)
+            if status != 'success':
+                return status, parameters
+        return 'success', ['Successfully moved %s jobs' % len(jobs)]
+
+    """ Batched remove_job, stops the jobs on each Poller in one call """
+    def remove_jobs(self, sender, job_ids):
+        job_pollers = {}
+        for poller, jobs in self.job_map.items():
+            for job_id in jobs:
+                job_pollers[job_id] = poller
+        poller_jobs = {}
+        for job_id in job_ids:
+            job_id = int(job_id)
+            placing = self.placing.pop(job_id, None)
+            poller = job_pollers.get(job_id)
+            if poller != None:
+                self.job_map[poller].remove(job_id)
+            else:
+                poller = placing
+            if poller != None:
+                poller_jobs.setdefault(poller, []).append(job_id)
+            self.evals.pop(job_id, None)
+            self.forget_sequences(job=job_id)
+        for poller, batch in poller_jobs.items():
+            self.sched.add_message(self.parser.rpc_call(poller, 'remove_jobs', [batch]))
+        return 'success', ['Removed %s jobs' % sum([len(batch) for batch in poller_jobs.values()])]
+
+    """ Called by Controller, returns the number of results written, dropped by failed writes and acked as
+    duplicates since the Aggregator started """
+    def get_result_stats(self, sender):
+        return 'success', [{'written':self.writer.written, 'dropped':self.writer.dropped, 'duplicates':self.duplicates}]
+
+    """ Called by child Poller to deliver result, with its sequence number from Pollers which number results """
+    def add_result(self, sender, id, recorded, val, sequence=None):
+        if sequence != None and not self.accept_sequence(str(sender), int(id), sequence):
+            self.count_duplicates(1)
+            return 'success', ['Sucessfully added result']
+        messages = self.insert_result(id, recorded, val)
+        if messages == None:
             return 'success', ['Sucessfully added result']
         else:
-            messages = self.temp_messages
-            self.temp_messages = []
             return 'failure', messages
         
+    """ Called by child Poller to deliver a batch of results, each a list of id, recorded and value, followed by a
+    sequence number from Pollers which number results. Results already stored are acked without being stored
+    again, malformed results fail. Returns the status of each result in the order they were given """
+    def add_results(self, sender, results):
+        sender = str(sender)
+        items = [self.parse_result(result) for result in results]
+        duplicates = set()
+        # Evaluate the values for each job together
+        job_indexes = {}
+        for i in range(len(items)):
+            if items[i] == None:
+                continue
+            id, recorded, val, sequence = items[i]
+            if sequence != None and not self.accept_sequence(sender, id, sequence):
+                duplicates.add(i)
+                continue
+            job_indexes.setdefault(id, []).append(i)
+        self.count_duplicates(len(duplicates))
+        failures = [None] * len(results)
+        for job, indexes in job_indexes.items():
+            job_failures = self.evaluate(job, [items[i][2] for i in indexes])
+            for i, failed in zip(indexes, job_failures):
+                failures[i] = failed
+
+        statuses = []
+        for i in range(len(items)):
+            if i in duplicates:
+                statuses.append('success')
+                continue
+            if failures[i] == None:
+                statuses.append('failure')
+                continue
+            id, recorded, val, sequence = items[i]
+            if self.insert_result(id, recorded, val, failed=failures[i]) == None:
+                statuses.append('success')
+            else:
+                statuses.append('failure')
+        return 'success', [statuses]
+
+    """ Adds to the count of resent results acked without being stored again """
+    def count_duplicates(self, duplicates):
+        self.result_lock.acquire()
+        self.duplicates += duplicates
+        self.result_lock.release()
+
+    """ Returns the id, recorded time, value and sequence number of a result from a batch, with the sequence
+    number None if it has none. Returns None if the result is malformed """
+    def parse_result(self, result):
+        try:
+            if len(result) == 3:
+                id, recorded, val = result
+                sequence = None
+            else:
+                id, recorded, val, sequence = result
+                sequence = int(sequence)
+            return int(id), recorded, val, sequence
+        except (TypeError, ValueError):
+            return None
+        
     """ Called by Controller when Poller is assigned """
     def add_poller(self, sender, poller):
         # Subscribe to poller for presence updates
@@ -254,6 +556,8 @@ class Aggregator:
         self.roster.Subscribe(poller_jid)
         self.job_map[poller_jid] = []
         self.sched.add_message(self.parser.rpc_call(poller_jid, 'set_aggregator', [self.entity_name]))
+        if self.compact_rpc:
+            self.sched.add_message(Iq('get', queryNS=NS_DISCO_INFO, to=poller_jid), self.disco_handler)
         return 'success', ['Successfully added %s' % poller_jid]
 
     """ Called by Controller to remove references to Poller """
@@ -261,6 +565,11 @@ class Aggregator:
         poller_jid = JID(poller)
         try:
             unassigned_jobs = self.job_map.pop(poller_jid)
+            self.peers.remove(poller_jid)
+            for job_id, placing in list(self.placing.items()):
+                if placing == poller_jid:
+                    del self.placing[job_id]
+            self.forget_sequences(poller=poller_jid)
             # If controller has also failed
 #            for job in unassigned_jobs:
 #                self.job_pool.append(job)
@@ -269,70 +578,91 @@ class Aggregator:
         except KeyError:
             return 'failure', ['Failed to remove poller %s' % poller]
 
+    """ Records the sequence number of a Poller's result for a job as accepted, returns False if it was already
+    accepted so the result is a resend. Holds the lock, so windows aren't recreated for removed Pollers and jobs """
+    def accept_sequence(self, poller, job, sequence):
+        self.lock.acquire()
+        try:
+            windows = self.sequences.get(job, {})
+            window = windows.get(poller)
+            if window == None:
+                # No window is kept for a Poller or job removed while its results were being stored
+                if JID(poller) not in self.job_map or (job not in self.evals and job not in self.placing):
+                    return True
+                window = windows[poller] = SequenceWindow()
+                self.sequences[job] = windows
+                self.sequence_jobs.setdefault(poller, set()).add(job)
+            elif window.seen(sequence):
+                return False
+            window.add(sequence)
+            return True
+        finally:
+            self.lock.release()
+
+    """ Drops the sequence numbers kept for a Poller or a job """
+    def forget_sequences(self, poller=None, job=None):
+        self.lock.acquire()
+        try:
+            if job != None:
+                for job_poller in self.sequences.pop(job, {}):
+                    self.sequence_jobs.get(job_poller, set()).discard(job)
+            if poller != None:
+                poller = str(poller)
+                for poller_job in self.sequence_jobs.pop(poller, ()):
+                    windows = self.sequences.get(poller_job, {})
+                    windows.pop(poller, None)
+                    if len(windows) == 0:
+                        self.sequences.pop(poller_job, None)
+        finally:
+            self.lock.release()
+
+    """ Batched add_poller """
+    def add_pollers(self, sender, pollers):
+        for poller in pollers:
+            self.add_poller(sender, poller)
+        return 'success', ['Successfully added %s pollers' % len(pollers)]
+
+    """ Batched remove_poller """
+    def remove_pollers(self, sender, pollers):
+        removed = []
+        for poller in pollers:
+            status, parameters = self.remove_poller(sender, poller)
+            if status == 'success':
+                removed.append(poller)
+        return 'success', [removed]
+
 # END RPC METHODS
 
     """ Used when inserting results supplied by add_result.
-    Peforms evaluations, casts type, makes notifications and then stores into the database. """
-    def insert_result(self, id, recorded, val, list_id=None):
+    Peforms evaluations, casts type, makes notifications and then stores into the database.
+    Takes the evaluations the value failed if they've already been performed, list elements aren't evaluated
+    as the whole list is evaluated with its parent. Returns None once stored, or the reasons it failed """
+    def insert_result(self, id, recorded, val, list_id=None, failed=None):
 
         val_type = type(val).__name__
         
-        try:
-            evals = self.evals.get(int(id))
-            if evals:
-                for comparison, comp_val in evals:
-                    if val_type == 'int' or val_type == 'float':
-                        eval_statement = str(val) + str(comparison) + str(comp_val)
-                    elif val_type == 'str':
-                        eval_statement = str('\'' +  val + '\'') + str(comparison) + str('\'' + comp_val + '\'')
-#                    print 'Eval statement: %s' % eval_statement
-                    result = eval(eval_statement)
-#                    print 'Eval result: %s' % result
-                if result != True:
-                    message = 'Job %s has caused an error! The value %s failed an evaluation.' % (id, comp_val)
-                    self.log.error(message)
-                    if id not in self.failed_jobs:
-                        self.log.info('Sending notifications')
-                        self.notifier.send_email(message)
-                        self.notifier.send_sms(message)
-                        self.failed_jobs.append(id)
-                else:
-                    if id in self.failed_jobs:
-                        message = 'Job %s is back within normal parameters' % id
-                        self.notifier.send_email(message)
-                        self.log.info(message)
-                        self.failed_jobs.remove(id)
-                        
-        except:
-#            traceback.print_exc()
-            self.temp_messages = ['Failed to evaluate returned result']
-            return 'failure'
+        if list_id == None:
+            if failed == None:
+                failed = self.evaluate(id, [val])[0]
+                if failed == None:
+                    return ['Failed to evaluate returned result']
+            self.notify(id, val, failed)
             
-        if val_type == 'int':        
-            if list_id != None:
-                self.results.insert().execute(job=id, int=val, recorded=recorded, list=list_id)
-            else:
-                self.results.insert().execute(job=id, int=val, recorded=recorded)
+        # Rows are queued with the writer, which inserts them in bulk
+        if val_type == 'int':
+            self.writer.add(job=id, int=val, recorded=recorded, list=list_id)
         elif val_type == 'str':
-            if list_id != None:
-                self.results.insert().execute(job=id, string=val, recorded=recorded, list=list_id)
-            else:
-                self.results.insert().execute(job=id, string=val, recorded=recorded)
+            self.writer.add(job=id, string=val, recorded=recorded, list=list_id)
         elif val_type == 'float':
-            if list_item != None:
-                self.results.insert().execute(job=id, float=val, recorded=recorded, list=list_id)
-            else:
-                self.results.insert().execute(job=id, float=val, recorded=recorded)
+            self.writer.add(job=id, float=val, recorded=recorded, list=list_id)
         elif val_type == 'list':
-            self.results.insert().execute(job=id, recorded=recorded, list=0)
-            where = and_(self.results.c.recorded == recorded, self.results.c.list == 0)
-            list_id = self.results.select(where).execute().fetchone().id
-            #print "Retrieved list id %s" % list_id
+            # The parent row's id is needed by the elements, so it's inserted immediately
+            inserted = self.results.insert().execute(job=id, recorded=recorded, list=0)
+            list_id = inserted.inserted_primary_key[0]
             for element in val:
                 self.insert_result(id, recorded, element, list_id)
         else:
-            self.temp_messages = ['Unexpected data type receieved']
-            return 'failure'
+            return ['Unexpected data type receieved']
         
     """ Setup listener """
     def step_on(self):
@@ -341,6 +671,11 @@ class Aggregator:
         except KeyboardInterrupt:
             server = 'quae.co.uk'
             features.unregister(self.conn, server)
+            # Store any results still waiting to be written, once the workers adding them have finished
+            self.dispatcher.end()
+            self.writer.end()
+            self.notifier.end()
+            self.log.end()
             #print 'Unregistered from %s' % server
             return 0
         return 1
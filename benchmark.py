@@ -0,0 +1,297 @@
+""" Benchmarks for Orochi internals, run directly with the name of a benchmark:
+python benchmark.py job_scheduler """
+import sys, threading
+from time import time, sleep
+from random import uniform
+from threading import Timer, Semaphore
+
+class DummyJob:
+    """ Stand in for poller.Job, performs no polling """
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.stop = False
+        self.running = False
+
+    def run_job(self):
+        return True
+
+    def end(self):
+        self.stop = True
+
+""" Schedule drift of the poller JobScheduler with a large number of jobs """
+def job_scheduler(jobs=10000, duration=30, workers=16):
+    from poller import JobScheduler
+    threads_before = threading.active_count()
+    scheduler = JobScheduler(workers)
+    scheduler.start()
+    for i in range(jobs):
+        scheduler.add_job(DummyJob(uniform(1, 10)))
+    sleep(duration)
+    runs, mean_drift, max_drift = scheduler.get_drift()
+    threads = threading.active_count() - threads_before
+    scheduler.end()
+    scheduler.join()
+    for worker in scheduler.pool.workers:
+        worker.join()
+    print('%s jobs, %s runs in %ss using %s threads' % (jobs, runs, duration, threads))
+    print('Mean drift %.2fms, max drift %.2fms' % (mean_drift * 1000, max_drift * 1000))
+
+class TimerScheduler:
+    """ Previous MessageScheduler behaviour, starts two threading.Timer per message """
+    def __init__(self, handler):
+        self.handler = handler
+        self.messages = {}
+        self.counter = 0
+
+    def add_message(self, message):
+        self.counter += 1
+        retry_job = Timer(10, self.handler, (message, True))
+        self.messages[self.counter] = retry_job, None
+        retry_job.start()
+        Timer(0, self.handler, (message,)).start()
+
+    def end(self):
+        for retry_job, action in self.messages.values():
+            retry_job.cancel()
+            retry_job.join()
+
+""" Messages sent per second and threads used by the MessageScheduler, against the previous Timer based scheduler """
+def message_scheduler(messages=5000):
+    from xmpp import Iq
+    from utils import MessageScheduler
+
+    # Window sized so no sender blocks, responses are never sent
+    heap_scheduler = lambda handler: MessageScheduler(handler, window=messages)
+    for name, scheduler_class in [('Timer per message', TimerScheduler), ('Timer heap', heap_scheduler)]:
+        sent = Semaphore(0)
+        def handler(message, retry=False):
+            if retry == False:
+                sent.release()
+        threads_before = threading.active_count()
+        scheduler = scheduler_class(handler)
+        peak_threads = 0
+        start = time()
+        for i in range(messages):
+            scheduler.add_message(Iq('set', to='aggregator@quae.co.uk/skynet'))
+            if i % 100 == 0:
+                peak_threads = max(peak_threads, threading.active_count() - threads_before)
+        for i in range(messages):
+            sent.acquire()
+        elapsed = time() - start
+        scheduler.end()
+        print('%s: %.0f messages/sec, peak %s threads' % (name, messages / elapsed, peak_threads))
+
+""" Previous Aggregator.insert_result evaluation, builds a string for every rule and calls eval() """
+def eval_string(evals, val):
+    val_type = type(val).__name__
+    for comparison, comp_val in evals:
+        if val_type == 'int' or val_type == 'float':
+            eval_statement = str(val) + str(comparison) + str(comp_val)
+        elif val_type == 'str':
+            eval_statement = str('\'' +  val + '\'') + str(comparison) + str('\'' + comp_val + '\'')
+        result = eval(eval_statement)
+    return result
+
+""" Evaluations per second of compiled Evaluations, one value at a time and batched, against eval() of strings """
+def evaluations(values=100000):
+    from aggregator import Evaluation
+    rules = [('>', 10), ('<', 90), ('!=', 50)]
+    samples = [int(uniform(0, 100)) for i in range(values)]
+
+    start = time()
+    for val in samples:
+        eval_string(rules, val)
+    print('eval() of strings: %.0f evaluations/sec' % (values * len(rules) / (time() - start)))
+
+    compiled = [Evaluation(comparison, threshold) for comparison, threshold in rules]
+    start = time()
+    for val in samples:
+        for evaluation in compiled:
+            evaluation.check(val)
+    print('Compiled, per value: %.0f evaluations/sec' % (values * len(rules) / (time() - start)))
+
+    start = time()
+    for evaluation in compiled:
+        evaluation.check_all(samples)
+    print('Compiled, batched: %.0f evaluations/sec' % (values * len(rules) / (time() - start)))
+
+""" Draining the controller's job pool, a scan of every poller per job against the per-segment load heap """
+def job_placement(jobs=100000, pollers=500, segments=2):
+    from topology import Topology
+    def setup():
+        topology = Topology()
+        topology.add_aggregator('aggregator')
+        for i in range(pollers):
+            topology.add_poller('poller%s' % i, 'segment%s' % (i % segments))
+            topology.assign_poller('poller%s' % i, 'aggregator')
+        for i in range(jobs):
+            topology.pool_job({'id':i, 'segment':'segment%s' % (i % segments)})
+        return topology
+
+    topology = setup()
+    start = time()
+    for job in topology.get_pooled_jobs():
+        least_loaded = None
+        job_comp = None
+        for poller in topology.get_segment_pollers(job['segment']):
+            if least_loaded == None or topology.get_load(poller) < job_comp:
+                least_loaded = poller
+                job_comp = topology.get_load(poller)
+        topology.place_job(job['id'], least_loaded)
+    print('Scan of segment pollers: %s jobs placed in %.2fs' % (jobs, time() - start))
+
+    topology = setup()
+    start = time()
+    for segment in topology.get_segments():
+        job = topology.next_pooled_job(segment)
+        while job != None:
+            topology.place_job(job['id'], topology.get_least_loaded(segment))
+            job = topology.next_pooled_job(segment)
+    loads = [topology.get_load('poller%s' % i) for i in range(pollers)]
+    print('Load heap: %s jobs placed in %.2fs, %s-%s jobs per poller' % (jobs, time() - start, min(loads), max(loads)))
+
+""" Controller startup loading jobs from a SQLite database, a query per monitor and job against one streamed query """
+def establish_jobs(jobs=100000, monitors=1000, segments=4):
+    import os, tempfile
+    from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
+    from database import stream_jobs
+    handle, filename = tempfile.mkstemp()
+    os.close(handle)
+    metadata = MetaData(create_engine('sqlite:///' + filename))
+    monitor_table = Table('monitors', metadata, Column('id', Integer, primary_key=True), Column('name', String(255)))
+    segment_table = Table('segments', metadata, Column('id', Integer, primary_key=True), Column('name', String(255)))
+    job_table = Table('jobs', metadata, Column('id', Integer, primary_key=True), Column('address', String(255)),
+        Column('protocol', String(255)), Column('frequency', Integer), Column('interface', String(255)),
+        Column('resource', String(255)), Column('monitor', Integer, index=True), Column('segment', Integer))
+    metadata.create_all()
+    monitor_table.insert().execute([{'id':i, 'name':'monitor%s' % i} for i in range(monitors)])
+    segment_table.insert().execute([{'id':i, 'name':'segment%s' % i} for i in range(segments)])
+    job_table.insert().execute([{'id':i, 'address':'127.0.0.1', 'protocol':'snmp', 'frequency':1, 'interface':'public',
+        'resource':'1.3.6.1.2.1.1.3.0', 'monitor':i % monitors, 'segment':i % segments} for i in range(jobs)])
+
+    # Previous establish_jobs, through the equivalent Database methods
+    start = time()
+    pool = []
+    for monitor in monitor_table.select().execute().fetchall():
+        monitor = monitor_table.select(monitor_table.c.name == monitor.name).execute().fetchone()
+        for job in job_table.select(job_table.c.monitor == monitor.id).execute().fetchall():
+            job = dict(job)
+            segment = segment_table.select(segment_table.c.id == job['segment']).execute().fetchone()
+            job['segment'] = segment.name
+            pool.append(job)
+    print('Query per monitor and job: %s jobs loaded in %.2fs' % (len(pool), time() - start))
+
+    start = time()
+    pool = []
+    for chunk in stream_jobs(job_table, monitor_table, segment_table):
+        pool.extend(chunk)
+    print('Streamed query: %s jobs loaded in %.2fs' % (len(pool), time() - start))
+    os.remove(filename)
+
+""" Encoding and decoding of add_results calls and get_results responses by the jabber_rpc Parser, in XML-RPC and
+the compact encoding, with the standard library xmlrpclib for reference. Decoding starts from the stanza's Node
+tree, as xmpppy delivers it, xmpppy's parsing is timed separately """
+def rpc_codec(messages=200):
+    import xmlrpclib
+    from datetime import datetime
+    from xmpp import Node
+    from xmpp.simplexml import XML2Node
+    from jabber_rpc import Parser, Peers, NS_COMPACT_RPC
+    peers = Peers()
+    peers.add('compact@quae.co.uk/skynet', Node('query', payload=[Node('feature', {'var':NS_COMPACT_RPC})]))
+    parser = Parser(peers)
+    recorded = datetime.now().replace(microsecond=0)
+    # A full poller batch, a day of raw results and a day of hourly buckets
+    add_results = [[[i, recorded, [i * 7, 'up', i / 3.0][i % 3]] for i in range(100)]]
+    get_results = [[{'recorded':recorded, 'int':i} for i in range(1000)]]
+    job = {'id':1, 'address':'127.0.0.1', 'protocol':'snmp', 'frequency':60, 'interface':'public', 'resource':'1.3.6.1.2.1.1.3.0'}
+    get_results_day = [job, [{'recorded':recorded, 'count':60, 'min':1, 'max':9, 'avg':4.5, 'result':4.5} for i in range(24)]]
+    calls = [('add_results', add_results)]
+    responses = [('get_results', get_results), ('get_results_day', get_results_day)]
+    runs = []
+    for name, params in calls:
+        for encoding, to in [('XML-RPC', 'xml@quae.co.uk/skynet'), ('compact', 'compact@quae.co.uk/skynet')]:
+            runs.append((name, encoding, params, lambda params, to=to, name=name: parser.rpc_call(to, name, params),
+                lambda query: parser.get_call(query.getChildren()[0])))
+    for name, params in responses:
+        for encoding, compact in [('XML-RPC', False), ('compact', True)]:
+            runs.append((name, encoding, params, lambda params, compact=compact: parser.rpc_response('client@quae.co.uk/web', '1', 'success', params, compact),
+                parser.get_response))
+
+    for name, encoding, params, build, decode in runs:
+        start = time()
+        for i in range(messages):
+            stanza = str(build(params))
+        encode_time = (time() - start) / messages
+        start = time()
+        for i in range(messages):
+            query = XML2Node(stanza).getTag('query')
+        parse_time = (time() - start) / messages
+        start = time()
+        for i in range(messages):
+            decode(query)
+        decode_time = (time() - start) / messages
+        print('%s %s, %s bytes: encode %.2fms, xmpppy parse %.2fms, decode %.2fms' % (name, encoding, len(stanza),
+            encode_time * 1000, parse_time * 1000, decode_time * 1000))
+
+    for name, params in calls + responses:
+        start = time()
+        for i in range(messages):
+            xml = xmlrpclib.dumps(tuple(params), name, allow_none=True)
+        encode_time = (time() - start) / messages
+        start = time()
+        for i in range(messages):
+            xmlrpclib.loads(xml)
+        print('%s xmlrpclib, %s bytes: encode %.2fms, parse and decode %.2fms' % (name, len(xml), encode_time * 1000,
+            (time() - start) / messages * 1000))
+
+""" Latency of a poller failure and an ack behind a backlog of results, with and without the control lane """
+def failover_latency(results=2000, pollers=1000, workers=4):
+    from utils import OrderedWorkerPool, LaneLock
+    from jabber_rpc import CONTROL_LANE, RESULT_LANE
+    # A backlog of result stanzas taking 1ms each to store, then a poller failure arrives. Without lanes the
+    # failure is handled in turn behind the backlog
+    for label, control_lane in [('single lane', RESULT_LANE), ('control lane', CONTROL_LANE)]:
+        pool = OrderedWorkerPool(workers)
+        handled = threading.Event()
+        for i in range(results):
+            pool.add_task('poller%d' % (i % pollers), sleep, (0.001,), RESULT_LANE)
+        start = time()
+        pool.add_task('aggregator', handled.set, lane=control_lane)
+        handled.wait()
+        print('Dispatch, %s: failure handled after %.1fms' % (label, (time() - start) * 1000))
+        pool.end()
+
+    # Threads sending result batches hold the connection for 1ms each, then an ack is sent
+    for label, control_lane in [('single lane', RESULT_LANE), ('control lane', CONTROL_LANE)]:
+        lock = LaneLock()
+        stop = threading.Event()
+        def send_results():
+            while not stop.is_set():
+                lock.acquire(RESULT_LANE)
+                sleep(0.001)
+                lock.release()
+        senders = [threading.Thread(target=send_results) for i in range(workers)]
+        for sender in senders:
+            sender.start()
+        sleep(0.1)
+        latencies = []
+        for i in range(50):
+            start = time()
+            lock.acquire(control_lane)
+            latencies.append(time() - start)
+            lock.release()
+            sleep(0.005)
+        stop.set()
+        for sender in senders:
+            sender.join()
+        print('Send, %s: ack sent after %.1fms avg, %.1fms max' % (label, sum(latencies) / len(latencies) * 1000,
+            max(latencies) * 1000))
+
+if __name__ == '__main__':
+    benchmarks = ['job_scheduler', 'message_scheduler', 'evaluations', 'job_placement', 'establish_jobs', 'rpc_codec',
+        'failover_latency']
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python benchmark.py [%s]' % '|'.join(benchmarks))
+        sys.exit(1)
+    globals()[sys.argv[1]]()
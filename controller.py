@@ -1,13 +1,14 @@
 from sqlalchemy import *
 from xmpp import *
-from time import sleep
-from utils import Connection, MessageScheduler, Logging
-from jabber_rpc import Parser
-from database import Database
+from time import sleep, time
+from utils import Connection, Configuration, MessageScheduler, Logging, OrderedWorkerPool
+from jabber_rpc import Parser, Peers, CONTROL_LANE, RESULT_LANE
+from database import Database, ResultMaintenance
+from topology import Topology
 from Queue import Queue
 from types import *
-from threading import Thread
-import sys
+from threading import Thread, RLock
+import sys, os, json
 from datetime import datetime
 
 import traceback
@@ -20,28 +21,66 @@ class Controller:
 
         self.db = Database()
 
+        # Results partitioning and retention
+        interval, partition = Configuration().get_maintenance()
+        self.maintenance = ResultMaintenance(self.db, interval, partition)
+        self.maintenance.start()
+
         entity_prefix = 'controller'
 
         conn = Connection(entity_prefix, static=True)
         self.entity_name, self.entity_suffix = conn.get_entity_name()
         
-        # List of nodes known to the controller
-        self.poller_map = {}
-        self.poller_pool = {}
-        
-        self.job_map = {}
-        self.job_pool = []
+        # Nodes and jobs known to the controller
+        self.topology = Topology()
+        # Job id -> (poller, time removed), jobs removed while placed, stopped once the placement is confirmed
+        self.cancelled_placements = {}
+
+        # Limit on the jobs and pollers moved by rebalancing in each interval
+        self.move_budget, self.move_interval = Configuration().get_rebalance()
+        self.moves_left = self.move_budget
+        self.budget_reset = 0
+        # Time of the next rebalance, or None. Nodes joining or leaving request a rebalance after a short delay,
+        # so a burst of them is handled by one pass
+        self.rebalance_due = None
+        self.rebalance_delay, self.rebalance_max_delay = Configuration().get_rebalance_delay()
+        # Time of the first request waiting on the next pass, or None
+        self.first_request = None
+        # Requests waiting on the next pass, and totals for get_rebalance_stats
+        self.pending_requests = 0
+        self.rebalance_requests = 0
+        self.rebalance_passes = 0
+
+        # Stanzas are handled by a pool of workers, in order for each sender. The lock is held by anything which
+        # changes the topology or jobs, read only queries run without it
+        self.lock = RLock()
+        workers, max_pending = Configuration().get_dispatch()
+        self.dispatcher = OrderedWorkerPool(workers, max_pending, Configuration().get_lane_weights())
 
         # Message scheduler
-        self.sched = MessageScheduler(self.message_handler)
+        self.sched = MessageScheduler(self.message_handler, action_lock=self.lock)
         
-        self.log = Logging(conn)
+        self.log = Logging(conn, *Configuration().get_logging())
         conn.join_muc('pollers')
         conn.join_muc('aggregators')
 
-        self.parser = Parser()
+        # Nodes advertising the compact encoding in their disco#info are sent it
+        self.peers = Peers()
+        if Configuration().get_compact_rpc():
+            self.parser = Parser(self.peers)
+        else:
+            self.parser = Parser()
         
         self.establish_jobs()
+
+        # Warm restart. The topology is saved to a snapshot as it changes, after a restart nodes in the snapshot
+        # are restored as they reconnect without being sent anything, and everything else waits for restore_window
+        self.snapshot_file, self.snapshot_interval, restore_window, snapshot_max_age = Configuration().get_snapshot()
+        self.last_snapshot = None
+        self.next_snapshot = time() + self.snapshot_interval
+        self.restoring = self.load_snapshot(snapshot_max_age)
+        self.restore_deadline = time() + restore_window
+        self.restored = 0
         
         self.conn = conn.get_conn()
 
@@ -64,51 +103,76 @@ class Controller:
     def message_handler(self, message, retry=False):
 #        print 'Sending message.'
         if retry == True:
-            self.log.error('Message timed out, resending.')
+            self.log.warning('Message timed out, resending.')
         self.conn.send(message)
 #
 #   MESSAGE HANDLERS
 #
-    """ Handler for presence stanzas recieved by the XMPP listener.
-    If 
-    """
+    """ Handler for presence stanzas recieved by the XMPP listener, handled by the dispatcher """
     def presence_handler(self, conn, presence_node):
+        self.dispatcher.add_task(str(presence_node.getFrom()), self.handle_presence, (presence_node,))
+        raise NodeProcessed
+
+    """ Looks up nodes joining the aggregator or poller MUCs, and removes nodes which leave """
+    def handle_presence(self, presence_node):
         sender = presence_node.getFrom()
         presence_type = presence_node.getAttr('type')
         # Ignore self and presence announcements from logging MUC
         if sender.getResource() != 'controller':
             if presence_type == 'unavailable':
                 if sender.getNode() == 'aggregators' or sender.getNode() == 'pollers':
-                    self.remove_entity(sender.getNode(), sender)
+                    self.lock.acquire()
+                    try:
+                        self.remove_entity(sender.getNode(), sender)
+                    finally:
+                        self.lock.release()
             elif sender.getNode() == 'aggregators' or sender.getNode() == 'pollers':
                 # Check the service discovery details for a connecting node.
                 self.disco_lookup(sender)
-        raise NodeProcessed
         
-    """ IQ set handler, runs RPC methods in whitelist """
+    """ IQ set handler, RPC calls are run by the dispatcher. Calls from Aggregators report failures so go in the
+    control lane, ahead of client queries """
     def set_handler(self, conn, iq_node):
+        if self.topology.is_aggregator(iq_node.getFrom()):
+            lane = CONTROL_LANE
+        else:
+            lane = RESULT_LANE
+        self.dispatcher.add_task(str(iq_node.getFrom()), self.run_calls, (conn, iq_node), lane)
+        raise NodeProcessed
+
+    """ Runs RPC methods in whitelist """
+    def run_calls(self, conn, iq_node):
         query_node = iq_node.getQueryChildren()
         for node in query_node:
             try:
-                method = node.getTagData('methodName')
+                method, args = self.parser.get_call(node, iq_node.getFrom())
                 method_whitelist = ['get_group', 'get_groups', 'create_group', 'update_group', 'remove_group',
                 'get_monitor', 'get_monitors', 'create_monitor', 'update_monitor', 'remove_monitor', 'get_monitors_by_gid',
                 'get_job', 'get_jobs', 'create_job', 'update_job', 'remove_job',
                 'get_evaluation', 'get_evaluations', 'create_evaluation', 'update_evaluation', 'remove_evaluation',
                 'get_results', 'get_results_day', 'get_results_week', 'get_results_hour',
-                'poller_failure',
+                'poller_failure', 'set_job_costs', 'get_rebalance_stats',
                 'get_aggregator']
                 if method in method_whitelist:
+                    # Queries only read the database, so one slow query doesn't hold up changes
+                    read_only = method.startswith('get_')
                     method = getattr(self, method)
                     try:
-                        try:
-                            params = node.getTag('params').getChildren()
-                            args = self.parser.get_args(params, iq_node.getFrom())
-                        except AttributeError:
-                            args = []
-                            
-                        status, parameters  = apply(method, args)
-                        message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters)
+                        if read_only:
+                            status, parameters  = apply(method, args)
+                        else:
+                            self.lock.acquire()
+                            try:
+                                status, parameters  = apply(method, args)
+                            finally:
+                                self.lock.release()
+                        # Query results can be large, they're sent behind control traffic
+                        if read_only:
+                            lane = RESULT_LANE
+                        else:
+                            lane = CONTROL_LANE
+                        message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters,
+                            self.parser.is_compact(node), lane)
                         self.conn.send(message)
                     except TypeError:
 #                        print sys.exc_info()
@@ -119,12 +183,15 @@ class Controller:
             except AttributeError:
                 traceback.print_exc()
                 conn.send(iq_node.buildReply('error'))
-        raise NodeProcessed
 
     def result_handler(self, conn, iq_node):
         # Check if the reponse is managed by scheduler
         if self.sched.is_managed(int(iq_node.getAttr('id'))):
-            self.sched.received_response(iq_node)
+            # Free the window slot here so held messages go out without waiting on the dispatcher,
+            # only the action is queued
+            pending = self.sched.release_response(iq_node)
+            if pending != None and pending.action != None:
+                self.dispatcher.add_task(str(iq_node.getFrom()), self.sched.run_action, (pending, iq_node))
         raise NodeProcessed
 #   END MESSAGE HANDLERS
 
@@ -137,6 +204,7 @@ class Controller:
             if entity_type == 'aggregator' or entity_type == 'poller':
                 adjusted_jid = JID(sender.getResource() + '@quae.co.uk/skynet')
                 category = query_node.getTagAttr('identity', 'category')
+                self.peers.add(adjusted_jid, query_node)
                 self.log.info('Registering node %s' % adjusted_jid)
                 self.add_entity(entity_type, category, adjusted_jid)
         else:
@@ -144,38 +212,55 @@ class Controller:
 
     def assign_job(self, sender, query_node):
         if query_node.getNamespace() == NS_RPC:
-            poller, job_id = self.parser.get_args_no_sender(query_node.getTag('methodResponse').getTag('params').getChildren())
+            poller, job_id = self.parser.get_response(query_node)
             poller_jid = JID(poller)
             job_id = int(job_id)
             job = None
-            for i in range(len(self.job_pool)):
-                if self.job_pool[i]['id'] == job_id:
-                    job = self.job_pool.pop(i)
-                    self.log.info('Removing job %s from the job pool' % job_id)
-                    break
+            cancelled = self.cancelled_placements.pop(job_id, None)
+            if cancelled != None and cancelled[0] == poller_jid:
+                # Removed while it was being placed, it's stopped now the Aggregator has it
+                self.log.debug('Stopping removed job %s on %s' % (job_id, poller_jid))
+                self.sched.add_message(self.parser.rpc_call(sender, 'remove_job', [job_id]))
+            # Only pooled jobs are assigned here, moved jobs are reassigned when the move is made
+            elif self.topology.get_job_poller(job_id) == None:
+                job = self.topology.assign_job(job_id, poller_jid)
             if job != None:
-                self.job_map[poller_jid].append(job)
-                self.log.info('Job %s successfully assigned to %s' % (job_id, poller_jid))
+                self.log.debug('Job %s successfully assigned to %s' % (job_id, poller_jid))
+            # Carry on draining the pool as responses free up the message window
+            if self.topology.pooled_job_count() > 0:
+                self.assign_pooled_jobs()
         else:
             self.log.error('Receieved iq message with incorrect namespace')
             
+    """ Response to get_jobs sent to a restored Poller. Jobs the snapshot had on the Poller which it isn't running
+    are pooled, jobs it's running which are pooled are assigned to it """
+    def verify_jobs(self, sender, query_node):
+        if query_node.getNamespace() == NS_RPC:
+            poller = JID(sender)
+            running = self.parser.get_response(query_node)[0]
+            running = set([int(job_id) for job_id in running])
+            for job in self.topology.get_poller_jobs(poller):
+                if job['id'] not in running:
+                    self.topology.pool_job(job)
+            for job_id in running:
+                if self.topology.is_job_pooled(job_id):
+                    self.topology.assign_job(job_id, poller)
+            if self.restoring == None and self.topology.pooled_job_count() > 0:
+                self.assign_pooled_jobs()
+        else:
+            self.log.error('Receieved iq message with incorrect namespace')
+
     def poller_removed(self, sender, query_node):
         if query_node.getNamespace() == NS_RPC:
-            args = self.parser.get_args_no_sender(query_node.getTag('methodResponse').getTag('params').getChildren())
+            args = self.parser.get_response(query_node)
             adjusted_jid = JID(args[0])
-            unassigned_jobs = self.job_map.pop(adjusted_jid)
+            parent_aggregator, unassigned_jobs = self.topology.remove_poller(adjusted_jid)
             for job in unassigned_jobs:
-                self.log.info('Adding job %s to the job pool' % job['id'])
-                self.job_pool.append(job)
-            parent_poller = None
-            for aggregator, pollers in self.poller_map.items():
-                for poller, segment in pollers:
-                    if poller == adjusted_jid:
-                        parent_aggregator = aggregator
-                        pollers.remove((poller, segment))
-                        break
+                self.log.debug('Adding job %s to the job pool' % job['id'])
             self.log.info('Removed %s from %s' % (adjusted_jid, parent_aggregator))
-            self.assign_pooled_jobs()            
+            # Jobs are placed again straight away, moving the remaining nodes waits for the next rebalance
+            self.assign_pooled_jobs()
+            self.request_rebalance()
         else:
             self.log.error('Receieved iq message with incorrect namespace')
 # END SCHEDULER HANDLERS
@@ -185,18 +270,31 @@ class Controller:
 #
 # Requested by an aggregator when an assigned poller has failed/disconnected.
     def poller_failure(self, sender, previous_poller):
-        pollers = self.poller_map[JID(sender)]
-        poller_jid = JID('pollers@conference.quae.co.uk/' + JID(previous_poller).getNode())
-        try:
-            pollers.remove(poller_jid)
+        poller_jid = JID(JID(previous_poller).getNode() + '@quae.co.uk/skynet')
+        if self.topology.get_poller_aggregator(poller_jid) == JID(sender):
+            self.topology.remove_poller(poller_jid)
             message = 'Removed failed poller'
             try:
-                self.rebalance_pollers()
+                self.assign_pooled_jobs()
+                self.request_rebalance()
             except:
                 print sys.exc_info()
             return 'success', [message]
-        except:
-            return 'failure', ['Failed to remove poller']
+        return 'failure', ['Failed to remove poller']
+
+# Reported periodically by each Poller, the average execution time in milliseconds of its jobs
+    def set_job_costs(self, sender, costs):
+        updated = 0
+        for job_id, exec_time in costs:
+            if self.topology.set_job_time(int(job_id), int(exec_time) / 1000.0):
+                updated += 1
+        return 'success', ['Updated costs of %s jobs' % updated]
+
+# Counts of rebalance requests, the passes made for them, and how many requests were handled by another's pass
+    def get_rebalance_stats(self, sender):
+        stats = {'requests':self.rebalance_requests, 'passes':self.rebalance_passes,
+        'coalesced':self.rebalance_requests - self.pending_requests - self.rebalance_passes}
+        return 'success', [stats]
 
 # Group operations
     def get_group(self, sender, name):
@@ -298,24 +396,27 @@ class Controller:
 
     def create_job(self, sender, mon, address, protocol, frequency, interface, resource):
         if self.db.get_monitor(mon) != None:
-            if self.db.create_job(address, protocol, frequency, interface, resource, mon) == True:
+            job_id = self.db.create_job(address, protocol, frequency, interface, resource, mon)
+            if job_id != False:
+                self.sync_job(job_id)
                 return 'success', ['Successfully created a job for %s' % mon]
         return 'failure', ['Failed to create job']
 
     def update_job(self, sender, mon, id, address, protocol, frequency, interface, resource):
         existing = self.db.get_job(id, mon)
-        if existing != None:
+        if existing != False:
             self.db.update_job(id, address, protocol, frequency, interface, resource)
+            self.sync_job(int(id))
             return 'success', ['Successfully updated job']
         else:
             return 'failure', ['failure']
             
     def remove_job(self, sender, mon, id):
-        self.db.remove_job(id)
-        if self.db.get_job(id) == None:
+        if self.db.remove_job(id, mon):
+            self.sync_job(int(id))
             return 'success', ['Successfully removed job']
         else:
-            return 'failure', ['failure']
+            return 'failure', ['No job %s in monitor %s' % (id, mon)]
         
     # Result read operations
     
@@ -337,7 +438,13 @@ class Controller:
         return 'failure', ['Failed to retreive specificied results']
         
     def get_results_week(self, sender, monitor, job, start_datetime):
-        pass
+        results = self.db.get_results_week(monitor, job, start_datetime)
+        if results == []:
+            return 'failure', ['No such results exist']
+        elif results != False:
+            job_details = self.db.get_job(job, monitor)
+            return 'success', [job_details, results]
+        return 'failure', ['Failed to retreive specificied results']
     
     def get_results_hour(self, sender, monitor, job, start_datetime):
         results = self.db.get_results_hour(monitor, job, start_datetime)
@@ -353,29 +460,23 @@ class Controller:
 #   BEGIN PRIVATE METHODS
 #
     """ Called on successful DISCO request.
-    Will register Poller or Aggregator, send jobs or balance jobs. """
+    Will register Poller or Aggregator, pollers and jobs are then assigned by the next rebalance. """
     def add_entity(self, entity_type, segment, entity):
         if entity_type == 'aggregator':
-            self.poller_map[entity] = []
-            # If pollers have been added, but there were no aggregators running
-            self.assign_pooled_pollers()
-            if len(self.poller_map) > 1:
-                self.rebalance_pollers()
-            self.assign_pooled_jobs()
+            self.topology.add_aggregator(entity)
+            if self.restoring != None:
+                # Take back the restored Pollers which were waiting on this Aggregator
+                for poller, (poller_segment, aggregator, job_ids) in self.restoring.items():
+                    poller = JID(poller)
+                    if aggregator == str(entity) and self.topology.is_poller(poller) and self.topology.get_poller_aggregator(poller) == None:
+                        self.topology.assign_poller(poller, entity)
+            self.request_rebalance()
                 
         elif entity_type == 'poller':
-            self.job_map[entity] = []
-            
-            self.poller_pool[entity] = segment
-            self.assign_pooled_pollers()
-            
-            if len(self.poller_map) > 1:
-                self.rebalance_pollers()
-            
-            self.assign_pooled_jobs()
-            
-            if len(self.job_map) > 1:
-                self.rebalance_jobs()
+            self.topology.add_poller(entity, segment)
+            if self.restoring != None and str(entity) in self.restoring:
+                self.restore_poller(entity)
+            self.request_rebalance()
             # Give poller to appropriate aggregator
             print 'Added %s to %ss' % (entity, entity_type)
         self.log.info('Node %s was successfully registered with the controller' % entity)
@@ -385,11 +486,10 @@ class Controller:
         try:
             if entity_type == 'aggregators':
                 adjusted_jid = JID(JID(entity).getResource() + '@quae.co.uk/skynet')
-                unassigned_pollers = self.poller_map.pop(adjusted_jid)
-                for poller, segment in unassigned_pollers:
-                    self.poller_pool[poller] = segment
+                unassigned_pollers = self.topology.remove_aggregator(adjusted_jid)
+                self.peers.remove(adjusted_jid)
                 self.log.info('Removed %s' % adjusted_jid)
-                if len(self.poller_pool) > 0:
+                if self.restoring == None and self.topology.pooled_poller_count() > 0:
                     # Try and assign pooled pollers
                     if not self.assign_pooled_pollers():
                         for poller, segment in unassigned_pollers:
@@ -398,196 +498,305 @@ class Controller:
                     
             elif entity_type == 'pollers':
                 adjusted_jid = JID(JID(entity).getResource() + '@quae.co.uk/skynet')
-                if len(self.poller_map) > 0:
-                    parent_aggregator = None
-                    for aggregator, pollers in self.poller_map.items():
-                        for poller, segment in pollers:
-                            if adjusted_jid == poller:
-                                parent_aggregator = aggregator
-                                break
-                    if parent_aggregator != None:
-                        remove_call = self.parser.rpc_call(parent_aggregator, 'remove_poller', [str(adjusted_jid)])
-                        self.sched.add_message(remove_call, self.poller_removed)
+                self.peers.remove(adjusted_jid)
+                parent_aggregator = self.topology.get_poller_aggregator(adjusted_jid)
+                if parent_aggregator != None:
+                    remove_call = self.parser.rpc_call(parent_aggregator, 'remove_poller', [str(adjusted_jid)])
+                    self.sched.add_message(remove_call, self.poller_removed)
+                elif self.topology.is_poller(adjusted_jid):
+                    self.topology.remove_poller(adjusted_jid)
+                    self.log.info('Poller not assigned, sucessfully removed')
+                    self.request_rebalance()
                 else:
-                    try:
-                        self.job_map.pop(adjusted_jid)
-                        self.poller_pool.pop(adjusted_jid)
-                        self.log.info('Poller not assigned, sucessfully removed')
-                    except:
-                        self.log.error('Failed to remove poller')
-                        traceback.print_exc()
+                    self.log.error('Failed to remove poller')
         except ValueError:
             self.log.error('Failed to remove %s' % entity)
 
-    """ Assign unassigned pollers """
+    """ Assign unassigned pollers, each Aggregator is sent the Pollers it gains and their jobs as one call each """
     def assign_pooled_pollers(self):
-        if len(self.poller_map) > 0:
-            while len(self.poller_pool) > 0:
-                unassigned_poller, segment = self.poller_pool.popitem()
+        if self.topology.aggregator_count() > 0:
+            added = {}
+            moved_jobs = {}
+            while self.topology.pooled_poller_count() > 0:
+                unassigned_poller, segment = self.topology.pop_pooled_poller()
                 chosen_aggregator = None
                 poller_comp = None
-                for aggregator, pollers in self.poller_map.items():
+                for aggregator in self.topology.get_aggregators():
+                    pollers = self.topology.get_aggregator_pollers(aggregator)
                     # If first loop or number of pollers assigned to aggregator is less than comp, make this agg the comp
                     if (chosen_aggregator == None and poller_comp == None) or len(pollers) < poller_comp:
                         chosen_aggregator = aggregator
                         poller_comp = len(pollers)
                 if chosen_aggregator != None:
                     # Assign Poller to the Aggregtor with least assigned Pollers
-                    
-                    message = self.parser.rpc_call(chosen_aggregator, 'add_poller', [str(unassigned_poller)])
-                    self.sched.add_message(message)
-                    
-                    for job in self.job_map[unassigned_poller]:
-                        message = self.parser.rpc_call(chosen_aggregator, 'move_job', [str(unassigned_poller), job['id'], job['address'], job['protocol'], job['frequency'], job['interface'], job['resource'], job['segment']])
-                        self.sched.add_message(message)
-                    self.poller_map[chosen_aggregator].append((unassigned_poller, segment))
+                    self.topology.assign_poller(unassigned_poller, chosen_aggregator)
+                    added.setdefault(chosen_aggregator, []).append(str(unassigned_poller))
+                    for job in self.topology.get_poller_jobs(unassigned_poller):
+                        moved_jobs.setdefault(chosen_aggregator, []).append(self.move_job_args(unassigned_poller, job))
+            self.send_pollers(added, moved_jobs)
             return True
         else:
             self.log.info('No aggregators available for poller assignment')
             return False
     
-    """ Get Pollers for a given network segment """
-    def get_segment_pollers(self, segment):
-        segment_pollers = {}
-        for aggregator, pollers in self.poller_map.items():
-            for poller, poller_segment in pollers:
-                if poller_segment == segment:
-                    segment_pollers[poller] = self.job_map[poller]
-        return segment_pollers
-        
-    """ Called to allocate unassigned jobs """
+    """ Called to allocate unassigned jobs, each is placed on the least loaded Poller in its segment.
+    Stops when the message window is full, and is called again as jobs are confirmed """
     def assign_pooled_jobs(self):
-        if len(self.job_map) > 0 and len(self.poller_map) > 0:
-            for job in self.job_pool:
-                unassigned_job = job
-                least_loaded = None
-                job_comp = None
-                pollers = self.get_segment_pollers(unassigned_job['segment'])
-                for poller, jobs in pollers.items():
-#                for poller, jobs in self.job_map.items():
-                    if (least_loaded == None and job_comp == None) or len(jobs) < job_comp:
-                        least_loaded = poller
-                        job_comp = len(jobs)
-                if least_loaded != None:
-                    chosen_aggregator = None
-                    for aggregator, pollers in self.poller_map.items():
-                        for poller, segment in pollers:
-                            if poller == least_loaded:
-                                chosen_aggregator = aggregator
-                                break
-                    if chosen_aggregator != None:
-                        self.send_job(unassigned_job, least_loaded, chosen_aggregator)
+        if self.restoring != None:
+            self.log.info('Waiting for nodes in the snapshot before assigning jobs')
+        elif self.topology.poller_count() > 0 and self.topology.aggregator_count() > 0:
+            # Jobs placed on a Poller which never confirmed them are placed again
+            expired = self.topology.expire_placements(self.sched.ttl)
+            if expired > 0:
+                self.log.error('%s jobs were not confirmed, returned to the pool' % expired)
+            cutoff = time() - self.sched.ttl
+            for job_id, (poller, removed) in list(self.cancelled_placements.items()):
+                if removed < cutoff:
+                    del self.cancelled_placements[job_id]
+            for segment in self.topology.get_segments():
+                unassigned_job = self.topology.next_pooled_job(segment)
+                while unassigned_job != None:
+                    least_loaded = self.topology.get_least_loaded(segment)
+                    self.topology.place_job(unassigned_job['id'], least_loaded)
+                    chosen_aggregator = self.topology.get_poller_aggregator(least_loaded)
+                    if not self.send_job(unassigned_job, least_loaded, chosen_aggregator):
+                        self.topology.pool_job(unassigned_job)
+                        return
+                    unassigned_job = self.topology.next_pooled_job(segment)
         else:
             self.log.info('No assigned pollers available for job assignment')
-        #print 'Job map %s' % self.job_map
-        #print 'Job pool %s' % self.job_pool
     
-    """ Rebalance pollers, compares amount assigned to each Aggregator, and moves across to
-    another Poller if there's at least 2 more than another Aggregator """
-    def rebalance_pollers(self):
-        self.log.info('Attempting to rebalance pollers')
-
-        poller_comp = None
-        least_pollers = None
-        most_pollers = None
-        # Retrieve aggregators with least and most pollers
-        
-        for aggregator, pollers in self.poller_map.items():
-            if poller_comp == None:
-                least_pollers = aggregator
-                most_pollers = aggregator
-            elif len(pollers) < poller_comp:
-                least_pollers = aggregator
-            elif len(pollers) > poller_comp:
-                most_pollers = aggregator
-            poller_comp = len(pollers)
-        
-        if least_pollers != None and most_pollers != None:
-            # If the difference between the two pollers is worth balancing
-            if (len(self.poller_map[most_pollers]) - len(self.poller_map[least_pollers])) > 1:
-                poller, segment = self.poller_map[most_pollers].pop()
-                self.poller_map[least_pollers].append((poller, segment))
-                self.sched.add_message(self.parser.rpc_call(least_pollers, 'add_poller', [str(poller)]))
-                self.sched.add_message(self.parser.rpc_call(most_pollers, 'remove_poller', [str(poller)]))
-                self.rebalance_pollers()
-            else:
-                self.log.info('Pollers balanced')
-                return True
-               
-    """ Similar to above, checks number of assigned jobs through the system, and will level them across all Pollers """ 
-    def rebalance_jobs(self):
-        self.log.info('Attempting to rebalance jobs')
-        job_comp = None
-        least_jobs = None
-        most_jobs = None
-        
-        network_segment = 'skynet'
-        pollers = self.get_segment_pollers(network_segment)
-        
-#        for poller, jobs in self.job_map.items():
-        for poller, jobs in pollers.items():
-            print poller
-            if job_comp == None:
-                least_jobs = poller
-                most_jobs = poller
-            elif len(jobs) < job_comp:
-                least_jobs = poller
-            elif len(jobs) > job_comp:
-                most_jobs = poller
-            job_comp = len(jobs)
-            
-        if least_jobs != None and most_jobs != None:
-            if (len(self.job_map[most_jobs]) - len(self.job_map[least_jobs])) > 1:
-                job = self.job_map[most_jobs].pop()
-                self.job_map[least_jobs].append(job)
-                least_parent = None
-                most_parent = None
-                for aggregator, pollers in self.poller_map.items():
-                    for poller, node_segment in pollers:
-                        if network_segment == node_segment:
-                            if poller == least_jobs:
-                                least_parent = aggregator
-                            if poller == most_jobs:
-                                most_parent = aggregator
-                            if least_parent != None and most_parent != None:
-                                break
-                    
-                if least_parent != None and most_parent != None:
-                    self.log.info('Moving job %s to %s' % (job['id'], least_jobs))
-                    self.sched.add_message(self.parser.rpc_call(most_parent, 'remove_job', [job['id']]))
-                    self.sched.add_message(self.parser.rpc_call(least_parent, 'run_job', [str(least_jobs), job['id'], job['address'], job['protocol'], job['frequency'], job['interface'], job['resource']]), offset=True)
-                self.rebalance_jobs()
-            else:
-                self.log.info('Jobs balanced')
-                return True
+    """ Request a rebalance, made once no further requests arrive for rebalance_delay seconds, but no later than
+    rebalance_max_delay seconds after the first request, so joining or leaving nodes are handled together """
+    def request_rebalance(self):
+        now = time()
+        self.rebalance_requests += 1
+        self.pending_requests += 1
+        if self.first_request == None:
+            self.first_request = now
+        self.rebalance_due = min(now + self.rebalance_delay, self.first_request + self.rebalance_max_delay)
+        # Nodes still to reconnect keep their pollers and jobs until the restore window ends
+        if self.restoring != None:
+            self.rebalance_due = max(self.rebalance_due, self.restore_deadline)
+
+    """ Assign pooled Pollers and rebalance them across all Aggregators, place pooled jobs, then rebalance jobs across
+    the Pollers of every segment. Each is planned in one pass and sent as a batch per Aggregator. At most move_budget
+    pollers and jobs are moved each move_interval, any further moves are made by a rebalance deferred until the
+    next interval """
+    def rebalance(self):
+        now = time()
+        if self.pending_requests > 0:
+            self.rebalance_passes += 1
+            self.log.info('Rebalancing for %s requests' % self.pending_requests)
+        self.pending_requests = 0
+        self.first_request = None
+        if now >= self.budget_reset:
+            self.moves_left = self.move_budget
+            self.budget_reset = now + self.move_interval
+
+        self.assign_pooled_pollers()
+
+        poller_moves = self.topology.plan_poller_moves(self.moves_left)
+        self.moves_left -= len(poller_moves)
+        self.move_pollers(poller_moves)
+
+        self.assign_pooled_jobs()
+
+        job_moves = self.topology.plan_job_moves(self.moves_left)
+        self.moves_left -= len(job_moves)
+        self.move_jobs(job_moves)
+
+        if self.moves_left <= 0:
+            self.log.info('Rebalancing budget used, continuing in %ss' % int(self.budget_reset - now))
+            self.rebalance_due = self.budget_reset
+        else:
+            self.log.info('Rebalanced, moved %s pollers and %s jobs' % (len(poller_moves), len(job_moves)))
+
+    """ Apply planned Poller moves. Each Aggregator is sent the Pollers it loses, then the Pollers it gains along
+    with their jobs, as one call each """
+    def move_pollers(self, moves):
+        removed = {}
+        added = {}
+        moved_jobs = {}
+        for poller, source, target in moves:
+            self.topology.assign_poller(poller, target)
+            removed.setdefault(source, []).append(str(poller))
+            added.setdefault(target, []).append(str(poller))
+            for job in self.topology.get_poller_jobs(poller):
+                moved_jobs.setdefault(target, []).append(self.move_job_args(poller, job))
+        for aggregator, pollers in removed.items():
+            self.sched.add_message(self.parser.rpc_call(aggregator, 'remove_pollers', [pollers]))
+        self.send_pollers(added, moved_jobs)
+
+    """ Send each Aggregator the Pollers it gains, then the jobs of those Pollers, from dictionaries keyed by Aggregator """
+    def send_pollers(self, added, moved_jobs):
+        for aggregator, pollers in added.items():
+            self.sched.add_message(self.parser.rpc_call(aggregator, 'add_pollers', [pollers]))
+            if aggregator in moved_jobs:
+                self.sched.add_message(self.parser.rpc_call(aggregator, 'move_jobs', [moved_jobs[aggregator]]))
+
+    """ Apply planned job moves. Each Aggregator is sent the jobs to stop, then the jobs to start, as one call each """
+    def move_jobs(self, moves):
+        removed = {}
+        added = {}
+        for job, source, target in moves:
+            self.topology.assign_job(job['id'], target)
+            removed.setdefault(self.topology.get_poller_aggregator(source), []).append(job['id'])
+            added.setdefault(self.topology.get_poller_aggregator(target), []).append([str(target), job['id'], job['address'], job['protocol'], job['frequency'], job['interface'], job['resource']])
+        for aggregator, job_ids in removed.items():
+            self.sched.add_message(self.parser.rpc_call(aggregator, 'remove_jobs', [job_ids]))
+        for aggregator, jobs in added.items():
+            self.sched.add_message(self.parser.rpc_call(aggregator, 'run_jobs', [jobs]), offset=True)
+
+    """ Arguments for an Aggregator's move_job, when it takes over a Poller's job """
+    def move_job_args(self, poller, job):
+        return [str(poller), job['id'], job['address'], job['protocol'], job['frequency'], job['interface'], job['resource'], job['segment']]
                 
     """ Retrieve jobs on startup """    
     def establish_jobs(self):
-        monitors = self.db.get_monitors()
         self.log.info('Retrieving jobs')
-        for monitor in monitors:
-            jobs = self.db.get_jobs(monitor.name)
+        for jobs in self.db.stream_jobs():
             for job in jobs:
-                job = dict(job)
-                segment_name = self.db.get_segment_name(job['segment'])
-                job['segment'] = segment_name
                 # Make the poll freq stored every minute minimum
                 job['frequency'] = job['frequency'] * 60
-                self.job_pool.append(job)
-        self.log.info('%s jobs added to the pool' % len(self.job_pool))
+                self.topology.pool_job(job)
+        self.log.info('%s jobs added to the pool' % self.topology.pooled_job_count())
         
-    """ Send job to Aggregator to forward to Poller """
+    """ Apply the database's definition of a job to the topology, after it's created, updated or removed.
+    Only that job is started, restarted on the same Poller, moved to another segment or stopped """
+    def sync_job(self, job_id):
+        job = self.db.get_job_details(job_id)
+        if job != None:
+            job['frequency'] = job['frequency'] * 60
+        current = self.topology.get_job(job_id)
+
+        if current == None:
+            if job != None:
+                self.log.debug('Adding job %s to the job pool' % job_id)
+                self.topology.pool_job(job)
+                self.assign_pooled_jobs()
+        elif job == None or job['segment'] != current['segment']:
+            placed = self.topology.is_job_placed(job_id)
+            poller = self.topology.remove_job(job_id)
+            if poller != None and placed:
+                # The Aggregator may not have the job yet, it's stopped once the placement is confirmed
+                self.cancelled_placements[job_id] = (poller, time())
+            elif poller != None:
+                aggregator = self.topology.get_poller_aggregator(poller)
+                if aggregator != None:
+                    self.log.debug('Stopping job %s on %s' % (job_id, poller))
+                    self.sched.add_message(self.parser.rpc_call(aggregator, 'remove_job', [job_id]))
+            if job != None:
+                self.topology.pool_job(job)
+                self.assign_pooled_jobs()
+        else:
+            changed = False
+            for key in ['address', 'protocol', 'frequency', 'interface', 'resource']:
+                if job.get(key) != current.get(key):
+                    changed = True
+            if changed:
+                poller = self.topology.replace_job(job)
+                if poller != None:
+                    # Pollers replace a running job with the same ID
+                    if not self.send_job(job, poller, self.topology.get_poller_aggregator(poller)):
+                        self.log.error('Failed to restart job %s on %s' % (job_id, poller))
+
+    """ Read the snapshot saved before a restart, returns the segment, Aggregator and jobs of each Poller keyed by
+    Poller, or None if there isn't a snapshot newer than max_age seconds """
+    def load_snapshot(self, max_age):
+        try:
+            if time() - os.path.getmtime(self.snapshot_file) > max_age:
+                self.log.info('Snapshot is too old to restore from')
+                return None
+            snapshot_file = open(self.snapshot_file)
+            try:
+                snapshot = json.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (OSError, IOError, ValueError):
+            return None
+        self.log.info('Restoring %s pollers from snapshot' % len(snapshot['pollers']))
+        return snapshot['pollers']
+
+    """ Write the topology to the snapshot if it has changed, otherwise mark the snapshot as current """
+    def save_snapshot(self):
+        snapshot = json.dumps(self.topology.snapshot())
+        try:
+            if snapshot != self.last_snapshot:
+                # Replace the previous snapshot in one step, so it's never left partly written
+                temp_file = self.snapshot_file + '.tmp'
+                snapshot_file = open(temp_file, 'w')
+                try:
+                    snapshot_file.write(snapshot)
+                finally:
+                    snapshot_file.close()
+                os.rename(temp_file, self.snapshot_file)
+                self.last_snapshot = snapshot
+            else:
+                os.utime(self.snapshot_file, None)
+        except (IOError, OSError) as e:
+            # Carry on without the snapshot, a restart is then a cold start
+            self.log.error('Failed to save snapshot to %s: %s' % (self.snapshot_file, e))
+
+    """ Restore a reconnected Poller's jobs from the snapshot, and its Aggregator if that has reconnected, without
+    sending either of them anything. The Poller is then asked which jobs it's running to correct the snapshot """
+    def restore_poller(self, poller):
+        segment, aggregator, job_ids = self.restoring[str(poller)]
+        for job_id in job_ids:
+            if self.topology.is_job_pooled(job_id):
+                self.topology.assign_job(job_id, poller)
+        if aggregator != None and self.topology.is_aggregator(JID(aggregator)):
+            self.topology.assign_poller(poller, JID(aggregator))
+        self.restored += 1
+        self.sched.add_message(self.parser.rpc_call(poller, 'get_jobs', []), self.verify_jobs)
+
+    """ Called once the restore window ends, Pollers and jobs which weren't restored are assigned by a rebalance """
+    def end_restore(self):
+        self.log.info('Restored %s of %s pollers from snapshot' % (self.restored, len(self.restoring)))
+        self.restoring = None
+        self.request_rebalance()
+
+    """ Send job to Aggregator to forward to Poller, returns False if the message window is full """
     def send_job(self, job, poller, aggregator):
         message = self.parser.rpc_call(aggregator, 'run_job', [str(poller), job['id'], job['address'], job['protocol'], job['frequency'], job['interface'], job['resource']])
-        self.log.info('Sending job %s to %s' % (job['id'], aggregator))
-        self.sched.add_message(message, self.assign_job, offset=True)
+        if self.sched.add_message(message, self.assign_job, offset=True, hold=False):
+            self.log.debug('Sending job %s to %s' % (job['id'], aggregator))
+            return True
+        return False
         
     def step_on(self):
         try:
             self.conn.Process(1)
-        except KeyboardInterrupt: return 0
+            # The receive loop never waits on the lock, if a worker holds it this is tried again next time round
+            if self.lock.acquire(False):
+                try:
+                    self.run_due()
+                finally:
+                    self.lock.release()
+        except KeyboardInterrupt:
+            self.dispatcher.end()
+            self.lock.acquire()
+            if self.restoring == None:
+                self.save_snapshot()
+            self.lock.release()
+            self.maintenance.end()
+            self.log.end()
+            return 0
         return 1
 
+    """ Ends the restore window, rebalances and saves the snapshot when they're due """
+    def run_due(self):
+        now = time()
+        if self.restoring != None and now >= self.restore_deadline:
+            self.end_restore()
+        if self.rebalance_due != None and now >= self.rebalance_due:
+            self.rebalance_due = None
+            self.rebalance()
+        # The topology is only partly known while restoring, so the previous snapshot is kept
+        if self.restoring == None and now >= self.next_snapshot:
+            self.next_snapshot = now + self.snapshot_interval
+            self.save_snapshot()
+
     def go_on(self):
         while self.step_on(): pass
 
@@ -1,6 +1,203 @@
 from sqlalchemy import *
 from utils import Configuration
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
+from threading import Thread, Lock, Event
+from time import time
+import traceback
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+# Rollup tables holding per job aggregates of results, coarsest first, with their period in seconds
+rollups = [('results_day', 86400), ('results_hour', 3600), ('results_minute', 60)]
+
+rollup_upsert = '''INSERT INTO %s (job, period, `count`, value_count, float_count, `sum`, `min`, `max`)
+VALUES (:job, :period, :count, :value_count, :float_count, :sum, :min, :max)
+ON DUPLICATE KEY UPDATE `count` = `count` + VALUES(`count`), value_count = value_count + VALUES(value_count),
+float_count = float_count + VALUES(float_count), `sum` = `sum` + VALUES(`sum`),
+`min` = LEAST(COALESCE(`min`, VALUES(`min`)), COALESCE(VALUES(`min`), `min`)),
+`max` = GREATEST(COALESCE(`max`, VALUES(`max`)), COALESCE(VALUES(`max`), `max`))'''
+
+""" Truncate a datetime to the start of its rollup period """
+def truncate_datetime(recorded, width):
+    recorded = recorded.replace(second=0, microsecond=0)
+    if width >= 3600:
+        recorded = recorded.replace(minute=0)
+    if width >= 86400:
+        recorded = recorded.replace(hour=0)
+    return recorded
+
+""" Query for jobs of existing monitors joined with their segment's name, labelled segment_name """
+def jobs_query(jobs, monitors, segments):
+    return select([jobs, segments.c.name.label('segment_name')],
+        from_obj=[jobs.join(monitors, jobs.c.monitor == monitors.c.id).outerjoin(segments, jobs.c.segment == segments.c.id)])
+
+""" Convert a row of jobs_query to a job dictionary, with the segment's name in place of the segment id """
+def job_from_row(row):
+    job = dict(row)
+    job['segment'] = job.pop('segment_name')
+    return job
+
+""" Generator over every job of an existing monitor in chunks of chunk_size dictionaries, with its segment's name
+in place of the segment id. Jobs, monitors and segments are joined in a single query and rows are streamed
+rather than fetched at once """
+def stream_jobs(jobs, monitors, segments, chunk_size=1000):
+    rows = jobs_query(jobs, monitors, segments).order_by(jobs.c.id).execution_options(stream_results=True).execute()
+    try:
+        while True:
+            chunk = rows.fetchmany(chunk_size)
+            if len(chunk) == 0:
+                break
+            yield [job_from_row(row) for row in chunk]
+    finally:
+        rows.close()
+
+class ResultWriter(Thread):
+    """ Background writer for the results table.
+    Rows are queued and inserted together with a single executemany once size rows are waiting or the oldest has
+    waited interval seconds. At most max_queued rows are held, add blocks when the queue is full.
+    Each batch is also added to the rollup tables, given as a list of table and period width pairs.
+    Failed writes are passed to error_handler as a message, if given, and the rows counted as dropped. """
+    columns = ['job', 'recorded', 'int', 'string', 'float', 'list']
+
+    def __init__(self, table, size=500, interval=1.0, max_queued=10000, rollup_tables=[], error_handler=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.table = table
+        self.rollup_tables = rollup_tables
+        self.error_handler = error_handler
+        self.size = size
+        self.interval = interval
+        self.rows = Queue(max_queued)
+        self.written = 0
+        self.dropped = 0
+        self.start()
+
+    """ Queue a row, values are keyed by column name """
+    def add(self, **values):
+        row = dict.fromkeys(self.columns)
+        row.update(values)
+        self.rows.put(row)
+
+    """ Flush any queued rows and stop the writer, waiting for it to finish """
+    def end(self):
+        self.rows.put(None)
+        self.join()
+
+    """ Insert a batch of rows in one statement, then update the rollups """
+    def flush(self, batch):
+        try:
+            self.table.insert().execute(batch)
+            self.written += len(batch)
+        except Exception as e:
+            traceback.print_exc()
+            self.dropped += len(batch)
+            self.report('Failed to write %s results, %s dropped in total: %s' % (len(batch), self.dropped, e))
+            return
+        for table, width in self.rollup_tables:
+            try:
+                self.table.bind.execute(text(rollup_upsert % table.name), self.rollup_rows(batch, width))
+            except Exception as e:
+                traceback.print_exc()
+                self.report('Failed to update %s with %s results: %s' % (table.name, len(batch), e))
+
+    def report(self, message):
+        if self.error_handler != None:
+            try:
+                self.error_handler(message)
+            except:
+                traceback.print_exc()
+
+    """ Aggregate a batch of rows into one rollup row per job and period """
+    def rollup_rows(self, batch, width):
+        periods = {}
+        for row in batch:
+            key = (row['job'], truncate_datetime(row['recorded'], width))
+            period = periods.get(key)
+            if period == None:
+                period = periods[key] = {'job':key[0], 'period':key[1], 'count':0, 'value_count':0, 'float_count':0,
+                    'sum':0.0, 'min':None, 'max':None}
+            period['count'] += 1
+            if row['float'] != None:
+                val = row['float']
+                period['float_count'] += 1
+            elif row['int'] != None:
+                val = row['int']
+            else:
+                continue
+            period['value_count'] += 1
+            period['sum'] += val
+            if period['min'] == None or val < period['min']:
+                period['min'] = val
+            if period['max'] == None or val > period['max']:
+                period['max'] = val
+        return list(periods.values())
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            if deadline != None:
+                timeout = max(deadline - time(), 0)
+            else:
+                timeout = None
+            try:
+                row = self.rows.get(True, timeout)
+            except Empty:
+                row = False
+            if row == None:
+                break
+            if row != False:
+                if len(batch) == 0:
+                    deadline = time() + self.interval
+                batch.append(row)
+            if len(batch) >= self.size or (len(batch) > 0 and time() >= deadline):
+                self.flush(batch)
+                batch = []
+                deadline = None
+        if len(batch) > 0:
+            self.flush(batch)
+
+""" MySQL TO_DAYS() of a date, used as the bound of daily partitions """
+def to_days(day):
+    return day.toordinal() + 365
+
+class ResultMaintenance(Thread):
+    """ Background maintenance of the results table, run periodically by the Controller.
+    Keeps daily partitions ahead of the current day, then expires results past their retention. """
+    def __init__(self, db, interval=3600, partition=False, days_ahead=7):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.db = db
+        self.interval = interval
+        self.partition = partition
+        self.days_ahead = days_ahead
+        self.stop = Event()
+        config = Configuration()
+        self.days, self.monitor_days, self.group_days = config.get_retention()
+
+    """ Stop after the current run """
+    def end(self):
+        self.stop.set()
+
+    """ Run maintenance once """
+    def maintain(self):
+        partitioned = self.db.is_partitioned('results')
+        if not partitioned and self.partition:
+            self.db.partition_results()
+            partitioned = True
+        if partitioned:
+            self.db.add_partitions(date.today() + timedelta(days=self.days_ahead))
+        self.db.expire_results(self.days, self.monitor_days, self.group_days, partitioned)
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                self.maintain()
+            except:
+                traceback.print_exc()
+            self.stop.wait(self.interval)
 
 class Database:
     """ Connection to the model """
@@ -10,10 +207,53 @@ class Database:
         # Connect with the provided credentials, recycle every hour to stop idle timeout
         self.db = create_engine('mysql://' + username + ':' + password + '@' + server + '/' + database, pool_recycle=3600)
         self.metadata = MetaData(self.db)
+        # Tables are reflected the first time they're used, then reused
+        self.tables = {}
+        self.tables_lock = Lock()
         
     """ Return the selected table from the database """
     def get_table(self, table):
-        return Table(table, self.metadata, autoload=True)
+        try:
+            return self.tables[table]
+        except KeyError:
+            pass
+        self.tables_lock.acquire()
+        try:
+            if table not in self.tables:
+                self.tables[table] = Table(table, self.metadata, autoload=True)
+            return self.tables[table]
+        finally:
+            self.tables_lock.release()
+
+    """ Return the rollup tables and their period widths, coarsest first. Tables are created if they don't exist """
+    def get_rollup_tables(self):
+        self.tables_lock.acquire()
+        try:
+            rollup_tables = []
+            for name, width in rollups:
+                if name not in self.tables:
+                    table = Table(name, self.metadata,
+                        Column('job', Integer, primary_key=True, autoincrement=False),
+                        Column('period', DateTime, primary_key=True),
+                        Column('count', Integer, nullable=False),
+                        Column('value_count', Integer, nullable=False),
+                        Column('float_count', Integer, nullable=False),
+                        Column('sum', Float(precision=53), nullable=False),
+                        Column('min', Float(precision=53)),
+                        Column('max', Float(precision=53)))
+                    table.create(checkfirst=True)
+                    self.tables[name] = table
+                rollup_tables.append((self.tables[name], width))
+            return rollup_tables
+        finally:
+            self.tables_lock.release()
+
+    """ Discard reflected tables so they're reflected again on next use, called after the schema changes """
+    def refresh_tables(self):
+        self.tables_lock.acquire()
+        self.metadata.clear()
+        self.tables = {}
+        self.tables_lock.release()
 
 # Group operations
     """ Return a group of specific name """
@@ -121,13 +361,25 @@ class Database:
         job_list = jobs.select(jobs.c.monitor == monitor.id).execute().fetchall()
         return job_list
         
-    """ Create a job with provided details """
+    """ Return every job in chunks, see stream_jobs """
+    def stream_jobs(self, chunk_size=1000):
+        return stream_jobs(self.get_table('jobs'), self.get_table('monitors'), self.get_table('segments'), chunk_size)
+
+    """ Return a job by ID in the form given by stream_jobs, or None if it doesn't exist """
+    def get_job_details(self, id):
+        jobs = self.get_table('jobs')
+        row = jobs_query(jobs, self.get_table('monitors'), self.get_table('segments')).where(jobs.c.id == id).execute().fetchone()
+        if row != None:
+            return job_from_row(row)
+        return None
+
+    """ Create a job with provided details, returns the new job's ID """
     def create_job(self, address, protocol, frequency, domain, interface, mon):
         monitor = self.get_monitor(mon)
         if monitor != False:
             jobs = self.get_table('jobs')
-            jobs.insert().execute(address=address, protocol=protocol, frequency=frequency, domain=domain, interface=interface, monitor=monitor.id)
-            return True
+            result = jobs.insert().execute(address=address, protocol=protocol, frequency=frequency, domain=domain, interface=interface, monitor=monitor.id)
+            return result.inserted_primary_key[0]
         return False
       
     """ Update a job by ID """ 
@@ -135,9 +387,24 @@ class Database:
         jobs = self.get_table('jobs')
         jobs.update(jobs.c.id == id).execute({'address':address, 'protocol':protocol, 'frequency':frequency, 'domain':domain, 'resource':resource})
 
-    """ Remove a job of id """
-    def remove_job(self, mon_name, id):
-        pass
+    """ Remove a job of a monitor by ID, with its evaluations and results. Returns False if the monitor has no
+    such job """
+    def remove_job(self, id, monitor):
+        jobs = self.get_table('jobs')
+        monitor = self.get_monitor(monitor)
+        if monitor == False:
+            return False
+        job = jobs.select(and_(jobs.c.monitor == monitor.id, jobs.c.id == id)).execute().fetchone()
+        if job == None:
+            return False
+        evaluations = self.get_table('evaluations')
+        evaluations.delete(evaluations.c.job == id).execute()
+        results = self.get_table('results')
+        results.delete(results.c.job == id).execute()
+        for table, width in self.get_rollup_tables():
+            table.delete(table.c.job == id).execute()
+        jobs.delete(jobs.c.id == id).execute()
+        return True
 
 # Evaluation operations
     """ Return all evaluations for a specific job id """
@@ -174,74 +441,160 @@ class Database:
                 return None
         return False
         
-    """ Return results for a day for a specified job starting at a provided timestamp """
-    def get_results_day(self, monitor, job_id, start_datetime):
+    """ Return aggregated results for a job between two datetimes, grouped into buckets of bucket_width seconds
+    with a single query. Each bucket has its start time, the number of results, and the minimum, maximum and
+    average numeric value. Values are ints unless the bucket contains floats, buckets without results are omitted.
+    Reads the coarsest rollup table whose periods fit exactly into the buckets and range, else the raw results.
+    Rollups only hold results from when they were created, and their first period for a job may be partial, so
+    they're only read for ranges starting after it """
+    def get_results_bucketed(self, monitor, job_id, start_datetime, end_datetime, bucket_width):
         job = self.get_job(job_id, monitor)
-        start_datetime = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S").replace(hour=0)
-        if job != False:
-            results = []
-            results_table = self.get_table('results')
-            for i in range(0,23):
-                loop_datetime = start_datetime + timedelta(hours=i)
-                end_datetime = loop_datetime + timedelta(hours=1)
-                #s = select([results_table.c.recorded, results_table.c.string], [func.avg(results_table.c.int), func.avg(results_table.c.float)], and_(results_table.c.job == job_id, results_table.c.recorded > start_datetime, results_table.c.recorded < end_datetime))
-                s = select([results_table.c.recorded, func.avg(results_table.c.int), func.avg(results_table.c.float), func.avg(results_table.c.string)], and_(results_table.c.job == job_id, results_table.c.recorded > loop_datetime, results_table.c.recorded < end_datetime), group_by=results_table.c.job)
-                result = s.execute().fetchone()
-                results.append(result)
-                print result
-            if len(results) > 0:
-                agg_results = []
-                # Using indexes as counter as ints and string are immutable
-                for i in range(0, len(results)):
-                    result = results[i]
-                    if result != None:
-                        recorded, int_val, float_val, str_val = result
-                        if int_val != None:
-                            result_val = int(int_val)
-                        elif float_val != None:
-                            result_val = float(float_val)
-                        elif str_val != None:
-                            result_val = str(str_val)
-                        agg_results.append({'recorded':recorded, 'result':result_val})
-                return agg_results
+        if job == False:
+            return False
+        for table, width in self.get_rollup_tables():
+            if bucket_width % width == 0 and truncate_datetime(start_datetime, width) == start_datetime \
+                    and truncate_datetime(end_datetime, width) == end_datetime:
+                earliest = select([func.min(table.c.period)], table.c.job == job_id).execute().scalar()
+                if earliest == None or start_datetime <= earliest:
+                    continue
+                elapsed = func.unix_timestamp(table.c.period) - func.unix_timestamp(start_datetime)
+                bucket = func.floor(elapsed / bucket_width).label('bucket')
+                where = and_(table.c.job == job_id, table.c.period >= start_datetime, table.c.period < end_datetime)
+                s = select([bucket, func.sum(table.c.count), func.sum(table.c.float_count), func.min(table.c.min),
+                    func.max(table.c.max), func.sum(table.c.sum) / func.sum(table.c.value_count)], where,
+                    group_by=[bucket], order_by=[bucket])
+                return self.get_buckets(s, start_datetime, bucket_width)
+
+        results_table = self.get_table('results')
+        value = func.coalesce(results_table.c.int, results_table.c.float)
+        elapsed = func.unix_timestamp(results_table.c.recorded) - func.unix_timestamp(start_datetime)
+        bucket = func.floor(elapsed / bucket_width).label('bucket')
+        # List parents hold no value, their elements are counted instead
+        where = and_(results_table.c.job == job_id, results_table.c.recorded >= start_datetime,
+            results_table.c.recorded < end_datetime, or_(results_table.c.list == None, results_table.c.list != 0))
+        s = select([bucket, func.count(results_table.c.id), func.count(results_table.c.float),
+            func.min(value), func.max(value), func.avg(value)], where, group_by=[bucket], order_by=[bucket])
+        return self.get_buckets(s, start_datetime, bucket_width)
+
+    """ Execute a bucketed query, returning a dictionary for each bucket """
+    def get_buckets(self, s, start_datetime, bucket_width):
+        buckets = []
+        for index, count, float_count, min_val, max_val, avg_val in s.execute().fetchall():
+            if float_count > 0:
+                convert = float
             else:
-                return None
-        return False
+                convert = int
+            bucket_values = {'recorded':start_datetime + timedelta(seconds=int(index) * bucket_width), 'count':int(count)}
+            for name, val in [('min', min_val), ('max', max_val), ('avg', avg_val)]:
+                if val != None:
+                    val = convert(val)
+                bucket_values[name] = val
+            # Kept for existing consumers of the hour and day results
+            bucket_values['result'] = bucket_values['avg']
+            buckets.append(bucket_values)
+        return buckets
+
+    """ Return results for a day for a specified job starting at a provided timestamp, in hourly buckets """
+    def get_results_day(self, monitor, job_id, start_datetime):
+        start_datetime = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S").replace(hour=0, minute=0, second=0)
+        return self.get_results_bucketed(monitor, job_id, start_datetime, start_datetime + timedelta(days=1), 3600)
         
-    """ Return results for an hour for a specified job starting at a provided timestamp """
+    """ Return results for an hour for a specified job starting at a provided timestamp, in five minute buckets """
     def get_results_hour(self, monitor, job_id, start_datetime):
-        job = self.get_job(job_id, monitor)
-        start_datetime = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S")
-        if job != False:
-            results = []
-            results_table = self.get_table('results')
-            for i in range(0,55,5):
-                start_datetime = start_datetime.replace(minute=i)
-                end_datetime = start_datetime.replace(minute=start_datetime.minute+5)
-                #s = select([results_table.c.recorded, results_table.c.string], [func.avg(results_table.c.int), func.avg(results_table.c.float)], and_(results_table.c.job == job_id, results_table.c.recorded > start_datetime, results_table.c.recorded < end_datetime))
-                s = select([results_table.c.recorded, func.avg(results_table.c.int), func.avg(results_table.c.float), func.avg(results_table.c.string)], and_(results_table.c.job == job_id, results_table.c.recorded > start_datetime, results_table.c.recorded < end_datetime), group_by=results_table.c.job)
-                result = s.execute().fetchone()
-                results.append(result)
-                print result
-            if len(results) > 0:
-                agg_results = []
-                # Using indexes as counter as ints and string are immutable
-                for i in range(0, len(results)):
-                    result = results[i]
-                    if result != None:
-                        recorded, int_val, float_val, str_val = result
-                        if int_val != None:
-                            result_val = int(int_val)
-                        elif float_val != None:
-                            result_val = float(float_val)
-                        elif str_val != None:
-                            result_val = str(str_val)
-                        agg_results.append({'recorded':recorded, 'result':result_val})
-                return agg_results
-            else:
-                return None
-        return False
+        start_datetime = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S").replace(minute=0, second=0)
+        return self.get_results_bucketed(monitor, job_id, start_datetime, start_datetime + timedelta(hours=1), 300)
+
+    """ Return results for a week for a specified job starting at a provided timestamp, in six hour buckets """
+    def get_results_week(self, monitor, job_id, start_datetime):
+        start_datetime = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S").replace(hour=0, minute=0, second=0)
+        return self.get_results_bucketed(monitor, job_id, start_datetime, start_datetime + timedelta(weeks=1), 21600)
         
+# Retention operations
+    """ Return whether a table is partitioned """
+    def is_partitioned(self, table):
+        s = text('''SELECT COUNT(*) FROM information_schema.partitions WHERE table_schema = DATABASE()
+            AND table_name = :table AND partition_name IS NOT NULL''')
+        return self.db.execute(s, table=table).scalar() > 0
+
+    """ Return the name and TO_DAYS upper bound of each daily partition of the results table, oldest first.
+    The catch-all partition for future results is omitted """
+    def get_partitions(self):
+        s = text('''SELECT partition_name, partition_description FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = 'results' AND partition_name IS NOT NULL
+            ORDER BY partition_ordinal_position''')
+        partitions = []
+        for name, bound in self.db.execute(s).fetchall():
+            if bound != 'MAXVALUE':
+                partitions.append((name, int(bound)))
+        return partitions
+
+    """ Convert the results table to range partitions by day, starting with a single catch-all partition.
+    MySQL requires the partitioning column in every unique key, so recorded is added to the primary key.
+    This rewrites the whole table, so is only done when enabled in the config """
+    def partition_results(self):
+        self.db.execute('''ALTER TABLE results DROP PRIMARY KEY, ADD PRIMARY KEY (id, recorded)
+            PARTITION BY RANGE (TO_DAYS(recorded)) (PARTITION p_future VALUES LESS THAN MAXVALUE)''')
+        self.refresh_tables()
+
+    """ Split daily partitions from the catch-all partition up to and including the given day """
+    def add_partitions(self, until):
+        partitions = self.get_partitions()
+        if len(partitions) > 0:
+            day = date.fromordinal(partitions[-1][1] - 365)
+        else:
+            day = date.today()
+        new_partitions = []
+        while day <= until:
+            new_partitions.append('PARTITION p%s VALUES LESS THAN (%s)' % (day.strftime('%Y%m%d'), to_days(day + timedelta(days=1))))
+            day += timedelta(days=1)
+        if len(new_partitions) > 0:
+            new_partitions.append('PARTITION p_future VALUES LESS THAN MAXVALUE')
+            self.db.execute('ALTER TABLE results REORGANIZE PARTITION p_future INTO (%s)' % ', '.join(new_partitions))
+
+    """ Drop the daily partitions holding only results recorded before a day, returning their names """
+    def drop_partitions(self, before):
+        expired = [name for name, bound in self.get_partitions() if bound <= to_days(before)]
+        if len(expired) > 0:
+            self.db.execute('ALTER TABLE results DROP PARTITION %s' % ', '.join(expired))
+        return expired
+
+    """ Return the retention in days for each job, from its monitor, else its group, else the default.
+    Overrides are keyed by lowercase name, as option names are lowercased by ConfigParser """
+    def get_job_retention(self, days, monitor_days, group_days):
+        jobs = self.get_table('jobs')
+        monitors = self.get_table('monitors')
+        groups = self.get_table('groups')
+        s = select([jobs.c.id, monitors.c.name, groups.c.name],
+            from_obj=[jobs.join(monitors, jobs.c.monitor == monitors.c.id).outerjoin(groups, monitors.c.group == groups.c.id)],
+            use_labels=True)
+        job_days = {}
+        for job_id, monitor_name, group_name in s.execute().fetchall():
+            if group_name != None:
+                group_name = group_name.lower()
+            job_days[job_id] = monitor_days.get(monitor_name.lower(), group_days.get(group_name, days))
+        return job_days
+
+    """ Remove raw results past their retention. When partitioned, whole partitions older than the longest
+    retention are dropped and only jobs with a shorter retention are deleted from, otherwise results are deleted """
+    def expire_results(self, days, monitor_days, group_days, partitioned=False):
+        if days == None and len(monitor_days) == 0 and len(group_days) == 0:
+            return
+        job_days = self.get_job_retention(days, monitor_days, group_days)
+        retentions = [job_retention for job_retention in job_days.values() if job_retention != None]
+        longest = None
+        if partitioned and len(retentions) == len(job_days) and len(retentions) > 0:
+            longest = max(retentions)
+            self.drop_partitions(date.today() - timedelta(days=longest))
+
+        retention_jobs = {}
+        for job_id, job_retention in job_days.items():
+            if job_retention != None and job_retention != longest:
+                retention_jobs.setdefault(job_retention, []).append(job_id)
+        results = self.get_table('results')
+        for job_retention, job_ids in retention_jobs.items():
+            cutoff = datetime.combine(date.today() - timedelta(days=job_retention), datetime.min.time())
+            results.delete(and_(results.c.job.in_(job_ids), results.c.recorded < cutoff)).execute()
+
 # Segement operations
     """ Return all network segments """
     def get_segments(self):
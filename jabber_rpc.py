@@ -1,201 +1,392 @@
 from xmpp import *
-import sys, random, time, base64, urllib2, smtplib
+import sys, random, time, base64, urllib2, smtplib, struct
 from email.mime.text import MIMEText
 from ConfigParser import ConfigParser
 from threading import Timer, Semaphore
 from datetime import datetime
+from xmlrpclib import Binary
 
-class Parser:
-    """ Parser object """
+# Disco feature of nodes which accept the compact encoding in place of XML-RPC
+NS_COMPACT_RPC = 'http://quae.co.uk/protocol/compact-rpc'
+
+# Stanzas are sent and handled in two lanes, so control traffic isn't queued behind results. A stanza's lane is
+# kept in its lane attribute, stanzas without one are control
+CONTROL_LANE = 'control'
+RESULT_LANE = 'results'
+result_methods = set(['add_result', 'add_results', 'set_job_costs'])
+
+""" Returns the lane of a stanza """
+def get_lane(stanza):
+    return getattr(stanza, 'lane', CONTROL_LANE)
+
+int_struct = struct.Struct('>q')
+float_struct = struct.Struct('>d')
+length_struct = struct.Struct('>I')
+datetime_struct = struct.Struct('>HBBBBBI')
+
+class RawXML:
+    """ Serialized XML, appended to a Node's children it's written out as is when the stanza is sent """
+    def __init__(self, xml):
+        self.xml = xml
+
+    def __str__(self):
+        return self.xml
+
+""" Escapes text for XML character data """
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+""" Parses an XML-RPC dateTime, as written by datetime.isoformat or in the compact XML-RPC form.
+Sliced rather than using strptime, which is several times slower """
+def parse_datetime(value):
+    value = value.strip()
+    if len(value) == 17 and value[8] == 'T':
+        value = '%s-%s-%s%s' % (value[0:4], value[4:6], value[6:8], value[8:])
+    if len(value) < 19 or value[4] != '-' or value[10] != 'T':
+        raise ValueError('Invalid dateTime %s' % value)
+    microsecond = 0
+    if len(value) > 20 and value[19] == '.':
+        microsecond = int(value[20:].ljust(6, '0'))
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]),
+        int(value[17:19]), microsecond)
+
+class Peers:
+    """ Features other nodes advertise in their disco#info, keyed by JID """
     def __init__(self):
-        self.temp_list = []
-        
-    def type_to_rpc(self, py_type):
-        rpc_type = None
-                
-        if py_type == 'str' or py_type == 'unicode':
-            rpc_type = 'string'
-        if py_type == 'long' or py_type == 'int':
-            rpc_type = 'int'
-        if py_type == 'datetime':
-            rpc_type = 'dateTime.iso8601'
-            
-        return rpc_type
-        
-    """ Converts XML-RPC values to python type """
-    def rpc_to_type(self, rpc_type, value):
-        py_val = None
-        
-        if rpc_type == 'string':
-            py_val = str(value)
-        elif rpc_type == 'int':
-            py_val = int(value)
-        elif rpc_type == 'dateTime.iso8601':
-            py_val = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-        return py_val
-
-    """ Returns Python data-type/struct from XML """
-    def get_values(self, parent, param):
-        if param.getName() == 'member' and param.getTag('name') != None:
-            name = str(param.getTag('name').getData())
-            param.delChild('name')
-            self.get_values((parent, name), param)
-
-            
-        else:
-            values = param.getChildren()
-            
-            for value in values:
-                value_types = value.getChildren()
-                for value_type in value_types:
-                    
-                    if value_type.getName() == 'array':
-                        array_list = []
-                        parent_type = type(parent).__name__
-                        if parent_type == 'list':
-                            parent.append(array_list)
-                        else:
-                            parent.update(array_list)
-                            
-                        for data_node in value_type.getChildren():
-                            self.get_values(array_list, data_node)
-                    elif value_type.getName() == 'struct':
-                        struct_dict = {}
-                        parent_type = type(parent).__name__
-                        if parent_type == 'list':
-                            parent.append(struct_dict)
-                        else:
-                            parent.update(struct_dict)
-                        for member in value_type.getChildren():
-                            self.get_values(struct_dict, member)
-#                    elif value_type.getName() == 'nil':
-#                        print value_type.getData()
-#                        parent_type = type(parent).__name__
-#                        if parent_type == 'tuple':
-#                            parent, name =
-                    else:
-                        converted = self.rpc_to_type(value_type.getName(), value_type.getData())
-                        parent_type = type(parent).__name__
-#                        if parent_type == 'NoneType':
-                        if parent_type == 'tuple':
-                            parent, name = parent
-                            parent[name] = converted
-                        elif parent_type == 'list':
-                            parent.append(converted)
-            
-    """ Encodes from Python type to XML-RPC """
-    def create_args(self, parent_node, param):
-
-        if type(param).__name__ == 'RowProxy':
-            param = dict(param.items())
-
-        param_type = type(param).__name__
-    
-        if param_type == 'list':
-            val_node = parent_node.addChild('value')
-            type_node = val_node.addChild('array')
-            data_node = type_node.addChild('data')
-            for element in param:
-                self.create_args(data_node, element)
-        elif param_type == 'dict':
-            val_node = parent_node.addChild('value')
-            type_node = val_node.addChild('struct')
-            for element in param.items():
-                member_node = type_node.addChild('member')
-                self.create_args(member_node, element)
-            
-        else:
-            if param_type == 'tuple':
-                key, param = param
-                param_type = type(param).__name__
-                name_node = parent_node.addChild('name')
-                name_node.setData(key)
-            
-            val_node = parent_node.addChild('value')
-            
-            if param != None:
-                rpc_type = self.type_to_rpc(param_type)
-                type_node = val_node.addChild(rpc_type)
-                # Convert timestamp to ISO 8601 format
-                if rpc_type == 'dateTime.iso8601':
-                    param = param.isoformat()
-                type_node.setData(param)
-            
+        self.features = {}
+
+    """ Record the features in a disco#info result """
+    def add(self, jid, query_node):
+        self.features[str(jid)] = set([feature.getAttr('var') for feature in query_node.getTags('feature')])
+
+    def remove(self, jid):
+        self.features.pop(str(jid), None)
+
+    def supports(self, jid, feature):
+        return feature in self.features.get(str(jid), ())
+
+class Compact:
+    """ Compact binary encoding of RPC payloads. Each value is a one character tag followed by fixed size fields,
+    strings and containers are prefixed by their length """
+
+    def pack_string(self, value, out):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        out.append('s' + length_struct.pack(len(value)))
+        out.append(value)
+
+    def pack_int(self, value, out):
+        if value < -2 ** 63 or value >= 2 ** 63:
+            raise TypeError('Cannot encode %s, out of 64 bit range' % value)
+        out.append('i' + int_struct.pack(value))
+
+    def pack_bool(self, value, out):
+        out.append(value and 'T' or 'F')
+
+    def pack_float(self, value, out):
+        out.append('d' + float_struct.pack(value))
+
+    def pack_datetime(self, value, out):
+        out.append('t' + datetime_struct.pack(value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond))
+
+    def pack_binary(self, value, out):
+        out.append('b' + length_struct.pack(len(value.data)))
+        out.append(value.data)
+
+    def pack_nil(self, value, out):
+        out.append('N')
+
+    def pack_array(self, value, out):
+        out.append('l' + length_struct.pack(len(value)))
+        for element in value:
+            self.pack_value(element, out)
+
+    def pack_struct(self, value, out):
+        out.append('m' + length_struct.pack(len(value)))
+        for name, element in value.items():
+            name = str(name)
+            out.append(length_struct.pack(len(name)))
+            out.append(name)
+            self.pack_value(element, out)
+
+    packers = {str:pack_string, unicode:pack_string, int:pack_int, long:pack_int, bool:pack_bool,
+        float:pack_float, datetime:pack_datetime, Binary:pack_binary, type(None):pack_nil,
+        list:pack_array, tuple:pack_array, dict:pack_struct}
+
+    """ Packs a Python value, anything with items() is packed as a struct """
+    def pack_value(self, value, out):
+        packer = self.packers.get(value.__class__)
+        if packer == None:
+            if hasattr(value, 'items'):
+                packer = Compact.pack_struct
+                value = dict(value.items())
+            else:
+                raise TypeError('Cannot encode %s' % value.__class__.__name__)
+        packer(self, value, out)
+
+    def pack(self, value):
+        out = []
+        self.pack_value(value, out)
+        return ''.join(out)
+
+    # Unpackers, each takes the data and the offset after the tag, returns the value and the offset after it
+
+    def unpack_string(self, data, offset):
+        length, = length_struct.unpack_from(data, offset)
+        offset += 4
+        return str(data[offset:offset + length]), offset + length
+
+    def unpack_int(self, data, offset):
+        return int_struct.unpack_from(data, offset)[0], offset + 8
+
+    def unpack_true(self, data, offset):
+        return True, offset
+
+    def unpack_false(self, data, offset):
+        return False, offset
+
+    def unpack_float(self, data, offset):
+        return float_struct.unpack_from(data, offset)[0], offset + 8
+
+    def unpack_datetime(self, data, offset):
+        return datetime(*datetime_struct.unpack_from(data, offset)), offset + datetime_struct.size
+
+    def unpack_binary(self, data, offset):
+        length, = length_struct.unpack_from(data, offset)
+        offset += 4
+        return Binary(data[offset:offset + length]), offset + length
+
+    def unpack_nil(self, data, offset):
+        return None, offset
+
+    def unpack_array(self, data, offset):
+        length, = length_struct.unpack_from(data, offset)
+        offset += 4
+        array = []
+        for i in range(length):
+            value, offset = self.unpack_value(data, offset)
+            array.append(value)
+        return array, offset
+
+    def unpack_struct(self, data, offset):
+        length, = length_struct.unpack_from(data, offset)
+        offset += 4
+        members = {}
+        for i in range(length):
+            name_length, = length_struct.unpack_from(data, offset)
+            offset += 4
+            name = str(data[offset:offset + name_length])
+            members[name], offset = self.unpack_value(data, offset + name_length)
+        return members, offset
+
+    unpackers = {'s':unpack_string, 'i':unpack_int, 'T':unpack_true, 'F':unpack_false, 'd':unpack_float,
+        't':unpack_datetime, 'b':unpack_binary, 'N':unpack_nil, 'l':unpack_array, 'm':unpack_struct}
+
+    def unpack_value(self, data, offset):
+        unpacker = self.unpackers.get(data[offset])
+        if unpacker == None:
+            raise ValueError('Unknown compact type %r' % data[offset])
+        return unpacker(self, data, offset + 1)
+
+    def unpack(self, data):
+        value, offset = self.unpack_value(data, 0)
+        if offset != len(data):
+            raise ValueError('Trailing data after compact value')
+        return value
+
+class Parser:
+    """ RPC encoder and decoder. Holds no state between calls, so one Parser can be shared between threads.
+    Python values are written straight to XML text, and decoded from the Node tree of a received stanza.
+    Calls to peers which advertise NS_COMPACT_RPC are sent in the compact encoding, carried base64 in the query,
+    and responses use the encoding of the call """
+    def __init__(self, peers=None):
+        self.peers = peers
+        self.compact = Compact()
+
+    # Encoders, each appends the XML of a value to a list of strings
+
+    def encode_string(self, value, out):
+        out.append('<value><string>%s</string></value>' % escape(value))
+
+    def encode_int(self, value, out):
+        out.append('<value><int>%d</int></value>' % value)
+
+    def encode_bool(self, value, out):
+        out.append(value and '<value><boolean>1</boolean></value>' or '<value><boolean>0</boolean></value>')
+
+    def encode_float(self, value, out):
+        out.append('<value><double>%r</double></value>' % value)
+
+    def encode_datetime(self, value, out):
+        out.append('<value><dateTime.iso8601>%s</dateTime.iso8601></value>' % value.isoformat())
+
+    def encode_binary(self, value, out):
+        out.append('<value><base64>%s</base64></value>' % base64.b64encode(value.data))
+
+    def encode_nil(self, value, out):
+        out.append('<value><nil/></value>')
+
+    def encode_array(self, value, out):
+        out.append('<value><array><data>')
+        for element in value:
+            self.encode_value(element, out)
+        out.append('</data></array></value>')
+
+    def encode_struct(self, value, out):
+        out.append('<value><struct>')
+        for name, element in value.items():
+            out.append('<member><name>%s</name>' % escape(str(name)))
+            self.encode_value(element, out)
+            out.append('</member>')
+        out.append('</struct></value>')
+
+    encoders = {str:encode_string, unicode:encode_string, int:encode_int, long:encode_int, bool:encode_bool,
+        float:encode_float, datetime:encode_datetime, Binary:encode_binary, type(None):encode_nil,
+        list:encode_array, tuple:encode_array, dict:encode_struct}
+
+    """ Encodes a Python value to XML-RPC. Anything with items(), such as a database row, is encoded as a struct """
+    def encode_value(self, value, out):
+        # __class__ rather than type(), which is the same for all instances of old-style classes such as Binary
+        encoder = self.encoders.get(value.__class__)
+        if encoder == None:
+            if hasattr(value, 'items'):
+                encoder = Parser.encode_struct
+                value = dict(value.items())
             else:
-                type_node = val_node.addChild('nil')
-                
-    """ Starts recursive call for XML-RPC --> Python data """
+                raise TypeError('Cannot encode %s as XML-RPC' % value.__class__.__name__)
+        encoder(self, value, out)
+
+    """ Returns the XML-RPC params element for a list of Python values """
+    def encode_params(self, params):
+        out = ['<params>']
+        for param in params:
+            out.append('<param>')
+            self.encode_value(param, out)
+            out.append('</param>')
+        out.append('</params>')
+        return ''.join(out)
+
+    # Decoders, each takes the type element of a value
+
+    def decode_string(self, node):
+        return str(node.getData())
+
+    def decode_int(self, node):
+        return int(node.getData())
+
+    def decode_bool(self, node):
+        return node.getData().strip() == '1'
+
+    def decode_float(self, node):
+        return float(node.getData())
+
+    def decode_datetime(self, node):
+        return parse_datetime(node.getData())
+
+    def decode_binary(self, node):
+        return Binary(base64.b64decode(node.getData()))
+
+    def decode_nil(self, node):
+        return None
+
+    def decode_array(self, node):
+        data, = node.getChildren()
+        return [self.decode_value(value) for value in data.getChildren()]
+
+    def decode_struct(self, node):
+        struct = {}
+        for member in node.getChildren():
+            name, value = member.getChildren()
+            struct[str(name.getData())] = self.decode_value(value)
+        return struct
+
+    decoders = {'string':decode_string, 'int':decode_int, 'i4':decode_int, 'i8':decode_int, 'boolean':decode_bool,
+        'double':decode_float, 'dateTime.iso8601':decode_datetime, 'base64':decode_binary, 'nil':decode_nil,
+        'array':decode_array, 'struct':decode_struct}
+
+    """ Decodes an XML-RPC value element to a Python value, a value without a type is a string """
+    def decode_value(self, value):
+        type_nodes = value.getChildren()
+        if not type_nodes:
+            return str(value.getData())
+        decoder = self.decoders.get(type_nodes[0].getName())
+        if decoder == None:
+            return None
+        return decoder(self, type_nodes[0])
+
+    """ Decodes a list of XML-RPC param elements to Python values """
+    def get_args_no_sender(self, params):
+        return [self.decode_value(param.getTag('value')) for param in params]
+
+    """ Same as above, with the sender as the first argument """
     def get_args(self, params, sender=None):
-        for param  in params:
-            self.get_values(self.temp_list, param)
-        args = self.temp_list
+        args = self.get_args_no_sender(params)
         args.insert(0, sender)
-        self.temp_list = []
         return args
-    
-    """ Same as above, doesn't take/return sender """
-    def get_args_no_sender(self, params):
-        for param  in params:
-            self.get_values(self.temp_list, param)
-        args = self.temp_list
-        self.temp_list = []
-        return args
- 
-    """ Generates XML-RPC fault message """
-    def fault_message(self, fault_code, fault_string):
+
+    """ Returns whether a call or response element is in the compact encoding """
+    def is_compact(self, node):
+        return node.getName() == 'compact'
+
+    """ Returns the method name and arguments, with the sender first, of a child of an RPC query """
+    def get_call(self, node, sender=None):
+        if self.is_compact(node):
+            method, params = self.compact.unpack(base64.b64decode(node.getData()))
+            return method, [sender] + params
+        params = node.getTag('params')
+        if params == None:
+            return node.getTagData('methodName'), [sender]
+        return node.getTagData('methodName'), self.get_args(params.getChildren(), sender)
+
+    """ Returns the values of an RPC response query """
+    def get_response(self, query_node):
+        compact = query_node.getTag('compact')
+        if compact != None:
+            return self.compact.unpack(base64.b64decode(compact.getData()))
+        return self.get_args_no_sender(query_node.getTag('methodResponse').getTag('params').getChildren())
+
+    """ Returns an RPC query element containing pre-serialized XML """
+    def rpc_query(self, xml):
         query = Node('query', attrs={'xmlns':NS_RPC})
-        method_response = query.addChild('methodResponse')
-    
-        fault = method_response.addChild('fault')
-        value = fault.addChild('value')
-        struct = value.addChild('struct')
-        # First member, for fault code
-        code_member = struct.addChild('member')
-        code_name = code_member.addChild('name')
-        code_name.setData('faultCode')
-        code_val = code_member.addChild('value')
-        code_type = code_val.addChild('int')
-        code_type.setData(fault_code)
-    
-        string_member = struct.addChild('member')
-        string_name = string_member.addChild('name')
-        string_name.setData('faultString')
-        string_val = string_member.addChild('value')
-        string_type = string_val.addChild('string')
-        string_type.setData(fault_string)
+        query.kids.append(RawXML(xml))
         return query
-    
-    """ Calls recursive conversion from Python --> XML-RPC """
+
+    """ Returns an RPC query carrying a compact encoded value """
+    def compact_query(self, value):
+        return self.rpc_query('<compact xmlns="%s">%s</compact>' % (NS_COMPACT_RPC, base64.b64encode(self.compact.pack(value))))
+
+    """ Generates XML-RPC fault message """
+    def fault_message(self, fault_code, fault_string):
+        out = ['<methodResponse><fault>']
+        self.encode_value({'faultCode':int(fault_code), 'faultString':fault_string}, out)
+        out.append('</fault></methodResponse>')
+        return self.rpc_query(''.join(out))
+
+    """ Creates an RPC call, compact encoded if the recipient supports it. Calls carrying results are sent in
+    the result lane """
     def rpc_call(self, to, name, params=[]):
-        query = Node('query', attrs={'xmlns':NS_RPC})
-        method_call = query.addChild('methodCall')
-        method_name = method_call.addChild('methodName')
-        method_name.setData(name)
-        parameters = method_call.addChild('params')
-        for param in params:
-            param_node = parameters.addChild('param')
-            self.create_args(param_node, param)
-
-        return Protocol('iq', to, 'set', payload=[query])
-
-    """ Creates RPC response """
-    def rpc_response(self, to, id, status, params):
-
-        if status == 'success':
-            query = Node('query', attrs={'xmlns':NS_RPC})
-            method_response = query.addChild('methodResponse')
-            parameters = method_response.addChild('params')
-# Recurse!
-            for param in params:
-                param_node = parameters.addChild('param')
-                self.create_args(param_node, param) 
-#            value = parameter.addChild('value')
-#            data = value.addChild(xml_type)
-#            data.setData(param)
+        if self.peers != None and self.peers.supports(to, NS_COMPACT_RPC):
+            query = self.compact_query([name, list(params)])
         else:
+            query = self.rpc_query('<methodCall><methodName>%s</methodName>%s</methodCall>' % (escape(name),
+                self.encode_params(params)))
+        call = Protocol('iq', to, 'set', payload=[query])
+        if name in result_methods:
+            call.lane = RESULT_LANE
+        return call
+
+    """ Creates RPC response, compact encoded if the call was. Faults are always XML-RPC """
+    def rpc_response(self, to, id, status, params, compact=False, lane=CONTROL_LANE):
+        if status != 'success':
             query = self.fault_message('1', params[0])
-            
-        return Protocol('iq', to, 'result', attrs={'id':id}, payload=[query])
+        elif compact == True:
+            query = self.compact_query(list(params))
+        else:
+            query = self.rpc_query('<methodResponse>%s</methodResponse>' % self.encode_params(params))
+        response = Protocol('iq', to, 'result', attrs={'id':id}, payload=[query])
+        response.lane = lane
+        return response
 
 if __name__=='__main__':
     print 'Whoops! This isn\'t meant to be run directly.'
@@ -5,15 +5,17 @@ import libvirt, sys
 from os import system
 from datetime import datetime
 from time import time, sleep
-from utils import Configuration, Connection, MessageScheduler, Logging
-from jabber_rpc import Parser
-from threading import Timer, Thread
+from utils import Configuration, Connection, MessageScheduler, Logging, WorkerPool
+from jabber_rpc import Parser, Peers, NS_COMPACT_RPC
+from threading import Timer, Thread, Condition, Lock
 from subprocess import Popen
+from heapq import heappush, heappop
+from itertools import count
 import sched
 
-class Job(Thread):
+class Job:
     """ Job object.
-    Setup job details """
+    Setup job details, executed periodically by the JobScheduler """
     def __init__(self, poller, id, address, protocol, frequency, domain, resource, conn, scheduler):
         self.poller = poller
         self.id = id
@@ -25,51 +27,48 @@ class Job(Thread):
         self.conn = conn
         self.scheduler = scheduler
         self.stop = False
+        self.running = False
         self.parser = Parser()
         self.cache = []
-        Thread.__init__(self)
+        # Moving average of seconds taken by each execution, reported to the Controller for job placement
+        self.exec_time = None
     
     """ Used to end the Job, sets stop boolean """
     def end(self):
         self.stop = True
     
-    """ Sends messages stored in queue """
+    """ Sends results stored in queue. Called on the receive loop, so it never waits for the in-flight window """
     def send_cached_results(self):
-        for result in self.cache:
-            message = self.parser.rpc_call(self.poller.get_aggregator(), 'add_result', result)
-            self.scheduler.add_message(message, offset=True)
+        cache = self.cache
+        self.cache = []
+        for result in cache:
+            self.add_result(result, False)
+
+    """ Passes a result to the Poller to be batched, cached if there's no parent Aggregator. Only JobScheduler
+    workers block on a full in-flight window """
+    def add_result(self, result, block=True):
+        if not self.poller.add_result(result, block):
+            self.cache.append(result)
         
-    """ Called by run method, executes polling method depending on Job protocol """
+    """ Called by the JobScheduler, executes polling method depending on Job protocol """
     def run_job(self):
-#        self.add_job(self.conn)
+        start = time()
         if self.protocol == 'snmp':
-            messages = self.snmp_poll(self.resource, self.domain, self.address)
-            if messages != None:
-                for message in messages:
-#                   print message
-                    self.scheduler.add_message(message)
+            self.snmp_poll(self.resource, self.domain, self.address)
         elif self.protocol == 'test':
-            result = self.test_execute(self.resource, self.address)
-            if result != None:
-                self.scheduler.add_message(result)
-
+            self.test_execute(self.resource, self.address)
         elif self.protocol == 'libvirt':
-            result = self.libvirt_poll(self.address, self.domain, self.resource)
-            if result != None:
-                self.scheduler.add_message(result)
+            self.libvirt_poll(self.address, self.domain, self.resource)
+        self.record_time(time() - start)
         return True
-        
-    """ Run method, keep job scheduled by checking execution time """
-    def run(self):
-        added = round(time(), 3) - self.frequency
-        while(self.stop == False):
-            start = time()
-            added += float(self.frequency)
-            self.run_job()
-            end = time() - added
-            #print float(self.frequency) - end
-            sleep(float(self.frequency) - end)
 
+    """ Adds the duration of an execution to the moving average """
+    def record_time(self, elapsed):
+        if self.exec_time == None:
+            self.exec_time = elapsed
+        else:
+            self.exec_time += 0.2 * (elapsed - self.exec_time)
+        
     """ Method called when script is executed.
     Exits before next poll if script doesn't complete """
     def test_execute(self, script, address):
@@ -80,33 +79,16 @@ class Job(Thread):
             sleep(0.25)
             
         cur_time = float(time())
-        aggregator = self.poller.get_aggregator()
+        time_recorded = datetime.now()
+        time_recorded = time_recorded.replace(microsecond=0)
         
         if cur_time >= timeout:
             subp.kill()
-            time_recorded = datetime.now()
-            time_recorded = time_recorded.replace(microsecond=0)
-            result = [self.id, time_recorded, 'timeout']
-            if aggregator != None:
-                return self.parser.rpc_call(aggregator, 'add_result', result)
-            else:
-                self.cache.append(result)
-        if subp.poll() == 0:
-            time_recorded = datetime.now()
-            time_recorded = time_recorded.replace(microsecond=0)
-            result = [self.id, time_recorded, 'pass']
-            if aggregator != None:
-                return self.parser.rpc_call(aggregator, 'add_result', result)
-            else:
-                self.cache.append(result)
+            self.add_result([self.id, time_recorded, 'timeout'])
+        elif subp.poll() == 0:
+            self.add_result([self.id, time_recorded, 'pass'])
         else:
-            time_recorded = datetime.now()
-            time_recorded = time_recorded.replace(microsecond=0)
-            result = [self.id, time_recorded, 'fail']
-            if aggregator != None:
-                return self.parser.rpc_call(aggregator, 'add_result', result)
-            else:
-                self.cache.append(result)
+            self.add_result([self.id, time_recorded, 'fail'])
     
     def str2oid(self, soid):
             """
@@ -126,7 +108,6 @@ class Job(Thread):
         Called when SNMP protocol set.
         Only polls v2c, converts oid from string.
         """
-        rpc_calls = []
         try:
             error_indication, error_status, error_index, var_binds = cmdgen.CommandGenerator().getCmd(
         # SNMP v1
@@ -154,16 +135,9 @@ class Job(Thread):
                                 val = val.__float__()
                             except AttributeError:
                                 val = val.__str__()
-                        aggregator = self.poller.get_aggregator()
-                        result = [self.id, time_recorded, val]
-                        if aggregator != None:
-                            rpc_calls.append(self.parser.rpc_call(aggregator, 'add_result', result))
-                        else:
-                            self.cache.append(result)
+                        self.add_result([self.id, time_recorded, val])
         except NoSuchObjectError:
             self.log.error('Can\'t resolve the provided OID')
-        if len(rpc_calls) > 0:
-            return rpc_calls
 
 
     """ Called to execute a libvirt poll """
@@ -182,27 +156,175 @@ class Job(Thread):
                 time_recorded = datetime.now()
                 time_recorded = time_recorded.replace(microsecond = 0)
                 
-                result = [self.id, time_recorded, val]
-                aggregator = self.poller.get_aggregator()
-                if aggregator != None:
-                    return self.parser.rpc_call(self.poller.get_aggregator(), 'add_result', result)
-                else:
-                    self.cache.append(result)
+                self.add_result([self.id, time_recorded, val])
             except libvirt.libvirtError:
                 self.log.error('Failed to find domain')
 
+class ResultBatcher:
+    """ Buffers results per Aggregator, sending each buffer as a single add_results call
+    once it holds size results or its oldest result has waited latency seconds """
+    def __init__(self, sched, size=100, latency=1.0, peers=None):
+        self.sched = sched
+        self.size = size
+        self.latency = latency
+        self.parser = Parser(peers)
+        self.buffers = {}
+        # Incremented for each new buffer of an Aggregator, so timers of buffers already flushed are ignored
+        self.generations = {}
+        self.lock = Lock()
+
+    """ Buffer a result for an Aggregator, flushing if the buffer is full. Only block off the receive loop """
+    def add(self, aggregator, result, block=False):
+        self.lock.acquire()
+        buffer = self.buffers.get(aggregator)
+        if buffer == None:
+            buffer = self.new_buffer(aggregator)
+        buffer.append(result)
+        full = len(buffer) >= self.size
+        self.lock.release()
+        if full:
+            self.flush(aggregator, block)
+
+    """ Start an empty buffer for an Aggregator, flushed after latency seconds. Called holding the lock """
+    def new_buffer(self, aggregator):
+        buffer = self.buffers[aggregator] = []
+        generation = self.generations[aggregator] = self.generations.get(aggregator, 0) + 1
+        self.sched.timers.schedule(self.latency, self.flush, (aggregator, False, generation))
+        return buffer
+
+    """ Send buffered results for an Aggregator. Flushes from the timer thread don't block on a full
+    in-flight window, the results are put back and retried after another latency period instead.
+    Timer flushes give the generation of the buffer they were scheduled for, and do nothing once it's gone """
+    def flush(self, aggregator, block=True, generation=None):
+        self.lock.acquire()
+        if generation == None or generation == self.generations.get(aggregator):
+            results = self.buffers.pop(aggregator, None)
+        else:
+            results = None
+        self.lock.release()
+        if results:
+            message = self.parser.rpc_call(aggregator, 'add_results', [results])
+            if not self.sched.add_message(message, block=block, hold=False):
+                self.lock.acquire()
+                buffer = self.buffers.get(aggregator)
+                if buffer == None:
+                    self.new_buffer(aggregator).extend(results)
+                else:
+                    buffer[:0] = results
+                self.lock.release()
+
+    """ Send all buffered results """
+    def flush_all(self):
+        for aggregator in list(self.buffers.keys()):
+            self.flush(aggregator)
+
+class JobScheduler(Thread):
+    """ Job scheduler object.
+    Keeps every Job in a heap ordered by next due time, and hands due Jobs to a bounded pool of workers.
+    Thread count is fixed by the pool size rather than growing with the number of Jobs. """
+    def __init__(self, workers=16):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue = []
+        self.counter = count()
+        self.cond = Condition()
+        self.pool = WorkerPool(workers)
+        self.stop = False
+        # Drift statistics, seconds between a Job being due and being dispatched
+        self.runs = 0
+        self.total_drift = 0.0
+        self.max_drift = 0.0
+
+    """ Schedule a Job, first execution is immediate """
+    def add_job(self, job):
+        self.cond.acquire()
+        heappush(self.queue, (time(), next(self.counter), job))
+        self.cond.notify()
+        self.cond.release()
+
+    """ Returns number of dispatched runs, mean and maximum drift in seconds """
+    def get_drift(self):
+        if self.runs == 0:
+            return 0, 0.0, 0.0
+        return self.runs, self.total_drift / self.runs, self.max_drift
+
+    """ Stop scheduling and shutdown the worker pool """
+    def end(self):
+        self.cond.acquire()
+        self.stop = True
+        self.cond.notify()
+        self.cond.release()
+        self.pool.end()
+
+    """ Executed by a worker, runs the Job and marks it as free to be dispatched again """
+    def execute(self, job):
+        try:
+            job.run_job()
+        finally:
+            job.running = False
+
+    """ Scheduler loop, waits until the earliest Job is due then dispatches it.
+    Ended Jobs are discarded when they reach the top of the heap. """
+    def run(self):
+        self.cond.acquire()
+        while self.stop == False:
+            if len(self.queue) == 0:
+                self.cond.wait()
+                continue
+            due, seq, job = self.queue[0]
+            now = time()
+            if due > now:
+                self.cond.wait(due - now)
+                continue
+            heappop(self.queue)
+            if job.stop == True:
+                continue
+            # Keep to the Job's original timing, skipping any runs that have already been missed
+            frequency = float(job.frequency)
+            next_due = due + frequency
+            if next_due <= now:
+                next_due += (int((now - next_due) / frequency) + 1) * frequency
+            heappush(self.queue, (next_due, next(self.counter), job))
+
+            # Don't overlap executions of a Job which is still running
+            if job.running == False:
+                drift = now - due
+                self.runs += 1
+                self.total_drift += drift
+                if drift > self.max_drift:
+                    self.max_drift = drift
+                job.running = True
+                self.pool.add_task(self.execute, (job,))
+        self.cond.release()
+
 class Poller:
     """ Poller object, establish connection, MUCs and handlers """
     def __init__(self, segment='skynet'):
         config = Configuration()
 
         self.jobs = {}
+        self.job_sched = JobScheduler(config.get_poller_workers())
+        self.job_sched.start()
 
         self.sched = MessageScheduler(self.message_handler)
-        self.parser = Parser()
+        # Results are sent in the compact encoding if the Aggregator advertises it in its disco#info
+        self.compact_rpc = config.get_compact_rpc()
+        if self.compact_rpc:
+            self.peers = Peers()
+        else:
+            self.peers = None
+        self.parser = Parser(self.peers)
+        batch_size, batch_latency = config.get_result_batch()
+        self.batcher = ResultBatcher(self.sched, batch_size, batch_latency, self.peers)
+        self.cost_interval = config.get_cost_interval()
+        self.sched.timers.schedule(self.cost_interval, self.report_costs)
         
         self.aggregator = None
         self.failed_aggregator = False
+        # Last sequence number given to the results of each job. Numbers start from the time in microseconds, so
+        # they're higher than any from before a restart
+        self.sequences = {}
+        self.sequence_base = int(time() * 1000000)
         
         self.query_queue = []
         conn = Connection('poller', 'roflcake')        
@@ -215,7 +337,7 @@ class Poller:
     
         self.conn = conn.get_conn()
         
-        self.log = Logging(conn)
+        self.log = Logging(conn, *config.get_logging())
         self.roster = self.conn.getRoster()
         
         self.conn.RegisterHandler('presence',self.presence_handler)
@@ -230,7 +352,7 @@ class Poller:
     """ Message scheduling handler """
     def message_handler(self, message, retry=False):
         if retry == True:
-            self.log.error('Timed out, attempting to resend.')
+            self.log.warning('Timed out, attempting to resend.')
         self.conn.send(message)
 #
 #  Handlers for node communication
@@ -255,6 +377,11 @@ class Poller:
             self.sched.received_response(iq_node)
         raise NodeProcessed  # This stanza is fully processed
     
+    """ Callback handler for the disco#info of the Aggregator, records the encodings it accepts """
+    def disco_handler(self, sender, query_node):
+        if query_node.getNamespace() == NS_DISCO_INFO:
+            self.peers.add(sender, query_node)
+
     """ IQ error handler """
     def error_handler(self, conn, iq_node):
         if iq_node.getFrom() == self.aggregator:
@@ -271,7 +398,10 @@ class Poller:
             else:
                 category = 'skynet'
             identity = Node('identity', {'category':category, 'type':'poller'})
-            reply.setQueryPayload([identity])
+            if self.compact_rpc:
+                reply.setQueryPayload([identity, Node('feature', {'var':NS_COMPACT_RPC})])
+            else:
+                reply.setQueryPayload([identity])
             conn.send(reply)
         else:
             conn.send(iq_node.buildReply('error'))
@@ -284,18 +414,15 @@ class Poller:
                 query_node = iq_node.getQueryChildren()
                 for node in query_node:
                     try:
-                        method = node.getTagData('methodName')
-                        method_whitelist = ['run_job', 'set_aggregator', 'remove_job', 'aggregator_failure']
+                        method, args = self.parser.get_call(node)
+                        method_whitelist = ['run_job', 'run_jobs', 'set_aggregator', 'remove_job', 'remove_jobs', 'aggregator_failure',
+                        'get_jobs']
                         if method in method_whitelist:
                             method = getattr(self, method)
                             try:
-                                try:
-                                    params = node.getTag('params').getChildren()
-                                    args = self.parser.get_args(params)
-                                except AttributeError:
-                                    args = []
                                 status, parameters = apply(method, args)
-                                message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters)
+                                message = self.parser.rpc_response(iq_node.getFrom(), iq_node.getID(), status, parameters,
+                                    self.parser.is_compact(node))
                                 conn.send(message)
                             except TypeError:
 #                                print sys.exc_info()
@@ -315,13 +442,26 @@ class Poller:
     """ Called by Aggregator to establish job """
     def run_job(self, sender, aggregator, id, addr, proto, freq, dom, resource):
         try:
+            # Stop any existing copy of the job, such as from a retried run_job
+            if id in self.jobs:
+                self.jobs[id].end()
             job = Job(self, id, addr, proto, freq, dom, resource, self.conn, self.sched)
             self.jobs[id] = job
-            job.start()
+            self.job_sched.add_job(job)
             return 'success', [int(id)]
         except:
             return 'failure', ['Failed to schedule job']
             
+    """ Called by Aggregator to establish a batch of jobs, each a list of run_job arguments.
+    Returns the ids of the jobs started """
+    def run_jobs(self, sender, aggregator, jobs):
+        started = []
+        for id, addr, proto, freq, dom, resource in jobs:
+            status, parameters = self.run_job(sender, aggregator, id, addr, proto, freq, dom, resource)
+            if status == 'success':
+                started.append(parameters[0])
+        return 'success', [started]
+
     """ Controller calls to notify of parent Aggregator failure """
     def aggregator_failure(self, sender):
         self.aggregator = None
@@ -337,10 +477,26 @@ class Poller:
         except:
             return 'failure', ['Failed to stop job %s' % job_id]
     
+    """ Called when a batch of jobs is moved off this Poller """
+    def remove_jobs(self, sender, job_ids):
+        stopped = 0
+        for job_id in job_ids:
+            job = self.jobs.get(int(job_id))
+            if job != None:
+                job.end()
+                stopped += 1
+        return 'success', ['Stopped %s jobs' % stopped]
+
+    """ Called by the Controller after it restarts, returns the ids of the jobs running """
+    def get_jobs(self, sender):
+        return 'success', [[int(id) for id, job in self.jobs.items() if job.stop == False]]
+
     """ Called by parent Aggregator, sets where add_results will be sent """
     def set_aggregator(self, sender, aggregator):
         self.log.info('Setting aggregator %s' % aggregator)
         self.aggregator = aggregator
+        if self.compact_rpc:
+            self.sched.add_message(Iq('get', queryNS=NS_DISCO_INFO, to=aggregator), self.disco_handler)
         if self.failed_aggregator == True:
             self.failed_aggregator = False
             for job in self.jobs.values():
@@ -354,6 +510,30 @@ class Poller:
     def get_aggregator(self):
         return self.aggregator
 
+    """ Used by Job instances to queue a result for the parent Aggregator, numbering it first so the Aggregator
+    can recognise it if it's resent. Returns False if there is no Aggregator to send to """
+    def add_result(self, result, block=False):
+        if len(result) == 3:
+            sequence = self.sequences.get(result[0], self.sequence_base) + 1
+            self.sequences[result[0]] = sequence
+            result.append(sequence)
+        aggregator = self.aggregator
+        if aggregator == None:
+            return False
+        self.batcher.add(aggregator, result, block)
+        return True
+
+    """ Reports the average execution time of each Job to the Controller in milliseconds, then schedules the next
+    report, even if this one failed """
+    def report_costs(self):
+        try:
+            costs = [[job.id, int(job.exec_time * 1000)] for job in self.jobs.values() if job.stop == False and job.exec_time != None]
+            if len(costs) > 0:
+                message = self.parser.rpc_call('controller@quae.co.uk/skynet', 'set_job_costs', [costs])
+                self.sched.add_message(message, hold=False)
+        finally:
+            self.sched.timers.schedule(self.cost_interval, self.report_costs)
+
     """ Setup listener """
     def step_on(self):
         try:
@@ -364,8 +544,11 @@ class Poller:
             # Stop all running jobs
             for job in self.jobs.values():
                 job.end()
+            self.job_sched.end()
+            self.batcher.flush_all()
                 
             self.sched.end()
+            self.log.end()
             
             print 'Unregistered from %s' % server
             return 0
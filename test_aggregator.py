@@ -0,0 +1,140 @@
+import unittest
+from aggregator import Aggregator, Evaluation, SequenceWindow
+from datetime import datetime
+from threading import Lock, RLock
+from xmpp import JID
+
+class EvaluationTestCase(unittest.TestCase):
+    def test_numeric_comparison(self):
+        evaluation = Evaluation('>', 10)
+        self.assertTrue(evaluation.check(11))
+        self.assertTrue(evaluation.check(10.5))
+        self.assertFalse(evaluation.check(10))
+
+    def test_string_comparison(self):
+        evaluation = Evaluation('==', 'pass')
+        self.assertTrue(evaluation.check('pass'))
+        self.assertFalse(evaluation.check('fail'))
+
+    def test_list_passes_when_all_elements_pass(self):
+        evaluation = Evaluation('<', 5)
+        self.assertTrue(evaluation.check([1, 2, 3]))
+        self.assertFalse(evaluation.check([1, 6]))
+
+    def test_mismatched_type(self):
+        evaluation = Evaluation('==', 'pass')
+        self.assertRaises(TypeError, evaluation.check, 1)
+
+    def test_check_all(self):
+        evaluation = Evaluation('<=', 2)
+        self.assertEqual(evaluation.check_all([1, 2, 3, 'fail']), [True, True, False, None])
+
+    def test_unsupported_comparison(self):
+        self.assertRaises(KeyError, Evaluation, 'in', 2)
+
+class SequenceWindowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.window = SequenceWindow(8)
+
+    def test_resent_result_seen(self):
+        self.assertFalse(self.window.seen(100))
+        self.window.add(100)
+        self.assertTrue(self.window.seen(100))
+        self.assertFalse(self.window.seen(101))
+
+    def test_out_of_order(self):
+        self.window.add(100)
+        self.window.add(103)
+        self.assertFalse(self.window.seen(101))
+        self.window.add(101)
+        self.assertTrue(self.window.seen(101))
+        self.assertTrue(self.window.seen(100))
+        self.assertFalse(self.window.seen(102))
+
+    def test_older_than_window_unseen(self):
+        self.window.add(100)
+        self.window.add(107)
+        self.assertTrue(self.window.seen(100))
+        self.window.add(108)
+        self.assertFalse(self.window.seen(100))
+        self.assertTrue(self.window.seen(107))
+
+    def test_jump_past_window(self):
+        self.window.add(100)
+        self.window.add(200)
+        self.assertFalse(self.window.seen(100))
+        self.assertTrue(self.window.seen(200))
+
+class BatchAggregator(Aggregator):
+    """ Aggregator without a connection or database, keeping the results it would store """
+    def __init__(self):
+        self.sequences = {}
+        self.sequence_jobs = {}
+        self.duplicates = 0
+        self.lock = RLock()
+        self.result_lock = Lock()
+        pollers = ['poller@quae.co.uk/skynet', 'poller1', 'poller2']
+        self.job_map = dict([(JID(poller), [1, 2]) for poller in pollers])
+        self.evals = {1:[], 2:[]}
+        self.placing = {}
+        self.failed_jobs = []
+        self.stored = []
+
+    def evaluate(self, id, values):
+        return [[] for val in values]
+
+    def insert_result(self, id, recorded, val, list_id=None, failed=None):
+        self.stored.append((id, val))
+
+class AddResultsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = BatchAggregator()
+        self.recorded = datetime(2010, 5, 1, 12)
+
+    def test_malformed_results_fail(self):
+        results = [[1, self.recorded, 4], [1, self.recorded], ['one', self.recorded, 4], 7, [2, self.recorded, 5, 'x']]
+        status, parameters = self.aggregator.add_results('poller@quae.co.uk/skynet', results)
+        self.assertEqual(parameters[0], ['success', 'failure', 'failure', 'failure', 'failure'])
+        self.assertEqual(self.aggregator.stored, [(1, 4)])
+
+    def test_resent_results_acked(self):
+        sender = 'poller@quae.co.uk/skynet'
+        self.aggregator.add_results(sender, [[1, self.recorded, 4, 1], [1, self.recorded, 5, 2]])
+        status, parameters = self.aggregator.add_results(sender,
+            [[1, self.recorded, 4, 1], [1, self.recorded, 5, 2], [1, self.recorded, 6, 3]])
+        self.assertEqual(parameters[0], ['success', 'success', 'success'])
+        self.assertEqual(self.aggregator.stored, [(1, 4), (1, 5), (1, 6)])
+        self.assertEqual(self.aggregator.duplicates, 2)
+
+    def test_forget_sequences(self):
+        self.aggregator.add_results('poller1', [[1, self.recorded, 4, 1], [2, self.recorded, 5, 1]])
+        self.aggregator.add_results('poller2', [[1, self.recorded, 6, 1]])
+        self.aggregator.forget_sequences(job=1)
+        self.assertEqual(self.aggregator.sequences.keys(), [2])
+        self.aggregator.forget_sequences(poller='poller1')
+        self.assertEqual(self.aggregator.sequences, {})
+        self.assertEqual(self.aggregator.sequence_jobs, {'poller2':set()})
+        # Forgotten sequence numbers are stored again
+        self.aggregator.add_results('poller1', [[2, self.recorded, 5, 1]])
+        self.assertEqual(self.aggregator.stored[-1], (2, 5))
+
+    def test_repeated_in_batch(self):
+        status, parameters = self.aggregator.add_results('poller1', [[1, self.recorded, 4, 1], [1, self.recorded, 4, 1]])
+        self.assertEqual(parameters[0], ['success', 'success'])
+        self.assertEqual(self.aggregator.stored, [(1, 4)])
+        self.assertEqual(self.aggregator.duplicates, 1)
+
+    def test_no_window_for_removed(self):
+        del self.aggregator.job_map[JID('poller1')]
+        del self.aggregator.evals[2]
+        self.aggregator.add_results('poller1', [[1, self.recorded, 4, 1]])
+        self.aggregator.add_results('poller2', [[2, self.recorded, 5, 1]])
+        self.assertEqual(self.aggregator.sequences, {})
+        self.assertEqual(self.aggregator.stored, [(1, 4), (2, 5)])
+
+    def test_insert_failure_returned(self):
+        messages = Aggregator.insert_result(self.aggregator, 1, self.recorded, object(), failed=[])
+        self.assertEqual(messages, ['Unexpected data type receieved'])
+
+if __name__ == '__main__':
+    unittest.main()
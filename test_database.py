@@ -1,5 +1,10 @@
-import unittest
-from database import Database
+import unittest, os, tempfile, calendar
+from time import sleep
+from datetime import datetime, date
+from threading import Lock
+from sqlalchemy import *
+from sqlalchemy import event
+from database import Database, ResultWriter, truncate_datetime, to_days, stream_jobs, jobs_query, job_from_row
 
 class DatabaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -14,9 +19,320 @@ class DatabaseTestCase(unittest.TestCase):
         group = self.database.get_group_by_name('quae-other')
         groups = self.database.get_groups()
         self.assertTrue(group in groups)
+
+    def test_get_table_cached(self):
+        jobs = self.database.get_table('jobs')
+        self.assertTrue(self.database.get_table('jobs') is jobs)
+        self.database.refresh_tables()
+        self.assertFalse(self.database.get_table('jobs') is jobs)
         
     def tearDown(self):
         self.database = None
+
+class ResultWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        metadata = MetaData(create_engine('sqlite:///' + self.filename))
+        self.results = Table('results', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('job', Integer),
+            Column('recorded', DateTime),
+            Column('int', Integer),
+            Column('string', String(255)),
+            Column('float', Float),
+            Column('list', Integer))
+        metadata.create_all()
+
+    def count(self):
+        return select([func.count(self.results.c.id)]).execute().scalar()
+
+    def test_flush_on_size(self):
+        writer = ResultWriter(self.results, size=10, interval=60)
+        for i in range(10):
+            writer.add(job=1, int=i, recorded=datetime.now())
+        for i in range(50):
+            if writer.written == 10:
+                break
+            sleep(0.02)
+        self.assertEqual(self.count(), 10)
+        writer.end()
+
+    def test_flush_on_end(self):
+        writer = ResultWriter(self.results, size=100, interval=60)
+        writer.add(job=1, string='pass', recorded=datetime.now())
+        writer.add(job=1, float=0.5, recorded=datetime.now())
+        writer.end()
+        self.assertEqual(self.count(), 2)
+        row = self.results.select(self.results.c.float != None).execute().fetchone()
+        self.assertEqual(row.float, 0.5)
+        self.assertEqual(row.string, None)
+
+    def test_failed_write_reported(self):
+        errors = []
+        writer = ResultWriter(self.results, size=100, interval=60, error_handler=errors.append)
+        writer.add(job=1, int=1, recorded='not a datetime')
+        writer.end()
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('Failed to write 1 results, 1 dropped in total'))
+
+    def test_rollup_rows(self):
+        writer = ResultWriter(self.results)
+        recorded = datetime(2010, 5, 1, 12, 30, 15)
+        batch = [dict(job=1, recorded=recorded, int=4, float=None, string=None, list=None),
+            dict(job=1, recorded=recorded.replace(minute=45), int=None, float=1.5, string=None, list=None),
+            dict(job=1, recorded=recorded, int=None, float=None, string='pass', list=None),
+            dict(job=2, recorded=recorded, int=7, float=None, string=None, list=None)]
+        rows = sorted(writer.rollup_rows(batch, 3600), key=lambda row: row['job'])
+        self.assertEqual(rows[0], {'job':1, 'period':datetime(2010, 5, 1, 12), 'count':3, 'value_count':2,
+            'float_count':1, 'sum':5.5, 'min':1.5, 'max':4})
+        self.assertEqual(rows[1]['count'], 1)
+        self.assertEqual(len(writer.rollup_rows(batch, 60)), 3)
+        writer.end()
+
+    def test_truncate_datetime(self):
+        recorded = datetime(2010, 5, 1, 12, 30, 15, 100)
+        self.assertEqual(truncate_datetime(recorded, 60), datetime(2010, 5, 1, 12, 30))
+        self.assertEqual(truncate_datetime(recorded, 3600), datetime(2010, 5, 1, 12))
+        self.assertEqual(truncate_datetime(recorded, 86400), datetime(2010, 5, 1))
+
+    def test_to_days(self):
+        self.assertEqual(to_days(date(2010, 1, 1)), 734138)
+
+    def tearDown(self):
+        os.remove(self.filename)
     
+class StreamJobsTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        metadata = MetaData(create_engine('sqlite:///' + self.filename))
+        self.monitors = Table('monitors', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(255)))
+        self.segments = Table('segments', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(255)))
+        self.jobs = Table('jobs', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('address', String(255)),
+            Column('frequency', Integer),
+            Column('monitor', Integer),
+            Column('segment', Integer))
+        metadata.create_all()
+        self.monitors.insert().execute([{'id':1, 'name':'frank'}, {'id':2, 'name':'bob'}])
+        self.segments.insert().execute([{'id':1, 'name':'skynet'}])
+        self.jobs.insert().execute([{'id':i, 'address':'127.0.0.1', 'frequency':1, 'monitor':i % 3, 'segment':1} for i in range(1, 11)])
+
+    def test_chunks(self):
+        chunks = list(stream_jobs(self.jobs, self.monitors, self.segments, chunk_size=3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        job = chunks[0][0]
+        self.assertEqual((job['id'], job['monitor'], job['segment'], job['address']), (1, 1, 'skynet', '127.0.0.1'))
+
+    def test_single_job(self):
+        job = job_from_row(jobs_query(self.jobs, self.monitors, self.segments).where(self.jobs.c.id == 4).execute().fetchone())
+        self.assertEqual((job['id'], job['segment']), (4, 'skynet'))
+
+    def test_jobs_without_monitor_skipped(self):
+        jobs = [job for chunk in stream_jobs(self.jobs, self.monitors, self.segments) for job in chunk]
+        self.assertEqual([job['id'] for job in jobs], [1, 2, 4, 5, 7, 8, 10])
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+""" MySQL UNIX_TIMESTAMP() of a datetime stored by SQLite """
+def unix_timestamp(recorded):
+    return calendar.timegm(datetime.strptime(recorded[:19], '%Y-%m-%d %H:%M:%S').timetuple())
+
+class SQLiteDatabase(Database):
+    """ Database on an SQLite file, with the MySQL functions used by result queries """
+    def __init__(self, filename):
+        self.db = create_engine('sqlite:///' + filename)
+        event.listen(self.db, 'connect', self.add_functions)
+        self.metadata = MetaData(self.db)
+        self.tables = {}
+        self.tables_lock = Lock()
+
+    def add_functions(self, connection, record):
+        connection.create_function('unix_timestamp', 1, unix_timestamp)
+        connection.create_function('floor', 1, lambda val: int(val // 1))
+
+class BucketedResultsTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        self.database = SQLiteDatabase(self.filename)
+        metadata = MetaData(self.database.db)
+        Table('jobs', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('monitor', Integer))
+        self.results = Table('results', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('job', Integer),
+            Column('recorded', DateTime),
+            Column('int', Integer),
+            Column('string', String(255)),
+            Column('float', Float),
+            Column('list', Integer))
+        metadata.create_all()
+        metadata.tables['jobs'].insert().execute([{'id':1, 'monitor':1}, {'id':2, 'monitor':1}])
+        # Read from the raw results only
+        self.database.get_rollup_tables = lambda: []
+
+    def add(self, job, recorded, **values):
+        values.setdefault('list', None)
+        return self.results.insert().execute(job=job, recorded=recorded, **values).inserted_primary_key[0]
+
+    def test_bucket_boundaries(self):
+        self.add(1, datetime(2010, 5, 1, 11, 59, 59), int=99)
+        self.add(1, datetime(2010, 5, 1, 12, 0, 0), int=1)
+        self.add(1, datetime(2010, 5, 1, 12, 4, 59), int=3)
+        self.add(1, datetime(2010, 5, 1, 12, 5, 0), int=10)
+        self.add(1, datetime(2010, 5, 1, 12, 59, 59), int=2)
+        self.add(1, datetime(2010, 5, 1, 13, 0, 0), int=99)
+        buckets = self.database.get_results_bucketed(None, 1, datetime(2010, 5, 1, 12), datetime(2010, 5, 1, 13), 300)
+        self.assertEqual([(bucket['recorded'], bucket['count'], bucket['min'], bucket['max'], bucket['avg'])
+            for bucket in buckets], [(datetime(2010, 5, 1, 12, 0), 2, 1, 3, 2), (datetime(2010, 5, 1, 12, 5), 1, 10, 10, 10),
+            (datetime(2010, 5, 1, 12, 55), 1, 2, 2, 2)])
+
+    def test_empty_buckets_omitted(self):
+        self.add(1, datetime(2010, 5, 1, 12, 10), int=1)
+        buckets = self.database.get_results_bucketed(None, 1, datetime(2010, 5, 1, 12), datetime(2010, 5, 1, 13), 300)
+        self.assertEqual([bucket['recorded'] for bucket in buckets], [datetime(2010, 5, 1, 12, 10)])
+        self.assertEqual(self.database.get_results_bucketed(None, 1, datetime(2010, 5, 2), datetime(2010, 5, 3), 3600), [])
+
+    def test_string_results(self):
+        self.add(2, datetime(2010, 5, 1, 12, 1), string='pass')
+        self.add(2, datetime(2010, 5, 1, 12, 2), string='fail')
+        buckets = self.database.get_results_bucketed(None, 2, datetime(2010, 5, 1, 12), datetime(2010, 5, 1, 13), 300)
+        self.assertEqual(len(buckets), 1)
+        self.assertEqual(buckets[0]['count'], 2)
+        self.assertEqual((buckets[0]['min'], buckets[0]['max'], buckets[0]['avg'], buckets[0]['result']), (None, None, None, None))
+
+    def test_floats_and_lists(self):
+        self.add(1, datetime(2010, 5, 1, 12, 1), int=1)
+        self.add(1, datetime(2010, 5, 1, 12, 2), float=2.5)
+        parent = self.add(1, datetime(2010, 5, 1, 12, 3), list=0)
+        self.add(1, datetime(2010, 5, 1, 12, 3), int=4, list=parent)
+        buckets = self.database.get_results_bucketed(None, 1, datetime(2010, 5, 1, 12), datetime(2010, 5, 1, 13), 300)
+        self.assertEqual((buckets[0]['count'], buckets[0]['min'], buckets[0]['max']), (3, 1.0, 4.0))
+        self.assertTrue(isinstance(buckets[0]['avg'], float))
+        self.assertAlmostEqual(buckets[0]['avg'], 7.5 / 3)
+
+    def test_hour_day_and_week(self):
+        self.add(1, datetime(2010, 5, 3, 12, 7), int=1)
+        self.add(1, datetime(2010, 5, 3, 12, 17), int=3)
+        hour = self.database.get_results_hour(None, 1, '2010-05-03T12:30:00')
+        self.assertEqual([bucket['recorded'] for bucket in hour], [datetime(2010, 5, 3, 12, 5), datetime(2010, 5, 3, 12, 15)])
+        day = self.database.get_results_day(None, 1, '2010-05-03T18:00:00')
+        self.assertEqual([(bucket['recorded'], bucket['result']) for bucket in day], [(datetime(2010, 5, 3, 12), 2)])
+        week = self.database.get_results_week(None, 1, '2010-05-03T00:00:00')
+        self.assertEqual([(bucket['recorded'], bucket['count']) for bucket in week], [(datetime(2010, 5, 3, 12), 2)])
+
+    def test_history_before_rollups(self):
+        del self.database.get_rollup_tables
+        self.database.get_rollup_tables()
+        self.add(1, datetime(2010, 5, 1, 12, 7), int=1)
+        # Rollups created on the 3rd, partway through the hour
+        self.add(1, datetime(2010, 5, 3, 12, 7), int=1)
+        self.add(1, datetime(2010, 5, 3, 12, 17), int=3)
+        rollup = {'job':1, 'count':1, 'value_count':1, 'float_count':0, 'sum':3, 'min':3, 'max':3}
+        self.database.get_table('results_hour').insert().execute([dict(rollup, period=datetime(2010, 5, 3, 12)),
+            dict(rollup, period=datetime(2010, 5, 3, 13), sum=8, min=8, max=8)])
+        self.database.get_table('results_minute').insert().execute(dict(rollup, period=datetime(2010, 5, 3, 12, 17)))
+        day = self.database.get_results_day(None, 1, '2010-05-01T00:00:00')
+        self.assertEqual([(bucket['recorded'], bucket['result']) for bucket in day], [(datetime(2010, 5, 1, 12), 1)])
+        # The partial first hour is read from the raw results
+        hour = self.database.get_results_bucketed(None, 1, datetime(2010, 5, 3, 12), datetime(2010, 5, 3, 13), 3600)
+        self.assertEqual([(bucket['count'], bucket['result']) for bucket in hour], [(2, 2)])
+        hour = self.database.get_results_bucketed(None, 1, datetime(2010, 5, 3, 13), datetime(2010, 5, 3, 14), 3600)
+        self.assertEqual([bucket['result'] for bucket in hour], [8])
+
+    def test_unknown_job(self):
+        self.assertEqual(self.database.get_results_bucketed(None, 3, datetime(2010, 5, 1, 12), datetime(2010, 5, 1, 13), 300), False)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class RetentionTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        self.database = SQLiteDatabase(self.filename)
+        metadata = MetaData(self.database.db)
+        groups = Table('groups', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(255)))
+        monitors = Table('monitors', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(255)),
+            Column('group', Integer))
+        jobs = Table('jobs', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('monitor', Integer))
+        metadata.create_all()
+        groups.insert().execute([{'id':1, 'name':'Quae-Other'}])
+        monitors.insert().execute([{'id':1, 'name':'Frank', 'group':1}, {'id':2, 'name':'bob', 'group':1},
+            {'id':3, 'name':'Alice', 'group':None}])
+        jobs.insert().execute([{'id':1, 'monitor':1}, {'id':2, 'monitor':2}, {'id':3, 'monitor':3}])
+
+    def test_overrides_match_any_case(self):
+        self.assertEqual(self.database.get_job_retention(30, {'frank':7}, {'quae-other':14}), {1:7, 2:14, 3:30})
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+class RemoveJobTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp()
+        os.close(handle)
+        self.database = SQLiteDatabase(self.filename)
+        metadata = MetaData(self.database.db)
+        monitors = Table('monitors', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(255)))
+        jobs = Table('jobs', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('monitor', Integer))
+        evaluations = Table('evaluations', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('job', Integer))
+        results = Table('results', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('job', Integer),
+            Column('recorded', DateTime),
+            Column('int', Integer))
+        metadata.create_all()
+        monitors.insert().execute([{'id':1, 'name':'frank'}, {'id':2, 'name':'bob'}])
+        jobs.insert().execute([{'id':1, 'monitor':1}, {'id':2, 'monitor':2}])
+        evaluations.insert().execute([{'job':1}, {'job':2}])
+        results.insert().execute([{'job':1, 'recorded':datetime(2010, 5, 1), 'int':1},
+            {'job':2, 'recorded':datetime(2010, 5, 1), 'int':2}])
+        self.database.get_rollup_tables()
+        self.database.get_table('results_hour').insert().execute(job=1, period=datetime(2010, 5, 1), count=1,
+            value_count=1, float_count=1, sum=1.0)
+
+    def jobs_in(self, table):
+        table = self.database.get_table(table)
+        return sorted([row.job for row in table.select().execute().fetchall()])
+
+    def test_removed_with_evaluations_and_results(self):
+        self.assertTrue(self.database.remove_job(1, 'frank'))
+        self.assertEqual(self.database.get_job(1), False)
+        self.assertEqual(self.jobs_in('evaluations'), [2])
+        self.assertEqual(self.jobs_in('results'), [2])
+        self.assertEqual(self.jobs_in('results_hour'), [])
+
+    def test_other_monitors_job_kept(self):
+        self.assertFalse(self.database.remove_job(2, 'frank'))
+        self.assertFalse(self.database.remove_job(2, 'nobody'))
+        self.assertNotEqual(self.database.get_job(2), False)
+        self.assertEqual(self.jobs_in('evaluations'), [1, 2])
+
+    def tearDown(self):
+        os.remove(self.filename)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from datetime import datetime
+from xmlrpclib import Binary
+from xmpp import Node
+from xmpp.simplexml import XML2Node
+from jabber_rpc import Parser, Peers, NS_COMPACT_RPC, parse_datetime
+
+class ParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser()
+
+    def round_trip(self, params):
+        call = XML2Node(str(self.parser.rpc_call('aggregator@quae.co.uk/skynet', 'add_results', params)))
+        method_call = call.getTag('query').getTag('methodCall')
+        self.assertEqual(method_call.getTagData('methodName'), 'add_results')
+        return self.parser.get_args(method_call.getTag('params').getChildren(), 'sender')
+
+    def test_scalars(self):
+        recorded = datetime(2011, 3, 1, 12, 30, 15)
+        params = ['up', 5, 2.5, True, False, None, recorded]
+        self.assertEqual(self.round_trip(params), ['sender'] + params)
+
+    def test_base64(self):
+        args = self.round_trip([Binary('\x00\xff<data>')])
+        self.assertEqual(args[1].data, '\x00\xff<data>')
+
+    def test_nested(self):
+        params = [[[1, datetime(2011, 3, 1), 'a & b'], [2, datetime(2011, 3, 2), 0.5]], {'job':{'id':1, 'tags':[]}}]
+        self.assertEqual(self.round_trip(params)[1:], params)
+
+    def test_response(self):
+        response = XML2Node(str(self.parser.rpc_response('poller@quae.co.uk/skynet', '7', 'success', [[1, 2]])))
+        self.assertEqual(response.getAttr('id'), '7')
+        params = response.getTag('query').getTag('methodResponse').getTag('params').getChildren()
+        self.assertEqual(self.parser.get_args_no_sender(params), [[1, 2]])
+
+    def test_fault(self):
+        response = XML2Node(str(self.parser.rpc_response('poller@quae.co.uk/skynet', '7', 'failure', ['No such job'])))
+        fault = response.getTag('query').getTag('methodResponse').getTag('fault')
+        self.assertEqual(self.parser.decode_value(fault.getTag('value')), {'faultCode':1, 'faultString':'No such job'})
+
+    def test_datetime_formats(self):
+        self.assertEqual(parse_datetime('20110301T12:30:15'), datetime(2011, 3, 1, 12, 30, 15))
+        self.assertEqual(parse_datetime('2011-03-01T12:30:15.25'), datetime(2011, 3, 1, 12, 30, 15, 250000))
+        self.assertRaises(ValueError, parse_datetime, '2011-03-01')
+
+    def test_untyped_value_is_string(self):
+        self.assertEqual(self.parser.decode_value(XML2Node('<value>up</value>')), 'up')
+
+    def test_unknown_type(self):
+        self.assertRaises(TypeError, self.parser.encode_params, [object()])
+
+
+class CompactTestCase(unittest.TestCase):
+    def setUp(self):
+        self.peers = Peers()
+        disco = Node('query', payload=[Node('identity', {'category':'skynet', 'type':'aggregator'}),
+            Node('feature', {'var':NS_COMPACT_RPC})])
+        self.peers.add('aggregator@quae.co.uk/skynet', disco)
+        self.parser = Parser(self.peers)
+
+    def call(self, to, params):
+        return XML2Node(str(self.parser.rpc_call(to, 'add_results', params))).getTag('query').getChildren()[0]
+
+    def test_negotiated(self):
+        self.assertTrue(self.parser.is_compact(self.call('aggregator@quae.co.uk/skynet', [])))
+        self.assertFalse(self.parser.is_compact(self.call('poller@quae.co.uk/skynet', [])))
+        self.peers.remove('aggregator@quae.co.uk/skynet')
+        self.assertFalse(self.parser.is_compact(self.call('aggregator@quae.co.uk/skynet', [])))
+
+    def test_round_trip(self):
+        params = [[[1, datetime(2011, 3, 1, 12, 30, 15, 500), 'up'], [2, datetime(2011, 3, 1), -2.5]],
+            {'job':{'id':2 ** 40, 'ok':True, 'error':None, 'data':[]}}]
+        method, args = self.parser.get_call(self.call('aggregator@quae.co.uk/skynet', params), 'sender')
+        self.assertEqual((method, args), ('add_results', ['sender'] + params))
+
+    def test_binary(self):
+        method, args = self.parser.get_call(self.call('aggregator@quae.co.uk/skynet', [Binary('\x00\xff')]))
+        self.assertEqual(args[1].data, '\x00\xff')
+
+    def test_response_matches_call(self):
+        for compact in [True, False]:
+            response = XML2Node(str(self.parser.rpc_response('poller@quae.co.uk/skynet', '7', 'success', [[1, 2]], compact)))
+            query = response.getTag('query')
+            self.assertEqual(query.getTag('compact') != None, compact)
+            self.assertEqual(self.parser.get_response(query), [[1, 2]])
+
+    def test_smaller(self):
+        params = [[[i, datetime(2011, 3, 1), i * 10] for i in range(100)]]
+        compact = str(self.parser.rpc_call('aggregator@quae.co.uk/skynet', 'add_results', params))
+        xml = str(self.parser.rpc_call('poller@quae.co.uk/skynet', 'add_results', params))
+        self.assertTrue(len(compact) * 3 < len(xml))
+
+    def test_int_range(self):
+        for value in [2 ** 63 - 1, -2 ** 63]:
+            method, args = self.parser.get_call(self.call('aggregator@quae.co.uk/skynet', [value]))
+            self.assertEqual(args[1], value)
+        for value in [2 ** 63, -2 ** 63 - 1]:
+            self.assertRaises(TypeError, self.call, 'aggregator@quae.co.uk/skynet', [value])
+
+if __name__ == '__main__':
+    unittest.main()
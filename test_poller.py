@@ -0,0 +1,118 @@
+import unittest
+from time import sleep
+from datetime import datetime
+from xmpp.simplexml import XML2Node
+from utils import MessageScheduler
+from jabber_rpc import Parser
+from poller import Job, JobScheduler, ResultBatcher
+
+class CountingJob:
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.stop = False
+        self.running = False
+        self.runs = 0
+
+    def run_job(self):
+        self.runs += 1
+
+    def end(self):
+        self.stop = True
+
+class JobSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = JobScheduler(2)
+        self.scheduler.start()
+
+    def test_runs_jobs_on_frequency(self):
+        job = CountingJob(0.1)
+        self.scheduler.add_job(job)
+        sleep(0.55)
+        self.assertTrue(job.runs >= 4)
+
+    def test_ended_job_not_run(self):
+        job = CountingJob(0.1)
+        self.scheduler.add_job(job)
+        sleep(0.15)
+        job.end()
+        runs = job.runs
+        sleep(0.3)
+        self.assertEqual(job.runs, runs)
+
+    def test_thread_count_fixed(self):
+        for i in range(1000):
+            self.scheduler.add_job(CountingJob(1))
+        self.assertEqual(len(self.scheduler.pool.workers), 2)
+
+    def tearDown(self):
+        self.scheduler.end()
+        self.scheduler = None
+
+class JobTestCase(unittest.TestCase):
+    def test_execution_time_average(self):
+        job = Job(None, 1, '127.0.0.1', 'snmp', 60, 'public', '1.3.6.1.2.1.1.3.0', None, None)
+        self.assertEqual(job.exec_time, None)
+        job.record_time(1.0)
+        self.assertEqual(job.exec_time, 1.0)
+        job.record_time(2.0)
+        self.assertAlmostEqual(job.exec_time, 1.2)
+
+class ResultBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.sched = MessageScheduler(self.handler)
+        self.batcher = ResultBatcher(self.sched, size=3, latency=0.1)
+
+    def handler(self, message, retry=False):
+        if retry == False:
+            self.sent.append(message)
+
+    def get_results(self, message):
+        query = XML2Node(str(message)).getTag('query')
+        params = query.getTag('methodCall').getTag('params').getChildren()
+        return Parser().get_args_no_sender(params)[0]
+
+    def test_flush_on_size(self):
+        recorded = datetime.now().replace(microsecond=0)
+        for i in range(3):
+            self.batcher.add('aggregator@quae.co.uk/skynet', [i, recorded, i * 10])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.get_results(self.sent[0]), [[0, recorded, 0], [1, recorded, 10], [2, recorded, 20]])
+
+    def test_flush_on_latency(self):
+        recorded = datetime.now().replace(microsecond=0)
+        self.batcher.add('aggregator@quae.co.uk/skynet', [1, recorded, 'pass'])
+        self.assertEqual(len(self.sent), 0)
+        sleep(0.2)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.get_results(self.sent[0]), [[1, recorded, 'pass']])
+
+    def test_flushed_buffer_timer_ignored(self):
+        recorded = datetime.now().replace(microsecond=0)
+        for i in range(3):
+            self.batcher.add('aggregator@quae.co.uk/skynet', [i, recorded, i * 10])
+        sleep(0.05)
+        # The first buffer's timer fires during the second buffer's latency period
+        self.batcher.add('aggregator@quae.co.uk/skynet', [3, recorded, 30])
+        sleep(0.07)
+        self.assertEqual(len(self.sent), 1)
+        sleep(0.1)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.get_results(self.sent[1]), [[3, recorded, 30]])
+
+    def test_full_window_doesnt_block(self):
+        recorded = datetime.now().replace(microsecond=0)
+        sched = MessageScheduler(self.handler, window=1)
+        batcher = ResultBatcher(sched, size=1, latency=10)
+        batcher.add('aggregator@quae.co.uk/skynet', [1, recorded, 10])
+        # The window is full, the result is kept for the next flush rather than waiting for a slot
+        batcher.add('aggregator@quae.co.uk/skynet', [2, recorded, 20])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(batcher.buffers['aggregator@quae.co.uk/skynet'], [[2, recorded, 20]])
+        sched.end()
+
+    def tearDown(self):
+        self.sched.end()
+
+if __name__ == '__main__':
+    unittest.main()
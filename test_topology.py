@@ -0,0 +1,221 @@
+import unittest
+from topology import Topology, job_cost
+
+class TopologyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.topology = Topology()
+        self.topology.add_aggregator('aggregator1')
+        self.topology.add_poller('poller1', 'skynet')
+        self.topology.add_poller('poller2', 'skynet')
+
+    def job(self, id, segment='skynet', protocol='snmp', frequency=60):
+        return {'id':id, 'address':'127.0.0.1', 'protocol':protocol, 'frequency':frequency, 'interface':'', 'resource':'', 'segment':segment}
+
+    def test_pollers_pooled_until_assigned(self):
+        self.assertEqual(self.topology.pooled_poller_count(), 2)
+        self.assertEqual(len(self.topology.get_segment_pollers('skynet')), 0)
+        poller, segment = self.topology.pop_pooled_poller()
+        self.topology.assign_poller(poller, 'aggregator1')
+        self.assertEqual(poller, 'poller1')
+        self.assertEqual(self.topology.get_poller_aggregator('poller1'), 'aggregator1')
+        self.assertEqual(self.topology.get_segment_pollers('skynet'), set(['poller1']))
+
+    def test_reassign_poller(self):
+        self.topology.add_aggregator('aggregator2')
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.assign_poller('poller1', 'aggregator2')
+        self.assertEqual(self.topology.get_aggregator_pollers('aggregator1'), [])
+        self.assertEqual(self.topology.get_aggregator_pollers('aggregator2'), [('poller1', 'skynet')])
+
+    def test_remove_aggregator_pools_pollers(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.assign_poller('poller2', 'aggregator1')
+        pollers = self.topology.remove_aggregator('aggregator1')
+        self.assertEqual(len(pollers), 2)
+        self.assertEqual(self.topology.pooled_poller_count(), 2)
+        self.assertEqual(self.topology.get_poller_aggregator('poller1'), None)
+        self.assertEqual(self.topology.get_segments(), [])
+
+    def test_assign_and_move_job(self):
+        self.topology.pool_job(self.job(1))
+        self.assertEqual(self.topology.assign_job(1, 'poller1')['id'], 1)
+        self.assertEqual(self.topology.pooled_job_count(), 0)
+        self.topology.assign_job(1, 'poller2')
+        self.assertEqual(self.topology.job_count('poller1'), 0)
+        self.assertEqual(self.topology.get_job_poller(1), 'poller2')
+        self.assertEqual(self.topology.get_last_job('poller2')['id'], 1)
+
+    def test_assign_unknown_job(self):
+        self.assertEqual(self.topology.assign_job(1, 'poller1'), None)
+        self.topology.pool_job(self.job(1))
+        self.assertEqual(self.topology.assign_job(1, 'poller3'), None)
+        self.assertEqual(self.topology.pooled_job_count(), 1)
+
+    def test_remove_poller_pools_jobs(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        for i in range(3):
+            self.topology.pool_job(self.job(i))
+            self.topology.assign_job(i, 'poller1')
+        aggregator, jobs = self.topology.remove_poller('poller1')
+        self.assertEqual(aggregator, 'aggregator1')
+        self.assertEqual([job['id'] for job in jobs], [0, 1, 2])
+        self.assertEqual(self.topology.pooled_job_count(), 3)
+        self.assertFalse(self.topology.is_poller('poller1'))
+        self.assertEqual(self.topology.get_aggregator_pollers('aggregator1'), [])
+
+    def test_remove_job(self):
+        self.topology.pool_job(self.job(1))
+        self.topology.assign_job(1, 'poller1')
+        self.assertEqual(self.topology.remove_job(1), 'poller1')
+        self.assertEqual(self.topology.get_job(1), None)
+
+    def test_least_loaded(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.assign_poller('poller2', 'aggregator1')
+        for i in range(4):
+            self.topology.pool_job(self.job(i))
+            self.topology.place_job(i, self.topology.get_least_loaded('skynet'))
+        cost = job_cost(self.job(0))
+        self.assertAlmostEqual(self.topology.get_load('poller1'), 2 * cost)
+        self.assertAlmostEqual(self.topology.get_load('poller2'), 2 * cost)
+        self.assertEqual(self.topology.remove_job(1), 'poller2')
+        self.assertEqual(self.topology.get_least_loaded('skynet'), 'poller2')
+        self.topology.assign_job(3, 'poller1')
+        self.assertAlmostEqual(self.topology.get_load('poller1'), 3 * cost)
+        self.assertEqual(self.topology.get_least_loaded('skynet'), 'poller2')
+        self.assertEqual(self.topology.get_least_loaded('other'), None)
+
+    def test_least_loaded_skips_pooled_poller(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.assign_poller('poller2', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.topology.assign_job(1, 'poller2')
+        self.topology.pool_poller('poller1')
+        self.assertEqual(self.topology.get_least_loaded('skynet'), 'poller2')
+
+    def test_placed_job_confirmed(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.topology.place_job(1, 'poller1')
+        self.assertEqual(self.topology.next_pooled_job('skynet'), None)
+        self.assertEqual(self.topology.get_job_poller(1), None)
+        self.topology.assign_job(1, 'poller1')
+        self.assertEqual(self.topology.get_job_poller(1), 'poller1')
+        self.assertEqual(self.topology.get_load('poller1'), job_cost(self.job(1)))
+        self.assertEqual(self.topology.placed_job_count(), 0)
+
+    def test_expire_placements(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.topology.place_job(1, 'poller1')
+        self.assertEqual(self.topology.expire_placements(60), 0)
+        self.assertEqual(self.topology.expire_placements(0), 1)
+        self.assertEqual(self.topology.get_load('poller1'), 0)
+        self.assertEqual(self.topology.next_pooled_job('skynet')['id'], 1)
+
+    def test_remove_poller_pools_placed_jobs(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.topology.place_job(1, 'poller1')
+        aggregator, jobs = self.topology.remove_poller('poller1')
+        self.assertEqual([job['id'] for job in jobs], [1])
+        self.assertEqual(self.topology.pooled_job_count(), 1)
+        self.assertEqual(self.topology.placed_job_count(), 0)
+
+    def test_cost_weighted_placement(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.assign_poller('poller2', 'aggregator1')
+        # A 1s SNMP poll costs as much as many 60s scripts
+        self.topology.pool_job(self.job(0, frequency=1))
+        self.topology.place_job(0, self.topology.get_least_loaded('skynet'))
+        for i in range(1, 4):
+            self.topology.pool_job(self.job(i, protocol='test'))
+            self.topology.place_job(i, self.topology.get_least_loaded('skynet'))
+        self.assertEqual(self.topology.placements[0][0], 'poller1')
+        self.assertEqual([self.topology.placements[i][0] for i in range(1, 4)], ['poller2'] * 3)
+
+    def test_set_job_time(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.topology.assign_job(1, 'poller1')
+        self.assertTrue(self.topology.set_job_time(1, 5.99))
+        self.assertAlmostEqual(self.topology.get_load('poller1'), 0.1)
+        self.assertAlmostEqual(self.topology.get_job_cost(1), 0.1)
+        self.assertFalse(self.topology.set_job_time(2, 1.0))
+
+    def test_choose_job(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        for i, frequency in enumerate([1, 10, 60]):
+            self.topology.pool_job(self.job(i, frequency=frequency))
+            self.topology.assign_job(i, 'poller1')
+        jobs = dict([(job['id'], job) for job in self.topology.get_poller_jobs('poller1')])
+        # The gap is 0.06 + 0.006 + 0.001, the 1s job is closest to half of it
+        self.assertEqual(self.topology.choose_job(jobs, self.topology.get_load('poller1'))['id'], 0)
+        self.assertEqual(self.topology.choose_job(jobs, 0.001), None)
+
+    def test_plan_poller_moves(self):
+        self.topology.add_aggregator('aggregator2')
+        for i in range(3, 6):
+            self.topology.add_poller('poller%s' % i, 'skynet')
+        for i in range(1, 6):
+            self.topology.assign_poller('poller%s' % i, 'aggregator1')
+        moves = self.topology.plan_poller_moves(10)
+        self.assertEqual(len(moves), 2)
+        self.assertEqual(set([(source, target) for poller, source, target in moves]), set([('aggregator1', 'aggregator2')]))
+        self.assertEqual(len(self.topology.plan_poller_moves(1)), 1)
+
+    def test_plan_job_moves(self):
+        self.topology.add_poller('poller3', 'skynet')
+        self.topology.add_poller('poller4', 'other')
+        self.topology.add_poller('poller5', 'other')
+        for i in range(1, 6):
+            self.topology.assign_poller('poller%s' % i, 'aggregator1')
+        for i in range(12):
+            self.topology.pool_job(self.job(i))
+            self.topology.assign_job(i, 'poller1')
+        for i in range(12, 16):
+            self.topology.pool_job(self.job(i, segment='other'))
+            self.topology.assign_job(i, 'poller4')
+        moves = self.topology.plan_job_moves(100)
+        # Every job moves once, straight to where it ends up
+        self.assertEqual(len(moves), 10)
+        self.assertEqual(len(set([job['id'] for job, source, target in moves])), 10)
+        targets = [target for job, source, target in moves]
+        self.assertEqual((targets.count('poller2'), targets.count('poller3'), targets.count('poller5')), (4, 4, 2))
+        for job, source, target in moves:
+            self.assertEqual(source, self.topology.get_job_poller(job['id']))
+        self.assertEqual(len(self.topology.plan_job_moves(3)), 3)
+
+    def test_plan_job_moves_balanced(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.assign_poller('poller2', 'aggregator1')
+        for i in range(2):
+            self.topology.pool_job(self.job(i))
+            self.topology.assign_job(i, 'poller%s' % (i + 1))
+        self.assertEqual(self.topology.plan_job_moves(100), [])
+
+    def test_replace_job(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.assertEqual(self.topology.replace_job(self.job(1, frequency=120)), None)
+        self.assertEqual(self.topology.get_job(1)['frequency'], 120)
+        self.topology.assign_job(1, 'poller1')
+        self.topology.set_job_time(1, 0.5)
+        self.assertEqual(self.topology.replace_job(self.job(1, frequency=60)), 'poller1')
+        self.assertEqual(self.topology.get_job(1)['exec_time'], 0.5)
+        self.assertAlmostEqual(self.topology.get_load('poller1'), 0.51 / 60)
+        self.topology.replace_job(self.job(1, protocol='test'))
+        self.assertAlmostEqual(self.topology.get_load('poller1'), 1.01 / 60)
+        self.assertEqual(self.topology.replace_job(self.job(2)), None)
+
+    def test_snapshot(self):
+        self.topology.assign_poller('poller1', 'aggregator1')
+        self.topology.pool_job(self.job(1))
+        self.topology.assign_job(1, 'poller1')
+        self.topology.pool_job(self.job(2))
+        snapshot = self.topology.snapshot()
+        self.assertEqual(snapshot['aggregators'], ['aggregator1'])
+        self.assertEqual(snapshot['pollers'], {'poller1':['skynet', 'aggregator1', [1]], 'poller2':['skynet', None, []]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+import unittest
+from time import sleep
+from xmpp import Iq
+from threading import Event, Thread
+from utils import TimerHeap, MessageScheduler, OrderedWorkerPool, WeightedLanes, Notifier, Logging, Configuration
+import smtpd, asyncore, email, tempfile, os
+from jabber_rpc import CONTROL_LANE, RESULT_LANE
+
+class TimerHeapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timers = TimerHeap()
+        self.calls = []
+
+    def test_calls_in_deadline_order(self):
+        self.timers.schedule(0.2, self.calls.append, ('second',))
+        self.timers.schedule(0.1, self.calls.append, ('first',))
+        sleep(0.3)
+        self.assertEqual(self.calls, ['first', 'second'])
+
+    def test_cancelled_call_not_run(self):
+        call = self.timers.schedule(0.1, self.calls.append, ('cancelled',))
+        call.cancel()
+        sleep(0.2)
+        self.assertEqual(self.calls, [])
+
+    def tearDown(self):
+        self.timers.end()
+
+class WeightedLanesTestCase(unittest.TestCase):
+    def test_turns_follow_weights(self):
+        lanes = WeightedLanes({CONTROL_LANE:2, RESULT_LANE:1})
+        both = [CONTROL_LANE, RESULT_LANE]
+        self.assertEqual([lanes.choose(both) for i in range(6)],
+            [CONTROL_LANE, CONTROL_LANE, RESULT_LANE, CONTROL_LANE, CONTROL_LANE, RESULT_LANE])
+
+    def test_only_waiting_lanes_chosen(self):
+        lanes = WeightedLanes({CONTROL_LANE:8, RESULT_LANE:1})
+        self.assertEqual(lanes.choose([RESULT_LANE]), RESULT_LANE)
+        self.assertEqual(lanes.choose([]), None)
+
+class OrderedWorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = OrderedWorkerPool(4)
+        self.calls = []
+
+    def test_key_order_kept(self):
+        done = Event()
+        for i in range(50):
+            self.pool.add_task('poller1', self.calls.append, (i,))
+        self.pool.add_task('poller1', done.set)
+        done.wait(1)
+        self.assertEqual(self.calls, list(range(50)))
+
+    def test_slow_key_doesnt_block_others(self):
+        release = Event()
+        done = Event()
+        self.pool.add_task('client', release.wait, (1,))
+        self.pool.add_task('client', self.calls.append, ('query answered',))
+        self.pool.add_task('poller1', self.calls.append, ('result stored',))
+        self.pool.add_task('poller1', done.set)
+        done.wait(1)
+        self.assertEqual(self.calls, ['result stored'])
+        release.set()
+        sleep(0.1)
+        self.assertEqual(self.calls, ['result stored', 'query answered'])
+
+    def test_control_ahead_of_results(self):
+        pool = OrderedWorkerPool(1)
+        release = Event()
+        done = Event()
+        pool.add_task('poller0', release.wait, (1,), RESULT_LANE)
+        for i in range(20):
+            pool.add_task('poller%d' % (i + 1), self.calls.append, ('result',), RESULT_LANE)
+        pool.add_task('aggregator', self.calls.append, ('failover',))
+        pool.add_task('aggregator', done.set, lane=RESULT_LANE)
+        release.set()
+        done.wait(1)
+        self.assertEqual(self.calls[0], 'failover')
+        pool.end()
+
+    def test_end_waits_for_tasks(self):
+        pool = OrderedWorkerPool(2)
+        for i in range(4):
+            pool.add_task('poller%d' % i, sleep, (0.05,), RESULT_LANE)
+            pool.add_task('poller%d' % i, self.calls.append, (i,), RESULT_LANE)
+        pool.end()
+        self.assertEqual(sorted(self.calls), [0, 1, 2, 3])
+
+    def tearDown(self):
+        self.pool.end()
+
+class MessageSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.sched = MessageScheduler(self.handler)
+
+    def handler(self, message, retry=False):
+        self.sent.append((message.getAttr('id'), retry))
+
+    def test_message_sent(self):
+        message = Iq('set', to='aggregator@quae.co.uk/skynet')
+        self.sched.add_message(message)
+        sleep(0.1)
+        self.assertEqual(self.sent, [(message.getAttr('id'), False)])
+        self.assertTrue(self.sched.is_managed(int(message.getAttr('id'))))
+
+    def test_response_runs_action(self):
+        responses = []
+        message = Iq('set', to='aggregator@quae.co.uk/skynet')
+        self.sched.add_message(message, lambda sender, query: responses.append(sender))
+        sleep(0.1)
+        response = Iq('result', frm='aggregator@quae.co.uk/skynet', attrs={'id':message.getAttr('id')})
+        self.sched.received_response(response)
+        self.assertEqual(len(responses), 1)
+        self.assertFalse(self.sched.is_managed(int(message.getAttr('id'))))
+
+    def test_unique_ids(self):
+        messages = [Iq('set', to='aggregator@quae.co.uk/skynet') for i in range(100)]
+        for message in messages:
+            self.sched.add_message(message)
+        self.assertEqual(len(set([message.getAttr('id') for message in messages])), 100)
+        self.assertEqual(self.sched.in_flight(), 100)
+
+    def test_window_backpressure(self):
+        sched = MessageScheduler(self.handler, window=1)
+        self.assertTrue(sched.add_message(Iq('set', to='aggregator@quae.co.uk/skynet')))
+        self.assertFalse(sched.add_message(Iq('set', to='aggregator@quae.co.uk/skynet'), hold=False))
+        sched.end()
+
+    def test_full_window_holds_message(self):
+        sched = MessageScheduler(self.handler, window=1)
+        first = Iq('set', to='aggregator@quae.co.uk/skynet')
+        held = Iq('set', to='aggregator@quae.co.uk/skynet')
+        self.assertTrue(sched.add_message(first))
+        self.assertTrue(sched.add_message(held))
+        self.assertEqual(len(self.sent), 1)
+        sched.received_response(Iq('result', frm='aggregator@quae.co.uk/skynet', attrs={'id':first.getAttr('id')}))
+        self.assertEqual(len(self.sent), 2)
+        self.assertTrue(sched.is_managed(int(held.getAttr('id'))))
+        sched.end()
+
+    def test_held_messages_capped(self):
+        sched = MessageScheduler(self.handler, window=1, max_held=2)
+        for i in range(3):
+            self.assertTrue(sched.add_message(Iq('set', to='aggregator@quae.co.uk/skynet')))
+        self.assertFalse(sched.add_message(Iq('set', to='aggregator@quae.co.uk/skynet')))
+        self.assertEqual(sched.dropped, 1)
+        self.assertEqual(len(self.sent), 1)
+        sched.end()
+
+    def test_release_frees_slot_before_action(self):
+        responses = []
+        sched = MessageScheduler(self.handler, window=1)
+        first = Iq('set', to='aggregator@quae.co.uk/skynet')
+        held = Iq('set', to='aggregator@quae.co.uk/skynet')
+        sched.add_message(first, lambda sender, query: responses.append(sender))
+        sched.add_message(held)
+        response = Iq('result', frm='aggregator@quae.co.uk/skynet', attrs={'id':first.getAttr('id')})
+        pending = sched.release_response(response)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(responses, [])
+        sched.run_action(pending, response)
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(sched.release_response(response), None)
+        sched.end()
+
+    def test_lanes_have_own_windows(self):
+        sched = MessageScheduler(self.handler, window=1)
+        results = Iq('set', to='aggregator@quae.co.uk/skynet')
+        results.lane = RESULT_LANE
+        self.assertTrue(sched.add_message(results))
+        self.assertTrue(sched.add_message(Iq('set', to='aggregator@quae.co.uk/skynet'), hold=False))
+        sched.end()
+
+    def test_retries_then_evicts(self):
+        sched = MessageScheduler(self.handler, retry_timeout=0.05, max_attempts=3)
+        message = Iq('set', to='aggregator@quae.co.uk/skynet')
+        sched.add_message(message)
+        sleep(0.6)
+        retries = [sent for sent in self.sent if sent[1] == True]
+        self.assertEqual(len(retries), 2)
+        self.assertFalse(sched.is_managed(int(message.getAttr('id'))))
+        sched.end()
+
+    def tearDown(self):
+        self.sched.end()
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """ Local SMTP server keeping the messages it receives and counting connections """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, email.message_from_string(data)))
+
+class NotifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInSMTPServer()
+        self.loop = Thread(target=asyncore.loop, kwargs={'timeout':0.01})
+        self.loop.setDaemon(True)
+        self.loop.start()
+
+    def test_storm_sent_as_digest(self):
+        notifier = Notifier(port=self.server.port, interval=0.1)
+        for i in range(50):
+            notifier.send_email('Job %s has caused an error!' % i, 'admin@quae.co.uk')
+        sleep(0.3)
+        self.assertEqual(len(self.server.messages), 1)
+        recipients, message = self.server.messages[0]
+        self.assertEqual(recipients, ['admin@quae.co.uk'])
+        self.assertEqual(message['Subject'], '50 Orochi alerts')
+        self.assertEqual(len(message.get_payload().splitlines()), 50)
+        notifier.end()
+
+    def test_connection_kept_open(self):
+        notifier = Notifier(port=self.server.port, interval=0.05)
+        notifier.send_email('Job 1 has caused an error!', 'admin@quae.co.uk')
+        sleep(0.2)
+        notifier.send_email('Job 2 has caused an error!', 'oncall@quae.co.uk')
+        notifier.end()
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_rate_limited_per_recipient(self):
+        notifier = Notifier(port=self.server.port, interval=0.05, rate_limit=1)
+        notifier.send_email('Job 1 has caused an error!', 'admin@quae.co.uk')
+        sleep(0.2)
+        notifier.send_email('Job 2 has caused an error!', 'admin@quae.co.uk')
+        notifier.send_email('Job 2 has caused an error!', 'oncall@quae.co.uk')
+        sleep(0.2)
+        self.assertEqual([recipients for recipients, message in self.server.messages],
+            [['admin@quae.co.uk'], ['oncall@quae.co.uk']])
+        # Held notifications are still sent when the notifier stops
+        notifier.end()
+        self.assertEqual(len(self.server.messages), 3)
+
+    def test_failed_delivery_retried(self):
+        notifier = Notifier(port=self.server.port, interval=0.05)
+        notifier.post_sms = lambda phone, message: 1 / 0
+        notifier.send_sms('Job 1 has caused an error!')
+        sleep(0.2)
+        self.assertTrue(notifier.is_alive())
+        self.assertEqual(notifier.sent, 0)
+        self.assertEqual(notifier.queued, 1)
+        notifier.end()
+
+    def test_dropped_count_kept_while_rate_limited(self):
+        notifier = Notifier(port=self.server.port, interval=0.05, rate_limit=1, max_queued=1)
+        notifier.send_email('Job 1 has caused an error!', 'admin@quae.co.uk')
+        sleep(0.2)
+        notifier.send_email('Job 2 has caused an error!', 'admin@quae.co.uk')
+        notifier.send_email('Job 3 has caused an error!', 'admin@quae.co.uk')
+        sleep(0.2)
+        self.assertEqual(notifier.dropped, 1)
+        notifier.end()
+        self.assertEqual(self.server.messages[-1][1].get_payload().splitlines(),
+            ['Job 2 has caused an error!', '1 further notifications were dropped'])
+
+    def tearDown(self):
+        self.server.close()
+        asyncore.close_all()
+        self.loop.join(1)
+
+class StandInConnection:
+    """ Connection keeping the stanzas sent through it """
+    def __init__(self):
+        self.sent = []
+
+    def get_conn(self):
+        return self
+
+    def join_muc(self, room_name):
+        return room_name + '@conference.quae.co.uk'
+
+    def send(self, stanza):
+        self.sent.append(stanza)
+
+class LoggingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = StandInConnection()
+
+    def test_entries_batched(self):
+        log = Logging(self.conn, interval=0.05, batch_size=10)
+        for i in range(25):
+            log.info('Sending job %s' % i)
+        sleep(0.2)
+        self.assertEqual(len(self.conn.sent), 3)
+        self.assertEqual(self.conn.sent[0].getBody().splitlines()[0], '[INFO] Sending job 0')
+        self.assertEqual(len(self.conn.sent[2].getBody().splitlines()), 5)
+        self.assertEqual(self.conn.sent[0].getType(), 'groupchat')
+        log.end()
+
+    def test_level_filtered(self):
+        log = Logging(self.conn, level='warning', interval=0.05)
+        log.debug('Job 1 successfully assigned')
+        log.info('Rebalanced')
+        log.error('Failed to remove poller')
+        log.end()
+        self.assertEqual([stanza.getBody() for stanza in self.conn.sent], ['[ERROR] Failed to remove poller'])
+
+    def test_level_any_case(self):
+        log = Logging(self.conn, level='WARNING', interval=0.05)
+        log.info('Rebalanced')
+        log.warning('Rebalance budget exhausted')
+        log.end()
+        self.assertEqual([stanza.getBody() for stanza in self.conn.sent], ['[WARNING] Rebalance budget exhausted'])
+
+    def test_unknown_level(self):
+        self.assertRaises(ValueError, Logging, self.conn, level='verbose')
+
+    def test_failed_send_keeps_logging(self):
+        sent = self.conn.sent
+        def send(stanza):
+            if len(sent) == 0:
+                sent.append(None)
+                raise AttributeError('Connection closed')
+            sent.append(stanza)
+        self.conn.send = send
+        log = Logging(self.conn, interval=0.05)
+        log.info('Rebalanced')
+        sleep(0.2)
+        log.info('Job 1 successfully assigned')
+        log.end()
+        self.assertEqual(sent[-1].getBody(), '[INFO] Job 1 successfully assigned')
+
+    def test_full_buffer_drops(self):
+        log = Logging(self.conn, interval=10, max_buffered=5)
+        for i in range(8):
+            log.error('Job %s has caused an error!' % i)
+        self.assertEqual(log.dropped, 3)
+        log.end()
+        lines = self.conn.sent[0].getBody().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[-1], '[WARNING] 3 log entries dropped')
+
+    def test_file_sink(self):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        log = Logging(self.conn, interval=0.05, filename=filename)
+        log.info('Rebalanced')
+        log.end()
+        lines = open(filename).read().splitlines()
+        os.remove(filename)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith('[INFO] Rebalanced'))
+
+class ConfigurationTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp('.cfg')
+        os.close(handle)
+
+    def configuration(self, text):
+        config_file = open(self.filename, 'w')
+        config_file.write(text)
+        config_file.close()
+        return Configuration(self.filename)
+
+    def test_lane_weights(self):
+        config = self.configuration('[connection]\ncontrol_weight = 4\nresult_weight = 3\n')
+        self.assertEqual(config.get_lane_weights(), {CONTROL_LANE:4, RESULT_LANE:3})
+
+    def test_lane_weights_default(self):
+        config = self.configuration('[connection]\nresult_weight = 0\n')
+        self.assertEqual(config.get_lane_weights(), {CONTROL_LANE:8, RESULT_LANE:1})
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+if __name__ == '__main__':
+    unittest.main()
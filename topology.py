@@ -0,0 +1,439 @@
+from collections import OrderedDict
+from heapq import heappush, heappop, heapify
+from itertools import count
+from time import time
+
+# Seconds an execution is expected to take for each protocol, until a Poller reports the time it observed
+protocol_times = {'snmp':0.05, 'libvirt':0.1, 'test':1.0}
+# Seconds of work handling each result, regardless of protocol
+result_time = 0.01
+
+""" Returns the load a Job puts on its Poller, as the expected seconds of work per second """
+def job_cost(job):
+    exec_time = job.get('exec_time')
+    if exec_time == None:
+        exec_time = protocol_times.get(job['protocol'], 0.1)
+    return (exec_time + result_time) / float(job['frequency'])
+
+class Topology:
+    """ Registry of the Aggregators, Pollers and Jobs known to the Controller.
+    Every relationship is indexed in both directions, so lookups don't scan other nodes. Pollers and Jobs which
+    aren't assigned are held in pools, and all changes go through the methods below to keep the indexes consistent. """
+    def __init__(self):
+        # Aggregator -> {poller: segment}
+        self.aggregators = {}
+        # Poller -> segment, for every known poller
+        self.pollers = {}
+        # Poller -> parent aggregator, assigned pollers only
+        self.poller_parents = {}
+        # Unassigned poller -> segment
+        self.poller_pool = OrderedDict()
+        # Segment -> set of assigned pollers
+        self.segments = {}
+        # Poller -> {job id: job}
+        self.poller_jobs = {}
+        # Job id -> poller
+        self.job_pollers = {}
+        # Segment -> {unassigned job id: job}
+        self.job_pool = {}
+        # Unassigned job id -> segment
+        self.pooled_jobs = {}
+        # Job id -> (poller, job, time placed), jobs sent to a poller which hasn't confirmed them yet
+        self.placements = OrderedDict()
+        # Poller -> total cost of assigned and placed jobs
+        self.loads = {}
+        # Job id -> cost counted in the load of its poller
+        self.job_costs = {}
+        # Segment -> heap of (load, sequence, poller). Entries aren't updated in place, a poller's entry is only
+        # current while its sequence matches load_seqs, older entries are discarded when they reach the top
+        self.load_heaps = {}
+        self.load_seqs = {}
+        self.sequence = count()
+
+# Aggregators
+    """ Register an Aggregator with no Pollers """
+    def add_aggregator(self, aggregator):
+        if aggregator not in self.aggregators:
+            self.aggregators[aggregator] = {}
+
+    """ Remove an Aggregator, returning its Pollers as (poller, segment) pairs, which are moved to the pool """
+    def remove_aggregator(self, aggregator):
+        pollers = self.aggregators.pop(aggregator, {})
+        for poller, segment in pollers.items():
+            self.poller_parents.pop(poller)
+            self.segments[segment].discard(poller)
+            self.poller_pool[poller] = segment
+        return list(pollers.items())
+
+    """ Return the Aggregators """
+    def get_aggregators(self):
+        return list(self.aggregators.keys())
+
+    """ Return the (poller, segment) pairs assigned to an Aggregator """
+    def get_aggregator_pollers(self, aggregator):
+        return list(self.aggregators.get(aggregator, {}).items())
+
+    def aggregator_count(self):
+        return len(self.aggregators)
+
+# Pollers
+    """ Register a Poller for a network segment, it is pooled until assigned to an Aggregator """
+    def add_poller(self, poller, segment):
+        if poller not in self.pollers:
+            self.pollers[poller] = segment
+            self.poller_jobs[poller] = OrderedDict()
+            self.poller_pool[poller] = segment
+            self.loads[poller] = 0.0
+
+    """ Remove a Poller, returning its parent Aggregator, or None if pooled, and its Jobs, which are moved to the pool.
+    Jobs placed on the Poller but not yet confirmed are pooled too """
+    def remove_poller(self, poller):
+        segment = self.pollers.get(poller)
+        if segment == None:
+            return None, []
+        self.poller_pool.pop(poller, None)
+        aggregator = self.poller_parents.pop(poller, None)
+        if aggregator != None:
+            self.aggregators[aggregator].pop(poller)
+            self.segments[segment].discard(poller)
+        jobs = list(self.poller_jobs[poller].values())
+        jobs.extend([job for job_id, (placed_poller, job, placed) in self.placements.items() if placed_poller == poller])
+        for job in jobs:
+            self.pool_job(job)
+        self.pollers.pop(poller)
+        self.poller_jobs.pop(poller)
+        self.loads.pop(poller)
+        self.load_seqs.pop(poller, None)
+        return aggregator, jobs
+
+    """ Assign a Poller to an Aggregator, taking it from the pool or its current Aggregator """
+    def assign_poller(self, poller, aggregator):
+        segment = self.pollers[poller]
+        self.poller_pool.pop(poller, None)
+        previous = self.poller_parents.get(poller)
+        if previous != None:
+            self.aggregators[previous].pop(poller)
+        self.aggregators[aggregator][poller] = segment
+        self.poller_parents[poller] = aggregator
+        self.segments.setdefault(segment, set()).add(poller)
+        self.push_load(poller)
+
+    """ Take the next unassigned Poller from the pool, returns a (poller, segment) pair """
+    def pop_pooled_poller(self):
+        poller, segment = self.poller_pool.popitem(last=False)
+        return poller, segment
+
+    """ Put an assigned Poller back in the pool, keeping its Jobs """
+    def pool_poller(self, poller):
+        aggregator = self.poller_parents.pop(poller, None)
+        segment = self.pollers[poller]
+        if aggregator != None:
+            self.aggregators[aggregator].pop(poller)
+            self.segments[segment].discard(poller)
+        self.poller_pool[poller] = segment
+
+    """ Return the Aggregator a Poller is assigned to, or None """
+    def get_poller_aggregator(self, poller):
+        return self.poller_parents.get(poller)
+
+    """ Return the assigned Pollers for a network segment """
+    def get_segment_pollers(self, segment):
+        return self.segments.get(segment, set())
+
+    """ Return the network segments with assigned Pollers """
+    def get_segments(self):
+        return [segment for segment, pollers in self.segments.items() if len(pollers) > 0]
+
+    """ Return the Aggregators, the segment and Aggregator of each Poller, and the Jobs assigned to each Poller,
+    with nodes as strings so it can be stored as JSON """
+    def snapshot(self):
+        pollers = {}
+        for poller, segment in self.pollers.items():
+            aggregator = self.poller_parents.get(poller)
+            if aggregator != None:
+                aggregator = str(aggregator)
+            pollers[str(poller)] = [segment, aggregator, list(self.poller_jobs[poller].keys())]
+        return {'aggregators':[str(aggregator) for aggregator in self.aggregators], 'pollers':pollers}
+
+    def is_aggregator(self, aggregator):
+        return aggregator in self.aggregators
+
+    def is_poller(self, poller):
+        return poller in self.pollers
+
+    def poller_count(self):
+        return len(self.pollers)
+
+    def pooled_poller_count(self):
+        return len(self.poller_pool)
+
+# Load
+    """ Return the total cost of the Jobs assigned or placed on a Poller """
+    def get_load(self, poller):
+        return self.loads.get(poller, 0.0)
+
+    """ Set the average execution time of a Job reported by its Poller, updating the Poller's load.
+    Returns False if the Job is unknown """
+    def set_job_time(self, job_id, exec_time):
+        job = self.get_job(job_id)
+        if job == None:
+            return False
+        job['exec_time'] = exec_time
+        if job_id in self.job_costs:
+            poller = self.job_pollers.get(job_id)
+            if poller == None:
+                poller = self.placements[job_id][0]
+            cost = job_cost(job)
+            self.add_load(poller, cost - self.job_costs[job_id])
+            self.job_costs[job_id] = cost
+        return True
+
+    """ Return the cost counted in the load of an assigned or placed Job, or None """
+    def get_job_cost(self, job_id):
+        return self.job_costs.get(job_id)
+
+    """ Return the Job from jobs, a dictionary of job id to Job, which most narrows a difference in load of gap
+    between two Pollers if moved between them, or None if moving any of them would widen it """
+    def choose_job(self, jobs, gap):
+        chosen = None
+        chosen_cost = None
+        for job_id, job in jobs.items():
+            cost = self.job_costs[job_id]
+            # Moving a job narrows the gap if it costs less than the gap, most when it costs half of it.
+            # The margin stops rounding in the loads moving a job back and forth
+            if cost < gap - 1e-9 and (chosen == None or abs(gap / 2 - cost) < abs(gap / 2 - chosen_cost)):
+                chosen = job
+                chosen_cost = cost
+        return chosen
+
+    """ Return the assigned Poller with the least load in a segment, or None """
+    def get_least_loaded(self, segment):
+        heap = self.load_heaps.get(segment)
+        while heap:
+            load, seq, poller = heap[0]
+            if self.load_seqs.get(poller) == seq and self.poller_parents.get(poller) != None:
+                return poller
+            heappop(heap)
+        return None
+
+    """ Add to the load of a Poller """
+    def add_load(self, poller, load):
+        self.loads[poller] += load
+        self.push_load(poller)
+
+    """ Push the current load of an assigned Poller onto its segment's heap, superseding its previous entry """
+    def push_load(self, poller):
+        if self.poller_parents.get(poller) == None:
+            return
+        segment = self.pollers[poller]
+        seq = next(self.sequence)
+        self.load_seqs[poller] = seq
+        heap = self.load_heaps.setdefault(segment, [])
+        heappush(heap, (self.loads[poller], seq, poller))
+        # Superseded entries are only discarded from the top, so rebuild once they outnumber current ones
+        if len(heap) > 2 * len(self.segments[segment]) + 16:
+            heap[:] = [entry for entry in heap if self.load_seqs.get(entry[2]) == entry[1]]
+            heapify(heap)
+
+# Rebalancing
+    """ Plan moving Pollers so each Aggregator has the same number, give or take one. Returns at most budget moves
+    as (poller, source aggregator, target aggregator), without applying them """
+    def plan_poller_moves(self, budget):
+        if len(self.aggregators) < 2:
+            return []
+        # Aggregators which already have the most Pollers keep the remainder, so the fewest Pollers move
+        ordered = sorted(self.aggregators.keys(), key=lambda aggregator: len(self.aggregators[aggregator]), reverse=True)
+        base, remainder = divmod(len(self.poller_parents), len(ordered))
+        targets = {}
+        surplus = []
+        for i in range(len(ordered)):
+            aggregator = ordered[i]
+            targets[aggregator] = base + (i < remainder and 1 or 0)
+            pollers = list(self.aggregators[aggregator].keys())
+            surplus.extend([(poller, aggregator) for poller in pollers[targets[aggregator]:]])
+        moves = []
+        for aggregator in ordered:
+            needed = targets[aggregator] - len(self.aggregators[aggregator])
+            while needed > 0 and len(surplus) > 0 and len(moves) < budget:
+                poller, source = surplus.pop()
+                moves.append((poller, source, aggregator))
+                needed -= 1
+        return moves
+
+    """ Plan moving assigned Jobs between the Pollers of each segment, repeatedly from the most to the least loaded
+    while that narrows the difference between them. A Job is moved at most once however many steps it takes part in.
+    Returns at most budget moves as (job, source poller, target poller), without applying them """
+    def plan_job_moves(self, budget):
+        # Job id -> (job, original poller, planned poller)
+        moves = OrderedDict()
+        for segment in self.get_segments():
+            loads = dict([(poller, self.loads[poller]) for poller in self.segments[segment]])
+            jobs = dict([(poller, dict(self.poller_jobs[poller])) for poller in loads])
+            while True:
+                source = max(loads, key=loads.get)
+                target = min(loads, key=loads.get)
+                job = self.choose_job(jobs[source], loads[source] - loads[target])
+                if job == None:
+                    break
+                job_id = job['id']
+                if job_id not in moves and len(moves) >= budget:
+                    break
+                cost = self.job_costs[job_id]
+                jobs[target][job_id] = jobs[source].pop(job_id)
+                loads[source] -= cost
+                loads[target] += cost
+                original = moves.pop(job_id, (job, source, target))[1]
+                if original != target:
+                    moves[job_id] = (job, original, target)
+        return list(moves.values())
+
+# Jobs
+    """ Take a Job out of the pool, placements or its Poller, returning it, or None if unknown """
+    def detach_job(self, job_id):
+        segment = self.pooled_jobs.pop(job_id, None)
+        if segment != None:
+            return self.job_pool[segment].pop(job_id)
+        if job_id in self.placements:
+            poller, job, placed = self.placements.pop(job_id)
+            self.add_load(poller, -self.job_costs.pop(job_id))
+            return job
+        poller = self.job_pollers.pop(job_id, None)
+        if poller != None:
+            self.add_load(poller, -self.job_costs.pop(job_id))
+            return self.poller_jobs[poller].pop(job_id)
+        return None
+
+    """ Add a Job to the pool of unassigned Jobs for its segment """
+    def pool_job(self, job):
+        self.detach_job(job['id'])
+        self.job_pool.setdefault(job['segment'], OrderedDict())[job['id']] = job
+        self.pooled_jobs[job['id']] = job['segment']
+
+    """ Mark a Job as sent to a Poller, its cost counting towards the Poller's load until the Poller confirms it.
+    Returns the Job, or None if the Job or Poller is unknown """
+    def place_job(self, job_id, poller):
+        if poller not in self.poller_jobs:
+            return None
+        job = self.detach_job(job_id)
+        if job == None:
+            return None
+        self.placements[job_id] = (poller, job, time())
+        self.job_costs[job_id] = job_cost(job)
+        self.add_load(poller, self.job_costs[job_id])
+        return job
+
+    """ Return placed Jobs which weren't confirmed within age seconds to the pool, returns the number expired """
+    def expire_placements(self, age):
+        expired = 0
+        cutoff = time() - age
+        while len(self.placements) > 0:
+            job_id = next(iter(self.placements))
+            poller, job, placed = self.placements[job_id]
+            if placed > cutoff:
+                break
+            self.pool_job(job)
+            expired += 1
+        return expired
+
+    """ Assign a Job to a Poller, taking it from the pool, placements or its current Poller.
+    Returns the Job, or None if the Job or Poller is unknown """
+    def assign_job(self, job_id, poller):
+        if poller not in self.poller_jobs:
+            return None
+        job = self.detach_job(job_id)
+        if job == None:
+            return None
+        self.poller_jobs[poller][job_id] = job
+        self.job_pollers[job_id] = poller
+        self.job_costs[job_id] = job_cost(job)
+        self.add_load(poller, self.job_costs[job_id])
+        return job
+
+    """ Replace a Job's details wherever it is held, keeping the reported execution time if its protocol hasn't
+    changed. Returns the Poller it's assigned or placed on, or None """
+    def replace_job(self, job):
+        job_id = job['id']
+        current = self.get_job(job_id)
+        if current == None:
+            return None
+        if current['protocol'] == job['protocol'] and job.get('exec_time') == None:
+            job['exec_time'] = current.get('exec_time')
+        if job_id in self.pooled_jobs:
+            self.job_pool[self.pooled_jobs[job_id]][job_id] = job
+            return None
+        if job_id in self.placements:
+            poller, previous, placed = self.placements[job_id]
+            self.placements[job_id] = (poller, job, placed)
+        else:
+            poller = self.job_pollers[job_id]
+            self.poller_jobs[poller][job_id] = job
+        cost = job_cost(job)
+        self.add_load(poller, cost - self.job_costs[job_id])
+        self.job_costs[job_id] = cost
+        return poller
+
+    """ Remove a Job entirely, returning the Poller it was assigned or placed on, or None """
+    def remove_job(self, job_id):
+        poller = self.job_pollers.get(job_id)
+        if job_id in self.placements:
+            poller = self.placements[job_id][0]
+        self.detach_job(job_id)
+        return poller
+
+    """ Return the Job with an id, whether pooled, placed or assigned, or None """
+    def get_job(self, job_id):
+        segment = self.pooled_jobs.get(job_id)
+        if segment != None:
+            return self.job_pool[segment][job_id]
+        if job_id in self.placements:
+            return self.placements[job_id][1]
+        poller = self.job_pollers.get(job_id)
+        if poller != None:
+            return self.poller_jobs[poller][job_id]
+        return None
+
+    """ Return the Poller a Job is assigned to, or None """
+    def get_job_poller(self, job_id):
+        return self.job_pollers.get(job_id)
+
+    """ Return the Jobs assigned to a Poller, in the order they were assigned """
+    def get_poller_jobs(self, poller):
+        return list(self.poller_jobs.get(poller, {}).values())
+
+    """ Return the most recently assigned Job of a Poller, or None """
+    def get_last_job(self, poller):
+        jobs = self.poller_jobs.get(poller)
+        if not jobs:
+            return None
+        return jobs[next(reversed(jobs))]
+
+    """ Return the unassigned Jobs, for one segment or all of them, in the order they were pooled """
+    def get_pooled_jobs(self, segment=None):
+        if segment != None:
+            return list(self.job_pool.get(segment, {}).values())
+        jobs = []
+        for pool in self.job_pool.values():
+            jobs.extend(pool.values())
+        return jobs
+
+    """ Return the next unassigned Job for a segment, or None """
+    def next_pooled_job(self, segment):
+        pool = self.job_pool.get(segment)
+        if not pool:
+            return None
+        return pool[next(iter(pool))]
+
+    def is_job_pooled(self, job_id):
+        return job_id in self.pooled_jobs
+
+    def is_job_placed(self, job_id):
+        return job_id in self.placements
+
+    def job_count(self, poller):
+        return len(self.poller_jobs.get(poller, {}))
+
+    def pooled_job_count(self):
+        return len(self.pooled_jobs)
+
+    def placed_job_count(self):
+        return len(self.placements)
@@ -1,31 +1,178 @@
 from xmpp import *
-import sys, random, time, base64, urllib3, smtplib
+import sys, random, time, base64, urllib3, smtplib, socket
 from email.mime.text import MIMEText
-from configparser import ConfigParser
-from threading import Timer, Semaphore
-from jabber_rpc import Parser
+from configparser import ConfigParser, NoSectionError, NoOptionError
+from threading import Timer, Semaphore, Thread, Condition, Lock
+from heapq import heappush, heappop
+from itertools import count
+from collections import deque
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+from jabber_rpc import Parser, CONTROL_LANE, RESULT_LANE, get_lane
 from random import uniform
 import traceback
 
-class Notifier:
-    """ Notification object """
-    def __init__(self):
+class Notifier(Thread):
+    """ Background notification sender, so an alert storm doesn't hold up storing results.
+    Notifications queued within interval seconds of the first are sent to each recipient as one digest, emails over
+    an SMTP connection kept open between digests. Each recipient is sent at most rate_limit digests every
+    rate_period seconds, further notifications wait for the next digest. At most max_queued notifications are held,
+    beyond that they're dropped and counted in the next digest. """
+    def __init__(self, host='localhost', port=25, interval=30, rate_limit=10, rate_period=3600, max_queued=1000):
+        Thread.__init__(self)
+        self.setDaemon(True)
         self.email = ''
         self.phone = '00000000000'
-        
-    """ Send an email notification with message to a certain recipient. 
+        self.sender = 'alerts@orochi.quae.co.uk'
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.max_queued = max_queued
+        # Notifications waiting for each (medium, recipient), and the times digests were last sent to each
+        self.pending = {}
+        self.sent_times = {}
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.smtp = None
+        self.stopping = False
+        self.cond = Condition()
+        self.start()
+
+    """ Queue an email notification with message to a certain recipient.
     If a recipient isn't specified, send to the admin email defined in the config file """
     def send_email(self, message, recipient=None):
         if recipient == None:
             recipient = self.email
-        s = smtplib.SMTP('localhost')
-        s.sendmail('alerts@orochi.quae.co.uk', [recipient], message)
-        s.quit()
-    
-    """ Using the Esendex REST API, send an SMS message with provided content to a given phone number.
-    If the phone number isn't specified, the SMS will be sent to the administrator number defined in the system config file"""
+        self.add('email', recipient, message)
+
+    """ Queue an SMS notification to the administrator number defined in the system config file """
     def send_sms(self, message):
-        xml  = '''<?xml version=\"1.0\" encoding=\"UTF-8\"?><message><from>''' + self.phone + '''</from><to>''' + self.phone + '''</to><type>SMS</type><body>''' + message + '''</body><validity>0</validity></message>'''
+        self.add('sms', self.phone, message)
+
+    def add(self, medium, recipient, message):
+        self.cond.acquire()
+        if self.queued < self.max_queued:
+            self.pending.setdefault((medium, recipient), []).append(message)
+            self.queued += 1
+            self.cond.notify()
+        else:
+            self.dropped += 1
+        self.cond.release()
+
+    """ Send any queued notifications, ignoring the rate limit, and stop the sender, waiting for it to finish """
+    def end(self):
+        self.cond.acquire()
+        self.stopping = True
+        self.cond.notify()
+        self.cond.release()
+        self.join()
+
+    """ Waits for a notification then for interval seconds more, so the rest of a storm goes in the same digests """
+    def run(self):
+        while True:
+            self.cond.acquire()
+            while self.queued == 0 and not self.stopping:
+                self.cond.wait()
+            digest_time = time.time() + self.interval
+            while not self.stopping and time.time() < digest_time:
+                self.cond.wait(digest_time - time.time())
+            stopping = self.stopping
+            digests = self.take_digests(stopping)
+            # The drop count is kept until there's a digest to report it in
+            dropped = 0
+            if len(digests) > 0:
+                dropped = self.dropped
+                self.dropped = 0
+            self.cond.release()
+
+            for (medium, recipient), messages in digests:
+                if dropped > 0:
+                    messages = messages + ['%s further notifications were dropped' % dropped]
+                    dropped = 0
+                try:
+                    if medium == 'email':
+                        delivered = self.deliver_email(recipient, messages)
+                    else:
+                        delivered = self.deliver_sms(recipient, messages)
+                except:
+                    print('Failed to deliver %s digest to %s' % (medium, recipient))
+                    traceback.print_exc()
+                    delivered = False
+                self.cond.acquire()
+                if delivered == True:
+                    self.sent += len(messages)
+                elif not stopping:
+                    # Retried with the next digest, which the failed one doesn't count against
+                    self.sent_times[(medium, recipient)].pop()
+                    self.pending.setdefault((medium, recipient), [])[:0] = messages
+                    self.queued += len(messages)
+                self.cond.release()
+
+            if stopping:
+                break
+        if self.smtp != None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+    """ Removes and returns the queued notifications of each recipient under their rate limit """
+    def take_digests(self, ignore_limit=False):
+        now = time.time()
+        digests = []
+        for key, messages in list(self.pending.items()):
+            sent_times = self.sent_times.setdefault(key, deque())
+            while len(sent_times) > 0 and sent_times[0] <= now - self.rate_period:
+                sent_times.popleft()
+            if len(sent_times) >= self.rate_limit and not ignore_limit:
+                continue
+            sent_times.append(now)
+            digests.append((key, messages))
+            del self.pending[key]
+            self.queued -= len(messages)
+        return digests
+
+    """ Email a digest of messages, reconnecting once if the server has closed the connection """
+    def deliver_email(self, recipient, messages):
+        if len(messages) == 1:
+            email = MIMEText(messages[0])
+            email['Subject'] = 'Orochi alert'
+        else:
+            email = MIMEText('\n'.join(messages))
+            email['Subject'] = '%s Orochi alerts' % len(messages)
+        email['From'] = self.sender
+        email['To'] = recipient
+        for attempt in range(2):
+            try:
+                if self.smtp == None:
+                    self.smtp = smtplib.SMTP(self.host, self.port)
+                self.smtp.sendmail(self.sender, [recipient], email.as_string())
+                return True
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self.smtp = None
+            except smtplib.SMTPException:
+                traceback.print_exc()
+                return False
+        traceback.print_exc()
+        return False
+
+    """ SMS a digest of messages, the count and the latest message if there is more than one """
+    def deliver_sms(self, phone, messages):
+        if len(messages) == 1:
+            message = messages[0]
+        else:
+            message = '%s Orochi alerts, latest: %s' % (len(messages), messages[-1])
+        return self.post_sms(phone, message) == True
+
+    """ Using the Esendex REST API, send an SMS message with provided content to a given phone number """
+    def post_sms(self, phone, message):
+        xml  = '''<?xml version=\"1.0\" encoding=\"UTF-8\"?><message><from>''' + self.phone + '''</from><to>''' + phone + '''</to><type>SMS</type><body>''' + message + '''</body><validity>0</validity></message>'''
         #print(xml)
         
         username = ''
@@ -54,13 +201,262 @@ class Notifier:
         
         return True
         
+class WorkerPool:
+    """ Fixed size pool of worker threads, consuming tasks from a shared queue """
+    def __init__(self, size=16):
+        self.tasks = Queue()
+        self.workers = []
+        for i in range(size):
+            worker = Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    """ Queue a method to be executed with args by the next free worker """
+    def add_task(self, method, args=()):
+        self.tasks.put((method, args))
+
+    """ Worker loop, runs tasks until a None task is received """
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task == None:
+                break
+            method, args = task
+            try:
+                method(*args)
+            except:
+                traceback.print_exc()
+
+    """ Stop all workers once the queued tasks have been run """
+    def end(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+
+class WeightedLanes:
+    """ Weighted round robin between lanes. While every lane has work waiting, each gets its weight out of every
+    sum of the weights turns """
+    def __init__(self, weights):
+        self.turns = []
+        for lane, weight in sorted(weights.items()):
+            self.turns.extend([lane] * weight)
+        self.position = 0
+
+    """ Returns the lane to take the next turn out of the lanes given, or None if none are given """
+    def choose(self, waiting):
+        for i in range(len(self.turns)):
+            lane = self.turns[(self.position + i) % len(self.turns)]
+            if lane in waiting:
+                self.position = (self.position + i + 1) % len(self.turns)
+                return lane
+        return None
+
+default_lane_weights = {CONTROL_LANE:8, RESULT_LANE:1}
+# Option in the connection section setting the weight of each lane
+lane_weight_options = {CONTROL_LANE:'control_weight', RESULT_LANE:'result_weight'}
+
+class LaneLock:
+    """ Lock handed to waiting threads by weighted round robin between lanes, rather than in no set order """
+    def __init__(self, weights=default_lane_weights):
+        self.lanes = WeightedLanes(weights)
+        self.waiting = dict([(lane, deque()) for lane in weights])
+        self.cond = Condition()
+        self.held = False
+        self.granted = None
+
+    def acquire(self, lane=CONTROL_LANE):
+        self.cond.acquire()
+        if self.held == False:
+            self.held = True
+        else:
+            ticket = object()
+            self.waiting[lane].append(ticket)
+            while self.granted is not ticket:
+                self.cond.wait()
+            self.granted = None
+        self.cond.release()
+
+    """ Release the lock, handing it straight to the next waiter if there is one """
+    def release(self):
+        self.cond.acquire()
+        lane = self.lanes.choose([lane for lane, tickets in self.waiting.items() if len(tickets) > 0])
+        if lane != None:
+            self.granted = self.waiting[lane].popleft()
+            self.cond.notifyAll()
+        else:
+            self.held = False
+        self.cond.release()
+
+class OrderedWorkerPool:
+    """ Fixed size pool of worker threads, where tasks added with the same key run one at a time in the order
+    they were added, and tasks with different keys run in parallel. Used to handle stanzas off the receive
+    loop while keeping each sender's stanzas in order. Keys whose next task is in a lane wait in that lane,
+    workers take from the lanes by weighted round robin. At most max_pending tasks wait in each lane, adding
+    blocks beyond that """
+    def __init__(self, size=8, max_pending=10000, weights=default_lane_weights):
+        self.lanes = WeightedLanes(weights)
+        # Keys with waiting tasks and none running, each key is in a lane at most once
+        self.ready = dict([(lane, deque()) for lane in weights])
+        # Tasks of each key, the key is present while one of its tasks is waiting or running
+        self.pending = {}
+        self.cond = Condition()
+        self.slots = dict([(lane, Semaphore(max_pending)) for lane in weights])
+        self.stopping = False
+        self.workers = []
+        for i in range(size):
+            worker = Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    """ Queue a method to be executed with args once earlier tasks with the same key have run """
+    def add_task(self, key, method, args=(), lane=CONTROL_LANE):
+        self.slots[lane].acquire()
+        self.cond.acquire()
+        tasks = self.pending.get(key)
+        if tasks == None:
+            self.pending[key] = deque([(lane, method, args)])
+            self.ready[lane].append(key)
+            self.cond.notify()
+        else:
+            tasks.append((lane, method, args))
+        self.cond.release()
+
+    """ Worker loop, runs the next task of a ready key then puts the key in the lane of its next task """
+    def work(self):
+        self.cond.acquire()
+        while True:
+            lane = self.lanes.choose([lane for lane, keys in self.ready.items() if len(keys) > 0])
+            if lane == None:
+                if self.stopping:
+                    break
+                self.cond.wait()
+                continue
+            key = self.ready[lane].popleft()
+            lane, method, args = self.pending[key].popleft()
+            self.cond.release()
+            try:
+                method(*args)
+            except:
+                traceback.print_exc()
+            self.slots[lane].release()
+            self.cond.acquire()
+            tasks = self.pending[key]
+            if len(tasks) > 0:
+                self.ready[tasks[0][0]].append(key)
+                self.cond.notify()
+            else:
+                del self.pending[key]
+        self.cond.release()
+
+    """ Stop all workers once the queued tasks have been run, waiting for them to finish """
+    def end(self):
+        self.cond.acquire()
+        self.stopping = True
+        self.cond.notifyAll()
+        self.cond.release()
+        for worker in self.workers:
+            worker.join()
+
+class ScheduledCall:
+    """ Handle for a call scheduled on a TimerHeap """
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.cancelled = False
+
+    """ Prevent the call from running, it is discarded when it reaches the top of the heap """
+    def cancel(self):
+        self.cancelled = True
+
+class TimerHeap(Thread):
+    """ Single thread executing scheduled calls, kept in a heap ordered by deadline.
+    Replaces starting a threading.Timer for every delayed call. """
+    def __init__(self):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue = []
+        self.counter = count()
+        self.cond = Condition()
+        self.stop = False
+        self.start()
+
+    """ Schedule method to be called with args after delay seconds, returns a ScheduledCall """
+    def schedule(self, delay, method, args=()):
+        call = ScheduledCall(method, args)
+        self.cond.acquire()
+        heappush(self.queue, (time.time() + delay, next(self.counter), call))
+        self.cond.notify()
+        self.cond.release()
+        return call
+
+    """ Stop the thread, discarding any pending calls """
+    def end(self):
+        self.cond.acquire()
+        self.stop = True
+        self.queue = []
+        self.cond.notify()
+        self.cond.release()
+
+    """ Wait for the earliest deadline, then run the call outside of the lock """
+    def run(self):
+        self.cond.acquire()
+        while self.stop == False:
+            if len(self.queue) == 0:
+                self.cond.wait()
+                continue
+            deadline, seq, call = self.queue[0]
+            now = time.time()
+            if deadline > now:
+                self.cond.wait(deadline - now)
+                continue
+            heappop(self.queue)
+            if call.cancelled == True:
+                continue
+            self.cond.release()
+            try:
+                call.method(*call.args)
+            except:
+                traceback.print_exc()
+            self.cond.acquire()
+        self.cond.release()
+
+class PendingMessage:
+    """ In-flight message tracked by the MessageScheduler until a response is received """
+    def __init__(self, message, action):
+        self.message = message
+        self.action = action
+        self.attempts = 1
+        self.created = time.time()
+        self.call = None
+
 class MessageScheduler:
-    """ Message scheduler and queue object """
-    def __init__(self, handler):
+    """ Message scheduler and queue object.
+    At most window messages are in-flight at once, unanswered messages are resent with exponential backoff
+    up to max_attempts times, and evicted after ttl seconds. Each lane has its own window, so results in flight
+    never hold up control messages. Messages added while their window is full are held and sent as slots are
+    freed, so the receive loop never waits on a response only it can read. At most max_held messages are held in
+    each lane, beyond that they're dropped and counted. Response actions run holding action_lock, if given, which
+    is only taken once the response has freed its slot in the window """
+    def __init__(self, handler, window=1000, retry_timeout=10, max_attempts=4, ttl=300, action_lock=None,
+        max_held=10000):
         self.handler = handler
+        self.action_lock = action_lock
         self.messages = {}
         self.sem = Semaphore()
+        self.windows = {CONTROL_LANE:Semaphore(window), RESULT_LANE:Semaphore(window)}
+        # Messages waiting for a slot in the window of their lane, with their action and offset
+        self.held = {CONTROL_LANE:deque(), RESULT_LANE:deque()}
+        self.held_lock = Lock()
+        self.max_held = max_held
+        self.dropped = 0
+        self.retry_timeout = retry_timeout
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        # Seed IDs from the clock so they stay unique across restarts of the node
+        self.counter = count(int(time.time() * 1000))
         self.parser = Parser()
+        self.timers = TimerHeap()
         
     """ Check if a message is managed by the Scheduler by ID """
     def is_managed(self, iq_id):
@@ -70,64 +466,155 @@ class MessageScheduler:
         except KeyError:
             pass
         return False
+
+    """ Returns the number of messages awaiting a response """
+    def in_flight(self):
+        return len(self.messages)
         
     """ Shutdown the queue, remove all queued messages and cleanup """
     def end(self):
+        self.held_lock.acquire()
+        for held in self.held.values():
+            held.clear()
+        self.held_lock.release()
         self.sem.acquire()
         while len(self.messages) > 0:
-            key, (message, action) = self.messages.popitem()
-            message.cancel()
+            key, pending = self.messages.popitem()
+            pending.call.cancel()
+            self.windows[get_lane(pending.message)].release()
         del self.messages
+        self.timers.end()
         self.sem.release()
         
     """ Add a message to the queue with optional random offset and method to perform when a result is recieved.
-    Immediately sends a message, and schedules another retry message to be sent ten seconds later. """
-    def add_message(self, message, action=None, offset=False):
+    Immediately sends a message, and schedules a retry to be sent if no response arrives in time.
+    When the in-flight window of the message's lane is full, the message is held and sent once a slot is freed,
+    or dropped returning False if max_held messages are already held. If hold is False it's returned to the
+    caller instead, with False, and if block is True the caller waits for a slot. Only block off the receive loop
+    and without holding a node lock. """
+    def add_message(self, message, action=None, offset=False, block=False, hold=True):
+        lane = get_lane(message)
+        if block == True:
+            self.windows[lane].acquire()
+        else:
+            self.held_lock.acquire()
+            try:
+                if not self.windows[lane].acquire(False):
+                    if not hold:
+                        return False
+                    if len(self.held[lane]) >= self.max_held:
+                        self.dropped += 1
+                        print('Held message limit reached, %s messages dropped' % self.dropped)
+                        return False
+                    self.held[lane].append((message, action, offset))
+                    return True
+            finally:
+                self.held_lock.release()
+        return self.send(message, action, offset)
+
+    """ Frees a slot in the window of a lane, using it to send the next held message if there is one """
+    def free_slot(self, lane):
+        self.held_lock.acquire()
+        if len(self.held[lane]) > 0:
+            message, action, offset = self.held[lane].popleft()
+        else:
+            message = None
+            self.windows[lane].release()
+        self.held_lock.release()
+        if message != None:
+            self.send(message, action, offset)
+
+    """ Send a message in a slot already taken from its window """
+    def send(self, message, action=None, offset=False):
         if offset == True:
             delay = uniform(0, 60)
         else:
             delay = 0
-            
+
         # Send initial message with no, or offset amount of delay
         try:
-            message_id = int(time.time() * 100)
-            message.setAttr('id', message_id)
-#            self.sem.acquire()
-            # Setup a second message to be sent after timeout
-            retry_job = Timer(delay + 10, self.handler, (message, True))
-            self.messages[message_id] = retry_job, action
-            retry_job.start()
-#            self.sem.release()
-            Timer(delay, self.handler, (message,)).start()
+            self.sem.acquire()
+            try:
+                message_id = next(self.counter)
+                message.setAttr('id', message_id)
+                pending = PendingMessage(message, action)
+                # Setup a retry to be sent after timeout
+                pending.call = self.timers.schedule(delay + self.retry_timeout, self.retry, (message_id,))
+                self.messages[message_id] = pending
+            finally:
+                self.sem.release()
+            if delay > 0:
+                self.timers.schedule(delay, self.handler, (message,))
+            else:
+                self.handler(message)
         except AttributeError:
+            self.windows[get_lane(message)].release()
             print("Can't send message, queue is shutting down.")
-#        self.sem.release()
+            return False
+        return True
+
+    """ Called when a message hasn't received a response in time. Resends the message with a doubled timeout,
+    or evicts it once the attempts or time to live are exhausted """
+    def retry(self, message_id):
+        self.sem.acquire()
+        try:
+            pending = self.messages.get(message_id)
+            if pending == None:
+                return
+            age = time.time() - pending.created
+            evicted = pending.attempts >= self.max_attempts or age >= self.ttl
+            if evicted:
+                self.messages.pop(message_id)
+            else:
+                timeout = min(self.retry_timeout * 2 ** pending.attempts, self.ttl - age)
+                pending.attempts += 1
+                pending.call = self.timers.schedule(timeout, self.retry, (message_id,))
+        finally:
+            self.sem.release()
+        if evicted:
+            print('Message %s evicted after %s attempts' % (message_id, pending.attempts))
+            self.free_slot(get_lane(pending.message))
+        else:
+            self.handler(pending.message, True)
         
     """ Passed an iq node, removes any future scheduled message retries and if applicable, executes the assigned method. """
     def received_response(self, iq_node):
-#        print('Message response received!')
+        pending = self.release_response(iq_node)
+        if pending != None:
+            self.run_action(pending, iq_node)
+
+    """ Passed an iq node, removes any future scheduled message retries and frees the message's slot in its window.
+    Returns the pending message, or None if it already had a response. Cheap enough to call on the receive loop """
+    def release_response(self, iq_node):
         # Cancel subsequent message when response receieved
-        self.sem.acquire()
         iq_id = iq_node.getAttr('id')
-        sender = iq_node.getFrom()
         # If this is a response to the retry, and the original message got a response after the retry was sent
+        self.sem.acquire()
         try:
-            thread, action = self.messages.pop(int(iq_id))
-            try:
-                thread.cancel()
-            except:
-                print('Error removing retry message')
-            if action != None:
-                try:
-                    apply(action, [sender, iq_node.getTag('query')])
-                except:
-                    print('Failed to execute handler')
-#                    print(sys.exc_info())
-                    traceback.print_exc()
+            pending = self.messages.pop(int(iq_id))
         except KeyError:
-            print('Response already receieved')
-        # No way to tell whether a response is to a retry or original. If original, then successful response, so cancel retry
+            pending = None
         self.sem.release()
+        if pending == None:
+            print('Response already receieved')
+            return None
+        pending.call.cancel()
+        self.free_slot(get_lane(pending.message))
+        return pending
+
+    """ Executes the method assigned to a pending message, if any, with the response """
+    def run_action(self, pending, iq_node):
+        # Run the action outside of the lock, it may queue further messages
+        if pending.action != None:
+            if self.action_lock != None:
+                self.action_lock.acquire()
+            try:
+                pending.action(iq_node.getFrom(), iq_node.getTag('query'))
+            except:
+                print('Failed to execute handler')
+                traceback.print_exc()
+            if self.action_lock != None:
+                self.action_lock.release()
     
 class Configuration:
     """ System configuration object, takes configuration filename as argument """
@@ -158,6 +645,206 @@ class Configuration:
 
     def get_db_password(self):
         return self.config.get('database', 'password')
+
+    """ Returns the number of worker threads used to execute poller jobs """
+    def get_poller_workers(self):
+        try:
+            return self.config.getint('poller', 'workers')
+        except (NoSectionError, NoOptionError):
+            return 16
+
+    """ Returns the seconds between a poller reporting job execution times to the controller """
+    def get_cost_interval(self):
+        try:
+            return self.config.getint('poller', 'cost_interval')
+        except (NoSectionError, NoOptionError):
+            return 300
+
+    """ Returns the number of results a poller batches into one add_results call, and the
+    longest time in seconds a result waits before its batch is sent """
+    def get_result_batch(self):
+        try:
+            size = self.config.getint('poller', 'batch_size')
+        except (NoSectionError, NoOptionError):
+            size = 100
+        try:
+            latency = self.config.getfloat('poller', 'batch_latency')
+        except (NoSectionError, NoOptionError):
+            latency = 1.0
+        return size, latency
+
+    """ Returns the number of rows an aggregator inserts at once, the longest time in seconds a row waits
+    before being inserted, and the most rows held waiting to be inserted """
+    def get_result_writer(self):
+        try:
+            size = self.config.getint('aggregator', 'batch_size')
+        except (NoSectionError, NoOptionError):
+            size = 500
+        try:
+            interval = self.config.getfloat('aggregator', 'flush_interval')
+        except (NoSectionError, NoOptionError):
+            interval = 1.0
+        try:
+            max_queued = self.config.getint('aggregator', 'max_queued')
+        except (NoSectionError, NoOptionError):
+            max_queued = 10000
+        return size, interval, max_queued
+
+    """ Returns the number of days raw results are kept, or None to keep them forever, followed by dictionaries
+    of days overriding it for monitors and groups by lowercase name, set as monitor.<name> and group.<name> """
+    def get_retention(self):
+        days = None
+        monitor_days = {}
+        group_days = {}
+        if self.config.has_section('retention'):
+            for name, value in self.config.items('retention'):
+                if name == 'days':
+                    days = int(value)
+                elif name.startswith('monitor.'):
+                    monitor_days[name[len('monitor.'):].lower()] = int(value)
+                elif name.startswith('group.'):
+                    group_days[name[len('group.'):].lower()] = int(value)
+        return days, monitor_days, group_days
+
+    """ Returns the most jobs and pollers the controller moves when rebalancing in each interval, and the interval in seconds """
+    def get_rebalance(self):
+        try:
+            budget = self.config.getint('controller', 'move_budget')
+        except (NoSectionError, NoOptionError):
+            budget = 500
+        try:
+            interval = self.config.getint('controller', 'move_interval')
+        except (NoSectionError, NoOptionError):
+            interval = 60
+        return budget, interval
+
+    """ Returns the seconds the controller waits for further nodes to join or leave before rebalancing, and the
+    longest it waits after the first """
+    def get_rebalance_delay(self):
+        try:
+            delay = self.config.getfloat('controller', 'rebalance_delay')
+        except (NoSectionError, NoOptionError):
+            delay = 2.0
+        try:
+            max_delay = self.config.getfloat('controller', 'rebalance_max_delay')
+        except (NoSectionError, NoOptionError):
+            max_delay = 10.0
+        return delay, max_delay
+
+    """ Returns the file the controller keeps a snapshot of its topology in, the seconds between checks for changes
+    to write, the seconds after starting during which nodes are matched against the snapshot, and the oldest
+    snapshot in seconds which is used """
+    def get_snapshot(self):
+        try:
+            filename = self.config.get('controller', 'snapshot_file')
+        except (NoSectionError, NoOptionError):
+            filename = 'controller.snapshot'
+        try:
+            interval = self.config.getint('controller', 'snapshot_interval')
+        except (NoSectionError, NoOptionError):
+            interval = 10
+        try:
+            window = self.config.getint('controller', 'restore_window')
+        except (NoSectionError, NoOptionError):
+            window = 30
+        try:
+            max_age = self.config.getint('controller', 'snapshot_max_age')
+        except (NoSectionError, NoOptionError):
+            max_age = 600
+        return filename, interval, window, max_age
+
+    """ Returns the seconds between runs of results maintenance, and whether the results table should be
+    converted to daily partitions """
+    def get_maintenance(self):
+        try:
+            interval = self.config.getint('maintenance', 'interval')
+        except (NoSectionError, NoOptionError):
+            interval = 3600
+        try:
+            partition = self.config.getboolean('maintenance', 'partition')
+        except (NoSectionError, NoOptionError):
+            partition = False
+        return interval, partition
+
+    """ Returns the lowest level sent to the logging MUC, the seconds entries are buffered before sending, the most
+    entries sent in one message, the most entries buffered, and a file entries are also appended to or None """
+    def get_logging(self):
+        try:
+            level = self.config.get('logging', 'level')
+        except (NoSectionError, NoOptionError):
+            level = 'info'
+        try:
+            interval = self.config.getfloat('logging', 'interval')
+        except (NoSectionError, NoOptionError):
+            interval = 1.0
+        try:
+            batch_size = self.config.getint('logging', 'batch_size')
+        except (NoSectionError, NoOptionError):
+            batch_size = 50
+        try:
+            max_buffered = self.config.getint('logging', 'max_buffered')
+        except (NoSectionError, NoOptionError):
+            max_buffered = 1000
+        try:
+            filename = self.config.get('logging', 'file')
+        except (NoSectionError, NoOptionError):
+            filename = None
+        return level, interval, batch_size, max_buffered, filename
+
+    """ Returns the SMTP server host and port used for notifications, the seconds notifications are gathered into a
+    digest, and the most digests sent to a recipient every rate_period seconds """
+    def get_notifications(self):
+        try:
+            host = self.config.get('notifications', 'smtp_host')
+        except (NoSectionError, NoOptionError):
+            host = 'localhost'
+        try:
+            port = self.config.getint('notifications', 'smtp_port')
+        except (NoSectionError, NoOptionError):
+            port = 25
+        try:
+            interval = self.config.getfloat('notifications', 'digest_interval')
+        except (NoSectionError, NoOptionError):
+            interval = 30
+        try:
+            rate_limit = self.config.getint('notifications', 'rate_limit')
+        except (NoSectionError, NoOptionError):
+            rate_limit = 10
+        try:
+            rate_period = self.config.getint('notifications', 'rate_period')
+        except (NoSectionError, NoOptionError):
+            rate_period = 3600
+        return host, port, interval, rate_limit, rate_period
+
+    """ Returns the number of worker threads handling incoming stanzas, and the most stanzas waiting for them """
+    def get_dispatch(self):
+        try:
+            workers = self.config.getint('connection', 'dispatch_workers')
+        except (NoSectionError, NoOptionError):
+            workers = 8
+        try:
+            max_pending = self.config.getint('connection', 'dispatch_queue')
+        except (NoSectionError, NoOptionError):
+            max_pending = 10000
+        return workers, max_pending
+
+    """ Returns the weights of the control and result lanes, out of every sum of the weights stanzas sent or
+    handled while both lanes are waiting, each lane gets its weight """
+    def get_lane_weights(self):
+        weights = dict(default_lane_weights)
+        for lane in weights:
+            try:
+                weights[lane] = max(1, self.config.getint('connection', lane_weight_options[lane]))
+            except (NoSectionError, NoOptionError):
+                pass
+        return weights
+
+    """ Returns whether the node advertises, and uses with peers advertising it, the compact RPC encoding """
+    def get_compact_rpc(self):
+        try:
+            return self.config.getboolean('connection', 'compact_rpc')
+        except (NoSectionError, NoOptionError):
+            return True
         
 class ConnectionException(Exception):
     def __init__(self, message):
@@ -211,8 +898,22 @@ class Connection:
             sys.exit(1)
         if self.authres != 'sasl':
             print("Warning: unable to perform SASL auth os %s. Old authentication method used!")%self.server
+        # xmpppy doesn't lock around writing a stanza, stanzas are sent from worker and timer threads as well as
+        # the receive loop so every send through the connection is serialised. Waiting control stanzas are sent
+        # ahead of results
+        self.send_lock = LaneLock(config.get_lane_weights())
+        self.unlocked_send = self.conn.send
+        self.conn.send = self.send
         self.conn.sendInitPresence()
 
+    """ Send a stanza, safe to call from any thread """
+    def send(self, stanza):
+        self.send_lock.acquire(get_lane(stanza))
+        try:
+            return self.unlocked_send(stanza)
+        finally:
+            self.send_lock.release()
+
     def unregister(self):
         features.unregister(self.conn, self.server)
     
@@ -246,23 +947,109 @@ class Connection:
     def get_conn(self):
         return self.conn
         
-class Logging:
-    
-    """ Object for logging events, takes an XMPP connection as an argument and joins logging MUC """
-    def __init__(self, conn):
+class Logging(Thread):
+    """ Object for logging events, takes an XMPP connection as an argument and joins logging MUC.
+    Entries below level are discarded, the rest are buffered and sent every interval seconds as multi-line
+    messages of up to batch_size entries, in the result lane so they don't hold up control traffic. At most
+    max_buffered entries are held, beyond that entries are dropped and counted rather than holding up the caller.
+    If filename is given, entries are also appended to it """
+    levels = {'debug':10, 'info':20, 'warning':30, 'error':40}
+
+    def __init__(self, conn, level='info', interval=1.0, batch_size=50, max_buffered=1000, filename=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
         self.conn = conn.get_conn()
+        try:
+            self.level = self.levels[level.lower()]
+        except KeyError:
+            raise ValueError('Unknown logging level %s, expected one of %s' % (level, ', '.join(sorted(self.levels))))
         self.log_muc = conn.join_muc('logging')
-        
-    """ Sends a message of type info to the logging MUC """
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        if filename != None:
+            self.file = open(filename, 'a')
+        else:
+            self.file = None
+        self.entries = []
+        self.dropped = 0
+        self.sent = 0
+        self.stopping = False
+        self.cond = Condition()
+        self.start()
+
+    def debug(self, message):
+        self.add('debug', message)
+
     def info(self, message):
-        message = Message(self.log_muc,'[INFO] %s' % message)
-        message.setType('groupchat')
-        self.conn.send(message)
-    
-    """ Sends a message of type error to the logging MUC """
+        self.add('info', message)
+
+    def warning(self, message):
+        self.add('warning', message)
+
     def error(self, message):
-        message = Message(self.log_muc,'[ERROR] %s' % message)
-        message.setType('groupchat')
-        self.conn.send(message)
+        self.add('error', message)
+
+    def add(self, level, message):
+        if self.levels[level] < self.level:
+            return
+        self.cond.acquire()
+        if len(self.entries) < self.max_buffered:
+            self.entries.append((time.time(), '[%s] %s' % (level.upper(), message)))
+            self.cond.notify()
+        else:
+            self.dropped += 1
+        self.cond.release()
+
+    """ Send any buffered entries and stop, waiting for the last messages to be sent """
+    def end(self):
+        self.cond.acquire()
+        self.stopping = True
+        self.cond.notify()
+        self.cond.release()
+        self.join()
+
+    """ Waits for an entry then for interval seconds more, so entries logged together go in the same messages """
+    def run(self):
+        while True:
+            self.cond.acquire()
+            while len(self.entries) == 0 and self.dropped == 0 and not self.stopping:
+                self.cond.wait()
+            flush_time = time.time() + self.interval
+            while not self.stopping and time.time() < flush_time:
+                self.cond.wait(flush_time - time.time())
+            entries = self.entries
+            self.entries = []
+            if self.dropped > 0:
+                entries.append((time.time(), '[WARNING] %s log entries dropped' % self.dropped))
+                self.dropped = 0
+            stopping = self.stopping
+            self.cond.release()
+
+            self.flush(entries)
+            if stopping:
+                break
+        if self.file != None:
+            self.file.close()
+
+    """ Sends entries to the logging MUC in batches, and appends them to the log file """
+    def flush(self, entries):
+        for i in range(0, len(entries), self.batch_size):
+            message = Message(self.log_muc, '\n'.join([entry for logged, entry in entries[i:i + self.batch_size]]))
+            message.setType('groupchat')
+            message.lane = RESULT_LANE
+            try:
+                self.conn.send(message)
+                self.sent += 1
+            except Exception:
+                # A failed send mustn't stop the logging thread
+                traceback.print_exc()
+        if self.file != None:
+            try:
+                for logged, entry in entries:
+                    self.file.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logged)), entry))
+                self.file.flush()
+            except Exception:
+                traceback.print_exc()
     
 #      Database(settings.get_database_server())